@@ -0,0 +1,293 @@
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
+from os import cpu_count, environ, makedirs
+from os.path import join
+from shutil import rmtree
+from subprocess import DEVNULL, CalledProcessError, check_output
+from tempfile import mkdtemp
+from time import perf_counter
+import argparse
+import io
+import json
+import platform
+import sys
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from src.benchmarks.tree_generator import SCALES, SHAPES, TreeGenerator
+
+# phases spending more than this share of their CPU time in the kernel are flagged as syscall-heavy
+SYSCALL_HEAVY_SHARE = 0.5
+
+# below this much CPU time, the user/system split is mostly timer noise
+MIN_FLAGGED_CPU = 0.02
+
+# per-process I/O counters on Linux
+PROC_IO_FILE = "/proc/self/io"
+
+
+def read_counters() -> dict:
+    """
+    Snapshot of process resource usage.
+    :return: counter name -> value
+    """
+    counters = {}
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        counters.update({
+            "cpu_user": usage.ru_utime,
+            "cpu_system": usage.ru_stime,
+            "voluntary_switches": usage.ru_nvcsw,
+            "involuntary_switches": usage.ru_nivcsw,
+        })
+    try:
+        with open(PROC_IO_FILE) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                counters[name] = int(value)
+    except OSError:
+        pass  # not Linux
+    return counters
+
+
+def peak_rss_mib() -> float:
+    """
+    Peak resident set size of this process so far.
+    :return: MiB, or 0 where unavailable
+    """
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)  # bytes on macOS, KiB elsewhere
+
+
+@contextmanager
+def measure(phases: dict, name: str, files: int = 0, size: int = 0):
+    """
+    Time a phase and record throughput and resource usage under phases[name].
+    The yielded dictionary can be updated with files/bytes that are only known once the phase has run.
+    :param phases: results of the current run
+    :param name: phase name
+    :param files: number of files the phase handles
+    :param size: number of bytes the phase handles
+    :return: work dictionary (files, bytes)
+    """
+    work = {"files": files, "bytes": size}
+    before = read_counters()
+    start = perf_counter()
+    with redirect_stdout(io.StringIO()):  # progress messages would dominate the output
+        yield work
+    seconds = perf_counter() - start
+    after = read_counters()
+
+    delta = {key: after[key] - before[key] for key in after}
+    cpu = delta.get("cpu_user", 0) + delta.get("cpu_system", 0)
+    phases[name] = {
+        "seconds": round(seconds, 4),
+        "files": work["files"],
+        "bytes": work["bytes"],
+        "files_per_s": round(work["files"] / seconds, 1) if seconds else 0,
+        "mb_per_s": round(work["bytes"] / 1e6 / seconds, 2) if seconds else 0,
+        "peak_rss_mib": peak_rss_mib(),
+        "cpu_user": round(delta.get("cpu_user", 0), 4),
+        "cpu_system": round(delta.get("cpu_system", 0), 4),
+        "system_share": round(delta.get("cpu_system", 0) / cpu, 3) if cpu else 0,
+        "read_syscalls": delta.get("syscr", 0),
+        "write_syscalls": delta.get("syscw", 0),
+        "voluntary_switches": delta.get("voluntary_switches", 0),
+    }
+
+
+def run_case(workdir: str, shape_name: str, scale_name: str, args: argparse.Namespace) -> dict:
+    """
+    Generate one tree pair and run every benchmarked phase against it.
+    :param workdir: scratch folder for this case
+    :param shape_name: key of SHAPES
+    :param scale_name: key of SCALES
+    :param args: parsed arguments
+    :return: case results
+    """
+    # imported here, after HOME has been pointed at the scratch folder
+    from src.file_diff.file_diff_evaluator import FileDiffEvaluator
+    from src.file_diff.file_synchronizer import FileSynchronizer
+    from src.file_diff.sync_executor import SyncExecutor
+    from src.gui.constants import SyncOptions
+    from src.gui.path_trie import PathTrie
+
+    phases = {}
+    with measure(phases, "generate") as work:
+        stats = TreeGenerator(args.seed).generate(workdir, SHAPES[shape_name], SCALES[scale_name], args.added,
+                                                  args.removed, args.modified)
+        work.update(files=stats["files"], bytes=stats["bytes"])
+    src, dst = stats["src"], stats["dst"]
+
+    # the first evaluation hashes every modified file; the second one finds the hashes in the cache
+    deltas = []
+    for name in ["evaluate", "evaluate_cached"]:
+        deltas = []
+        with measure(phases, name, stats["files"]):
+            FileDiffEvaluator(deltas.append, args.scan_workers).generate_file_diff(src, dst, SyncOptions["ONE_WAY"])
+    left, right, modified = deltas[0]
+
+    with measure(phases, "path_trie", len(left) + len(modified)):
+        trie = PathTrie()
+        for entries in [left, modified]:
+            for folders, name, _, size in entries.iter_parts():
+                trie.insert_parts(folders, name, size=size)
+
+    try:
+        from src.gui.utilities import gen_treedata
+    except ImportError:
+        print("PySimpleGUI not installed, skipping gen_treedata", file=sys.stderr)
+    else:
+        with measure(phases, "gen_treedata", len(left) + len(modified)):
+            gen_treedata([*left, *modified], b"")
+
+    synchronizer = FileSynchronizer(True, args.sync_workers)
+    with measure(phases, "sync_plan", stats["files"]):
+        plan = synchronizer.plan_sync(src, dst, SyncOptions["ONE_WAY"])
+    with measure(phases, "sync_execute", len(plan), plan.summary()["bytes"]):
+        SyncExecutor(args.sync_workers, synchronizer.delta_threshold).execute(plan)
+
+    # steady state: nothing left to do, so this is pure scanning cost
+    with measure(phases, "sync_noop", stats["files"]):
+        synchronizer.run_sync(src, dst, SyncOptions["ONE_WAY"])
+
+    return {
+        "shape": shape_name,
+        "scale": scale_name,
+        "folders": stats["folders"],
+        "files": stats["files"],
+        "bytes": stats["bytes"],
+        "diff": {"source_only": len(left), "destination_only": len(right), "modified": len(modified)},
+        "phases": phases
+    }
+
+
+def current_commit() -> str:
+    """
+    Commit of the working tree, so results can be matched to the code they measured.
+    :return: commit hash, or "unknown" outside a git checkout
+    """
+    try:
+        return check_output(["git", "rev-parse", "HEAD"], stderr=DEVNULL, text=True).strip()
+    except (OSError, CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """
+    Print how long each phase took relative to a previous run.
+    :param results: current results
+    :param baseline: previously saved results
+    :return: None
+    """
+    previous = {(case["shape"], case["scale"]): case["phases"] for case in baseline["cases"]}
+    print(f"\nCompared with {baseline['meta']['commit'][:12]}:")
+    for case in results["cases"]:
+        old_phases = previous.get((case["shape"], case["scale"]))
+        if old_phases is None:
+            continue
+        for name, phase in case["phases"].items():
+            old = old_phases.get(name)
+            if old and old["seconds"]:
+                ratio = phase["seconds"] / old["seconds"]
+                print(f"  {case['shape']:>6} {case['scale']:>6} {name:<16} {old['seconds']:>9.3f}s -> "
+                      f"{phase['seconds']:>9.3f}s  ({ratio:.2f}x)")
+
+
+def print_summary(results: dict) -> None:
+    """
+    Print a table of all phases, marking the ones dominated by kernel time.
+    :param results: benchmark results
+    :return: None
+    """
+    for case in results["cases"]:
+        print(f"\n{case['shape']} / {case['scale']}: {case['files']} files, {case['bytes'] / 1e6:.1f} MB, "
+              f"diff {case['diff']}")
+        for name, phase in case["phases"].items():
+            cpu = phase["cpu_user"] + phase["cpu_system"]
+            heavy = cpu >= MIN_FLAGGED_CPU and phase["system_share"] > SYSCALL_HEAVY_SHARE
+            flag = "  syscall-heavy" if heavy else ""
+            print(f"  {name:<16} {phase['seconds']:>9.3f}s {phase['files_per_s']:>12.1f} files/s "
+                  f"{phase['mb_per_s']:>9.2f} MB/s  rss {phase['peak_rss_mib']:>7.1f} MiB{flag}")
+
+
+def create_parser() -> argparse.ArgumentParser:
+    """
+    Define command-line interface.
+    :return: argument parser
+    """
+    parser = argparse.ArgumentParser(prog="run_benchmarks", description="Benchmark diff and sync on synthetic trees.")
+    parser.add_argument("--shapes", nargs="+", choices=list(SHAPES), default=list(SHAPES))
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--added", type=float, default=0.05, help="fraction of files only in the source")
+    parser.add_argument("--removed", type=float, default=0.05, help="fraction of files only in the destination")
+    parser.add_argument("--modified", type=float, default=0.05, help="fraction of files that differ")
+    parser.add_argument("--scan-workers", type=int, default=8)
+    parser.add_argument("--sync-workers", type=int, default=4)
+    parser.add_argument("--workdir", help="folder for generated trees (default: a temporary folder)")
+    parser.add_argument("--keep", action="store_true", help="don't delete generated trees")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    return parser
+
+
+def main(argv: list = None) -> int:
+    """
+    Run benchmarks for every requested shape and scale.
+    :param argv: command-line arguments
+    :return: exit code
+    """
+    args = create_parser().parse_args(argv)
+    workdir = args.workdir or mkdtemp(prefix="lockstep-bench-")
+    makedirs(workdir, exist_ok=True)
+
+    # hash cache and manifests go to the scratch folder instead of the user's ~/.lockstep
+    environ["HOME"] = environ["USERPROFILE"] = join(workdir, "home")
+
+    results = {
+        "meta": {
+            "commit": current_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": cpu_count(),
+            "seed": args.seed,
+            "fractions": {"added": args.added, "removed": args.removed, "modified": args.modified},
+        },
+        "cases": []
+    }
+
+    try:
+        for scale_name in args.scales:
+            for shape_name in args.shapes:
+                case_dir = join(workdir, f"{shape_name}-{scale_name}")
+                rmtree(case_dir, ignore_errors=True)
+                makedirs(case_dir)
+                print(f"Running {shape_name} / {scale_name}", file=sys.stderr)
+                try:
+                    results["cases"].append(run_case(case_dir, shape_name, scale_name, args))
+                finally:
+                    if not args.keep:
+                        rmtree(case_dir, ignore_errors=True)
+    finally:
+        if not args.keep and not args.workdir:
+            rmtree(workdir, ignore_errors=True)
+
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+from os import makedirs, utime
+from os.path import join
+from random import Random
+from typing import NamedTuple
+
+# not taken from src.settings.constants: importing that fixes the ~/.lockstep path before the benchmark runner has
+# pointed HOME at its scratch folder
+MIB = 1024 * 1024
+
+# every file's contents are cut from this much seeded random data, so generating large trees stays cheap
+CONTENT_POOL_SIZE = 4 * MIB
+
+# modified destination files are dated this much older than their source, like a stale copy
+STALE_OFFSET_NS = 24 * 3600 * 10 ** 9
+
+# fixed timestamp for generated files, so trees from the same seed are identical down to their mtimes
+BASE_MTIME_NS = 1_600_000_000 * 10 ** 9
+
+
+class TreeShape(NamedTuple):
+    """
+    Layout of a synthetic tree: a balanced tree of folders with the same number of files in each.
+    """
+    fanout: int  # subfolders per folder
+    depth: int  # folder levels below the root
+    files_per_folder: int
+    min_size: int  # bytes
+    max_size: int  # bytes
+
+
+SHAPES = {
+    "wide": TreeShape(fanout=200, depth=1, files_per_folder=10, min_size=1024, max_size=16 * 1024),
+    "deep": TreeShape(fanout=2, depth=10, files_per_folder=1, min_size=1024, max_size=16 * 1024),
+    "tiny": TreeShape(fanout=10, depth=2, files_per_folder=20, min_size=0, max_size=512),
+    # larger than the default delta threshold, so modified files go through block-level delta transfer
+    "huge": TreeShape(fanout=0, depth=0, files_per_folder=2, min_size=80 * MIB, max_size=80 * MIB),
+    "mixed": TreeShape(fanout=4, depth=3, files_per_folder=12, min_size=1024, max_size=MIB),
+}
+
+# multiplier for files per folder
+SCALES = {
+    "small": 1,
+    "medium": 10,
+    "large": 100,
+}
+
+
+class TreeGenerator(object):
+    """
+    This class builds a source and destination tree pair from a seed. Both start out identical; then a fraction of
+    the files is left out of the destination (added), left out of the source (removed), or changed in the
+    destination (modified, same size with a single byte flipped and an older mtime).
+    The same seed and parameters always produce the same trees.
+    """
+    def __init__(self, seed: int = 0) -> None:
+        self.__seed = seed
+        self.__pool = Random(seed).randbytes(CONTENT_POOL_SIZE)
+
+    def generate(self, root: str, shape: TreeShape, scale: int = 1, added: float = 0.05, removed: float = 0.05,
+                 modified: float = 0.05) -> dict:
+        """
+        Write src and dst folders below root.
+        :param root: empty folder to generate into
+        :param shape: tree layout
+        :param scale: multiplier for files per folder
+        :param added: fraction of files only in the source
+        :param removed: fraction of files only in the destination
+        :param modified: fraction of files whose destination copy differs
+        :return: generation statistics, including src and dst paths
+        """
+        rng = Random(self.__seed)
+        src, dst = join(root, "src"), join(root, "dst")
+        stats = {"src": src, "dst": dst, "folders": 0, "files": 0, "bytes": 0, "added": 0, "removed": 0,
+                 "modified": 0}
+
+        for rel_dir in self.__folders(shape):
+            makedirs(join(src, rel_dir), exist_ok=True)
+            makedirs(join(dst, rel_dir), exist_ok=True)
+            stats["folders"] += 1
+
+            for i in range(shape.files_per_folder * scale):
+                rel_path = join(rel_dir, f"file{i:06d}.bin")
+                size = rng.randint(shape.min_size, shape.max_size)
+                data = self.__content(rng, size)
+                fate = rng.random()
+
+                if fate < added:
+                    self.__write(join(src, rel_path), data, BASE_MTIME_NS)
+                    stats["added"] += 1
+                elif fate < added + removed:
+                    self.__write(join(dst, rel_path), data, BASE_MTIME_NS)
+                    stats["removed"] += 1
+                elif fate < added + removed + modified and size > 0:
+                    self.__write(join(src, rel_path), data, BASE_MTIME_NS)
+                    changed = bytearray(data)
+                    changed[rng.randrange(size)] ^= 0xFF
+                    self.__write(join(dst, rel_path), changed, BASE_MTIME_NS - STALE_OFFSET_NS)
+                    stats["modified"] += 1
+                else:
+                    self.__write(join(src, rel_path), data, BASE_MTIME_NS)
+                    self.__write(join(dst, rel_path), data, BASE_MTIME_NS)
+
+                stats["files"] += 1
+                stats["bytes"] += size
+
+        return stats
+
+    @staticmethod
+    def __folders(shape: TreeShape) -> list:
+        """
+        Relative paths of all folders in the tree, root ("") included, parents before children.
+        :param shape: tree layout
+        :return: list of relative folder paths
+        """
+        folders, level = [""], [""]
+        for depth in range(shape.depth):
+            level = [join(parent, f"dir{depth:02d}_{i:04d}") for parent in level for i in range(shape.fanout)]
+            folders.extend(level)
+        return folders
+
+    def __content(self, rng: Random, size: int) -> bytes:
+        """
+        Pseudo-random contents cut from the pool at a random offset, wrapping around as needed.
+        :param rng: seeded random generator
+        :param size: number of bytes
+        :return: file contents
+        """
+        offset = rng.randrange(CONTENT_POOL_SIZE)
+        if offset + size <= CONTENT_POOL_SIZE:
+            return self.__pool[offset:offset + size]
+
+        chunks, remaining = [], size
+        while remaining > 0:
+            chunk = self.__pool[offset:offset + remaining]
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            offset = 0
+        return b"".join(chunks)
+
+    @staticmethod
+    def __write(path: str, data: bytes, mtime_ns: int) -> None:
+        """
+        Write file and set its timestamps.
+        :param path: file path
+        :param data: contents
+        :param mtime_ns: access and modification time
+        :return: None
+        """
+        with open(path, "wb") as f:
+            f.write(data)
+        utime(path, ns=(mtime_ns, mtime_ns))
@@ -0,0 +1,392 @@
+from contextlib import redirect_stdout
+from typing import Optional
+import argparse
+import json
+import signal
+import sys
+
+# Only lightweight modules are imported here; each command imports what it needs, and nothing under this
+# entry point imports PySimpleGUI or Tkinter, so the CLI works without a display.
+
+
+def load_configuration(name: str) -> tuple:
+    """
+    Read saved settings and one configuration.
+    :param name: configuration name
+    :return: GUI settings dictionary and configuration dictionary (src, dst, sync, include, exclude)
+    """
+    from src.settings.settings import GuiSettings
+
+    gui_settings = GuiSettings()
+    gui_settings.load_gui_settings()
+    configuration = gui_settings.get_configuration(name)
+    if configuration is None:
+        raise SystemExit(f"Unknown configuration: {name}")
+    return gui_settings.gui_settings, configuration
+
+
+def publish(metrics, settings: dict, configuration: str) -> None:
+    """
+    Write metrics of a finished run to ~/.lockstep/metrics and, if configured, a Prometheus textfile.
+    :param metrics: RunMetrics of the run
+    :param settings: GUI settings dictionary
+    :param configuration: configuration name
+    :return: None
+    """
+    from src.gui.constants import SettingsKey
+    from src.metrics.run_metrics import publish_metrics
+
+    publish_metrics(metrics, settings[SettingsKey.METRICS_TEXTFILE_DIR], configuration)
+
+
+def watch_throttle(synchronizer, configuration: str) -> None:
+    """
+    Let a run pick up throttle limits changed while it is running, with `throttle` or in the GUI.
+    :param synchronizer: FileSynchronizer of the run
+    :param configuration: configuration name
+    :return: None
+    """
+    from src.settings.settings import GuiSettings
+
+    gui_settings = GuiSettings()
+    synchronizer.throttle.watch_limits(lambda: gui_settings.throttle_limits(configuration))
+
+
+def merge_counts(per_destination: dict) -> dict:
+    """
+    Add up counts of a fan-out run over its destinations.
+    :param per_destination: destination -> counts
+    :return: summed counts
+    """
+    from collections import Counter
+
+    total = Counter()
+    for counts in per_destination.values():
+        total.update(counts)
+    return dict(total)
+
+
+def evaluate(args: argparse.Namespace) -> dict:
+    """
+    Diff the folders of a configuration.
+    :param args: parsed arguments
+    :return: result dictionary
+    """
+    from src.file_diff.file_diff_evaluator import FileDiffEvaluator
+    from src.file_diff.file_synchronizer import FileSynchronizer
+    from src.file_diff.path_filter import PathFilter
+    from src.gui.constants import SettingsKey
+    from src.metrics.run_metrics import RunMetrics
+
+    settings, metadata = load_configuration(args.configuration)
+    deltas = []
+    metrics = RunMetrics("evaluate")
+    path_filter = PathFilter.from_configuration(metadata)
+    synchronizer = FileSynchronizer.from_settings(settings, metadata)
+    watch_throttle(synchronizer, args.configuration)
+    evaluator = FileDiffEvaluator(deltas.append, settings[SettingsKey.SCAN_WORKERS], throttle=synchronizer.throttle,
+                                  low_priority=synchronizer.low_priority)
+    evaluator.generate_file_diff(metadata["src"], metadata["dst"], metadata["sync"], args.configuration, metrics,
+                                 path_filter)
+
+    left, right, modified = deltas[0]
+    moved = evaluator.find_moves(metadata["src"], metadata["dst"], left, right, metrics, path_filter)
+    publish(metrics, settings, args.configuration)
+
+    result = {"counts": {"source_only": len(left), "destination_only": len(right), "modified": len(modified),
+                         "moved": len(moved)},
+              "metrics": metrics.summary()}
+    if not args.summary:
+        result.update({"source_only": sorted(left), "destination_only": sorted(right), "modified": sorted(modified),
+                       "moved": moved})
+    return result
+
+
+def dry_run(args: argparse.Namespace) -> dict:
+    """
+    Plan a sync of a configuration without changing anything.
+    :param args: parsed arguments
+    :return: result dictionary
+    """
+    from src.file_diff.file_synchronizer import FileSynchronizer
+    from src.file_diff.path_filter import PathFilter
+    from src.metrics.run_metrics import RunMetrics
+
+    settings, metadata = load_configuration(args.configuration)
+    metrics = RunMetrics("dry_run")
+    synchronizer = FileSynchronizer.from_settings(settings, metadata)
+    plans = synchronizer.plan_fan_out(metadata["src"], FileSynchronizer.destinations_of(metadata), metadata["sync"],
+                                      metrics=metrics, path_filter=PathFilter.from_configuration(metadata))
+    if plans is None:
+        raise SystemExit(f"Unexpected sync style: {metadata['sync']}")
+    publish(metrics, settings, args.configuration)
+
+    summaries = {dst: plan.summary() for dst, plan in plans.items()}
+    result = {"summary": merge_counts(summaries), "metrics": metrics.summary()}
+    if len(plans) > 1:
+        result["destinations"] = summaries
+    if not args.summary:
+        result["operations"] = [op._asdict() for plan in plans.values() for op in plan.operations]
+    return result
+
+
+def sync(args: argparse.Namespace) -> dict:
+    """
+    Sync a configuration.
+    :param args: parsed arguments
+    :return: result dictionary
+    """
+    from src.file_diff.file_synchronizer import FileSynchronizer
+    from src.file_diff.path_filter import PathFilter
+    from src.metrics.run_metrics import RunMetrics
+
+    settings, metadata = load_configuration(args.configuration)
+    metrics = RunMetrics("sync")
+    synchronizer = FileSynchronizer.from_settings(settings, metadata)
+    watch_throttle(synchronizer, args.configuration)
+
+    # stop cleanly on Ctrl+C or a service manager's stop, so the next run resumes from the journal
+    handlers = {signum: signal.signal(signum, lambda *_: synchronizer.cancel())
+                for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        results = synchronizer.run_fan_out(metadata["src"], FileSynchronizer.destinations_of(metadata),
+                                           metadata["sync"], metrics=metrics, resume=not args.restart,
+                                           path_filter=PathFilter.from_configuration(metadata),
+                                           full_snapshot=args.full)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    if results is None:
+        raise SystemExit(f"Unexpected sync style: {metadata['sync']}")
+    publish(metrics, settings, args.configuration)
+    result = {"results": merge_counts(results), "cancelled": synchronizer.cancelled, "metrics": metrics.summary()}
+    if len(results) > 1:
+        result["destinations"] = results
+    return result
+
+
+def verify(args: argparse.Namespace) -> dict:
+    """
+    Hash every source file of a configuration and compare it with each destination.
+    :param args: parsed arguments
+    :return: result dictionary
+    """
+    from src.file_diff.file_synchronizer import FileSynchronizer
+    from src.file_diff.path_filter import PathFilter
+    from src.metrics.run_metrics import RunMetrics
+
+    settings, metadata = load_configuration(args.configuration)
+    metrics = RunMetrics("verify")
+    synchronizer = FileSynchronizer.from_settings(settings)
+    if args.algorithm:
+        synchronizer.verify_algorithm = args.algorithm
+
+    handlers = {signum: signal.signal(signum, lambda *_: synchronizer.cancel())
+                for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        reports = synchronizer.verify_folders(metadata["src"], FileSynchronizer.destinations_of(metadata), metrics,
+                                              PathFilter.from_configuration(metadata), args.repair or None)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    publish(metrics, settings, args.configuration)
+
+    counts = {dst: {"verified": report["verified"], "mismatches": len(report["mismatches"]),
+                    "repaired": report["repaired"]} for dst, report in reports.items()}
+    result = {"results": merge_counts(counts), "cancelled": synchronizer.cancelled, "metrics": metrics.summary()}
+    if not args.summary:
+        result["destinations"] = reports
+    return result
+
+
+def snapshots(args: argparse.Namespace) -> dict:
+    """
+    List the archive snapshots of a configuration with the snapshot style.
+    :param args: parsed arguments
+    :return: result dictionary
+    """
+    from src.file_diff.archive_snapshot import SnapshotReader
+
+    _, metadata = load_configuration(args.configuration)
+    return {"snapshots": SnapshotReader(metadata["dst"]).list_snapshots()}
+
+
+def restore(args: argparse.Namespace) -> dict:
+    """
+    Extract files from an archive snapshot of a configuration.
+    :param args: parsed arguments
+    :return: result dictionary
+    """
+    from src.file_diff.archive_snapshot import SnapshotReader
+
+    _, metadata = load_configuration(args.configuration)
+    reader = SnapshotReader(metadata["dst"])
+    name = args.snapshot or reader.latest()
+    if name not in reader.list_snapshots():
+        raise SystemExit(f"Snapshot not found in {metadata['dst']}: {args.snapshot or 'no snapshots yet'}")
+    return {"snapshot": name, "restored": reader.restore(args.to, args.paths or [""], name)}
+
+
+def watch(args: argparse.Namespace) -> None:
+    """
+    Keep a configuration in sync until interrupted.
+    :param args: parsed arguments
+    :return: None
+    """
+    from src.daemon.sync_daemon import DEFAULT_DEBOUNCE, DEFAULT_MAX_DELAY, SyncDaemon
+    from src.file_diff.file_synchronizer import FileSynchronizer
+    from src.file_diff.path_filter import PathFilter
+
+    settings, metadata = load_configuration(args.configuration)
+    debounce = DEFAULT_DEBOUNCE if args.debounce is None else args.debounce
+    synchronizer = FileSynchronizer.from_settings(settings, metadata)
+    watch_throttle(synchronizer, args.configuration)
+    daemon = SyncDaemon(synchronizer, metadata["src"],
+                        FileSynchronizer.destinations_of(metadata), metadata["sync"], debounce, DEFAULT_MAX_DELAY,
+                        PathFilter.from_configuration(metadata))
+
+    def stop(*_) -> None:
+        # a sync in progress stops between chunks, and the next full sync picks up what it left
+        synchronizer.cancel()
+        daemon.stop()
+
+    handlers = {signum: signal.signal(signum, stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        daemon.run()
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    print("Stopped")
+
+
+def throttle(args: argparse.Namespace) -> dict:
+    """
+    Change the throttle limits of a configuration. Running syncs of it pick them up within seconds.
+    :param args: parsed arguments
+    :return: result dictionary
+    """
+    from src.settings.settings import GuiSettings
+
+    gui_settings = GuiSettings()
+    gui_settings.load_gui_settings()
+    configuration = gui_settings.get_configuration(args.configuration)
+    if configuration is None:
+        raise SystemExit(f"Unknown configuration: {args.configuration}")
+
+    if args.reset:
+        configuration.pop("max_mib_per_second", None)
+        configuration.pop("max_ops_per_second", None)
+    if args.mib_per_second is not None:
+        configuration["max_mib_per_second"] = max(0.0, args.mib_per_second)
+    if args.ops_per_second is not None:
+        configuration["max_ops_per_second"] = max(0.0, args.ops_per_second)
+    gui_settings.update_configuration(args.configuration, configuration)
+    bytes_per_second, ops_per_second = gui_settings.throttle_limits(args.configuration)
+    gui_settings.close()
+    return {"configuration": args.configuration, "bytes_per_second": bytes_per_second,
+            "ops_per_second": ops_per_second}
+
+
+def batch(args: argparse.Namespace) -> dict:
+    """
+    Run an action for several configurations concurrently, throttled per block device.
+    :param args: parsed arguments
+    :return: aggregated report
+    """
+    from src.file_diff.batch_runner import BatchAction, BatchRunner
+    from src.settings.settings import GuiSettings
+
+    gui_settings = GuiSettings()
+    gui_settings.load_settings()
+    names = args.configurations or list(gui_settings.configurations.keys())
+    unknown = [name for name in names if name not in gui_settings.configurations]
+    if unknown:
+        raise SystemExit(f"Unknown configurations: {', '.join(unknown)}")
+
+    action = args.action.upper().replace("-", "_")
+    runner = BatchRunner(gui_settings.gui_settings, args.per_device, args.max_jobs, gui_settings.throttle_limits)
+    report = runner.run({name: gui_settings.configurations[name] for name in names}, getattr(BatchAction, action))
+    return report
+
+
+def create_parser() -> argparse.ArgumentParser:
+    """
+    Define command-line interface.
+    :return: argument parser
+    """
+    from src.settings.constants import VERIFY_ALGORITHMS
+
+    parser = argparse.ArgumentParser(prog="lockstep", description="Evaluate or sync saved Lockstep configurations.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, handler, description in [
+        ("evaluate", evaluate, "list files that differ between source and destination"),
+        ("dry-run", dry_run, "list operations a sync would perform"),
+        ("sync", sync, "synchronize destinations with source"),
+        ("verify", verify, "hash source and destination files and report mismatches"),
+        ("watch", watch, "watch source and sync changes continuously"),
+        ("snapshots", snapshots, "list archive snapshots of a configuration with the snapshot style"),
+        ("restore", restore, "extract files from an archive snapshot"),
+        ("throttle", throttle, "change bandwidth and operation limits of a configuration, also while it runs"),
+    ]:
+        command = commands.add_parser(name, help=description, description=description)
+        command.add_argument("configuration", help="name of saved configuration")
+        command.set_defaults(handler=handler)
+        if name in ("evaluate", "dry-run", "verify"):
+            command.add_argument("--summary", action="store_true", help="only print counts")
+        if name == "verify":
+            command.add_argument("--algorithm", choices=VERIFY_ALGORITHMS, help="hash algorithm (default: setting)")
+            command.add_argument("--repair", action="store_true", help="copy mismatched files again")
+        if name == "sync":
+            command.add_argument("--restart", action="store_true",
+                                 help="discard an unfinished earlier sync instead of resuming it")
+            command.add_argument("--full", action="store_true",
+                                 help="with the snapshot style, archive everything instead of changes since the last "
+                                      "snapshot")
+        if name == "restore":
+            command.add_argument("paths", nargs="*", help="files or folders to restore, relative to the source "
+                                                          "(default: everything)")
+            command.add_argument("--to", required=True, help="folder to restore into")
+            command.add_argument("--snapshot", help="snapshot name (default: latest)")
+        if name == "watch":
+            command.add_argument("--debounce", type=float, help="seconds of quiet before syncing")
+        if name == "throttle":
+            command.add_argument("--mib-per-second", type=float, help="bandwidth limit in MiB/s (0: unlimited)")
+            command.add_argument("--ops-per-second", type=float,
+                                 help="directory listings and file operations per second (0: unlimited)")
+            command.add_argument("--reset", action="store_true", help="use the limits of the settings again")
+
+    command = commands.add_parser("batch", help="run several configurations at once",
+                                  description="run several configurations at once, throttled per block device")
+    command.add_argument("action", choices=["evaluate", "dry-run", "sync"])
+    command.add_argument("configurations", nargs="*", help="names of saved configurations (default: all)")
+    command.add_argument("--per-device", type=int, default=1, help="concurrent jobs per block device")
+    command.add_argument("--max-jobs", type=int, default=16, help="concurrent jobs overall")
+    command.set_defaults(handler=batch)
+
+    return parser
+
+
+def main(argv: Optional[list] = None) -> int:
+    """
+    Run a command. Progress messages go to stderr, so stdout only carries the JSON result.
+    :param argv: command-line arguments
+    :return: exit code
+    """
+    args = create_parser().parse_args(argv)
+    with redirect_stdout(sys.stderr):
+        result = args.handler(args)
+
+    if result is not None:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        results = result.get("results", {})
+        if results.get("errors") or results.get("mismatches", 0) > results.get("repaired", 0) or \
+                result.get("failed") or result.get("cancelled"):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+from ctypes.util import find_library
+from errno import ENOSPC
+from os import scandir
+from os.path import join, relpath
+from select import select
+from time import monotonic, sleep
+from typing import Optional
+import ctypes
+import os
+import struct
+
+from src.file_diff.path_filter import PathFilter
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+READ_BUFFER_SIZE = 1024 * 1024
+
+DEFAULT_POLL_INTERVAL = 10.0
+
+
+def create_watcher(root: str, path_filter: Optional[PathFilter] = None):
+    """
+    Create the best available watcher for a folder: inotify on Linux, polling elsewhere or if inotify fails.
+    :param root: folder to watch
+    :param path_filter: directories it rejects are not watched
+    :return: started watcher
+    """
+    try:
+        watcher = InotifyWatcher(root, path_filter)
+        watcher.start()
+        return watcher
+    except OSError as e:
+        print(f"inotify unavailable for {root} ({e}), falling back to polling")
+
+    watcher = PollingWatcher(root, path_filter=path_filter)
+    watcher.start()
+    return watcher
+
+
+class InotifyWatcher(object):
+    """
+    This class watches a folder tree through the Linux inotify API, called directly through ctypes.
+    Every directory gets its own watch; watches are added for directories created or moved in while running.
+    """
+    def __init__(self, root: str, path_filter: Optional[PathFilter] = None) -> None:
+        self.__root = root
+        self.__path_filter = path_filter if path_filter else None
+        self.__fd = -1
+        self.__watches = {}  # wd -> path relative to root
+        libc_name = find_library("c")
+        if libc_name is None:
+            raise OSError("C library not found")
+        self.__libc = ctypes.CDLL(libc_name, use_errno=True)
+
+    def start(self) -> None:
+        """
+        Initialize inotify and add watches for the whole tree.
+        :return: None
+        """
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        try:
+            self.__watch_tree("")
+        except OSError:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        """
+        Release inotify descriptor and all watches.
+        :return: None
+        """
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+        self.__watches = {}
+
+    def read_events(self, timeout: float) -> tuple:
+        """
+        Wait for filesystem events.
+        :param timeout: maximum seconds to wait
+        :return: set of changed paths relative to root, and whether the kernel event queue overflowed
+        """
+        changed, overflowed = set(), False
+        readable, _, _ = select([self.__fd], [], [], timeout)
+        if not readable:
+            return changed, overflowed
+
+        try:
+            buffer = os.read(self.__fd, READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return changed, overflowed
+
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.__watches.pop(wd, None)
+                continue
+
+            parent = self.__watches.get(wd)
+            if parent is None:
+                continue
+            rel_path = join(parent, os.fsdecode(name)) if name else parent
+            changed.add(rel_path)
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and self.__is_watched(rel_path):
+                try:
+                    # contents may have been written before the watch was in place, so the directory is synced whole
+                    self.__watch_tree(rel_path)
+                except OSError as e:
+                    if e.errno == ENOSPC:  # out of inotify watches
+                        overflowed = True
+                    else:
+                        print(f"Unable to watch {rel_path}: {e}")
+
+        changed.discard("")
+        return changed, overflowed
+
+    def __watch_tree(self, rel_dir: str) -> None:
+        """
+        Add watches for directory and everything below it, iteratively.
+        Re-adding a watch for an inode that is already watched returns the same descriptor, which keeps the
+        path mapping correct for directories that were moved within the tree.
+        :param rel_dir: directory relative to root
+        :return: None
+        """
+        pending = [rel_dir]
+        while pending:
+            current = pending.pop()
+            path = join(self.__root, current)
+            wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), path)
+            self.__watches[wd] = current
+
+            with scandir(path) as it:
+                pending.extend(join(current, entry.name) for entry in it if entry.is_dir(follow_symlinks=False) and
+                               self.__is_watched(join(current, entry.name)))
+
+    def __is_watched(self, rel_dir: str) -> bool:
+        """
+        Whether a directory is covered by the path filter, and therefore needs a watch.
+        :param rel_dir: directory relative to root
+        :return: True if it should be watched
+        """
+        return self.__path_filter is None or self.__path_filter.accepts(rel_dir, True)
+
+
+class PollingWatcher(object):
+    """
+    This class detects changes by periodically re-listing the tree and comparing size/mtime snapshots.
+    Used where inotify is unavailable; cost is a full scan per interval, so the interval should be generous.
+    """
+    def __init__(self, root: str, interval: float = DEFAULT_POLL_INTERVAL,
+                 path_filter: Optional[PathFilter] = None) -> None:
+        self.__root = root
+        self.__interval = interval
+        self.__path_filter = path_filter if path_filter else None
+        self.__snapshot = {}
+        self.__next_poll = 0.0
+
+    def start(self) -> None:
+        """
+        Take initial snapshot.
+        :return: None
+        """
+        self.__snapshot = self.__take_snapshot()
+        self.__next_poll = monotonic() + self.__interval
+
+    def close(self) -> None:
+        """
+        Nothing to release; present for parity with InotifyWatcher.
+        :return: None
+        """
+        self.__snapshot = {}
+
+    def read_events(self, timeout: float) -> tuple:
+        """
+        Wait until the next poll is due (or timeout), then report paths that changed since the last poll.
+        :param timeout: maximum seconds to wait
+        :return: set of changed paths relative to root, and False (polling can't overflow)
+        """
+        wait = self.__next_poll - monotonic()
+        if wait > timeout:
+            sleep(timeout)
+            return set(), False
+        sleep(max(0.0, wait))
+
+        snapshot = self.__take_snapshot()
+        changed = {path for path in snapshot.keys() | self.__snapshot.keys()
+                   if snapshot.get(path) != self.__snapshot.get(path)}
+        self.__snapshot = snapshot
+        self.__next_poll = monotonic() + self.__interval
+        return changed, False
+
+    def __take_snapshot(self) -> dict:
+        """
+        List tree iteratively.
+        :return: path relative to root -> (is directory, size, mtime_ns)
+        """
+        snapshot = {}
+        pending = [self.__root]
+        while pending:
+            try:
+                with scandir(pending.pop()) as it:
+                    for entry in it:
+                        st = entry.stat(follow_symlinks=False)
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if self.__path_filter is not None and \
+                                not self.__path_filter.accepts(relpath(entry.path, self.__root), is_dir):
+                            continue
+                        # a directory's mtime changes whenever its entries do, which the entries report themselves
+                        snapshot[relpath(entry.path, self.__root)] = (is_dir, 0 if is_dir else st.st_size,
+                                                                      0 if is_dir else st.st_mtime_ns)
+                        if is_dir:
+                            pending.append(entry.path)
+            except OSError as e:
+                print(f"Unable to poll folder: {e}")
+        return snapshot
@@ -0,0 +1,101 @@
+from threading import Event
+from time import monotonic
+from typing import Optional
+
+from src.daemon.file_watcher import create_watcher
+from src.file_diff.file_synchronizer import FileSynchronizer
+from src.file_diff.path_filter import PathFilter
+
+# wait for this long without new events before syncing, so bursts (e.g. an unpacked archive) become one sync
+DEFAULT_DEBOUNCE = 2.0
+
+# but never hold changes back longer than this while events keep arriving
+DEFAULT_MAX_DELAY = 30.0
+
+
+class SyncDaemon(object):
+    """
+    This class keeps the destinations of a configuration in sync by watching the source for changes.
+    A full sync runs at startup and after event queue overflows; otherwise only changed paths are synced.
+    Directories rejected by the path filter aren't watched.
+    """
+    def __init__(self, file_synchronizer: FileSynchronizer, src: str, dsts: list, style: str,
+                 debounce: float = DEFAULT_DEBOUNCE, max_delay: float = DEFAULT_MAX_DELAY,
+                 path_filter: Optional[PathFilter] = None) -> None:
+        self.__file_synchronizer = file_synchronizer
+        self.__src = src
+        self.__dsts = dsts
+        self.__style = style
+        self.__debounce = debounce
+        self.__max_delay = max_delay
+        self.__stop_event = Event()
+        self.__path_filter = path_filter
+
+    def stop(self) -> None:
+        """
+        Ask the daemon loop to exit. Pending changes are synced first, unless the synchronizer was cancelled.
+        :return: None
+        """
+        self.__stop_event.set()
+
+    def run(self) -> None:
+        """
+        Run until stopped.
+        :return: None
+        """
+        # watch before the initial sync, so changes made during it are picked up afterwards
+        watcher = create_watcher(self.__src, self.__path_filter)
+        self.__full_sync()
+
+        pending = set()
+        first_event, last_event = None, None
+        try:
+            while not self.__stop_event.is_set():
+                changed, overflowed = watcher.read_events(timeout=self.__debounce / 2)
+                now = monotonic()
+
+                if overflowed:
+                    print("Change events were lost, falling back to a full sync")
+                    watcher.close()
+                    watcher = create_watcher(self.__src, self.__path_filter)
+                    self.__full_sync()
+                    pending, first_event, last_event = set(), None, None
+                    continue
+
+                if changed:
+                    pending |= changed
+                    first_event = first_event or now
+                    last_event = now
+
+                if pending and (now - last_event >= self.__debounce or now - first_event >= self.__max_delay):
+                    self.__sync_pending(pending)
+                    pending, first_event, last_event = set(), None, None
+
+            if pending and not self.__file_synchronizer.cancelled:
+                self.__sync_pending(pending)
+        finally:
+            watcher.close()
+
+    def __full_sync(self) -> None:
+        """
+        Scan and sync source and destinations completely.
+        :return: None
+        """
+        print(f"Running full sync from {self.__src} to {', '.join(self.__dsts)}")
+        self.__file_synchronizer.run_fan_out(self.__src, self.__dsts, self.__style, path_filter=self.__path_filter)
+
+    def __sync_pending(self, pending: set) -> None:
+        """
+        Sync coalesced changes. Errors are reported, and the daemon keeps running.
+        :param pending: changed paths relative to the source folder
+        :return: None
+        """
+        print(f"Syncing {len(pending)} changed paths")
+        for dst in self.__dsts:  # few paths change at a time, so destinations are simply synced in turn
+            try:
+                self.__file_synchronizer.sync_paths(self.__src, dst, self.__style, pending, self.__path_filter)
+            except OSError as e:
+                print(f"Sync of changed paths to {dst} failed: {e}")
+            if self.__file_synchronizer.cancelled:
+                break
+
@@ -0,0 +1,395 @@
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from gzip import GzipFile
+from multiprocessing import get_context
+from os import cpu_count, lstat, makedirs, readlink, remove, replace, scandir, sep, utime
+from os.path import basename, dirname, exists, join, relpath
+from shutil import copyfileobj
+from stat import S_IMODE, S_ISDIR, S_ISLNK, S_ISREG
+from threading import Event
+from time import gmtime, strftime, time
+from typing import Iterable, Optional
+import json
+import tarfile
+
+from src.file_diff.copy_backend import TEMP_PREFIX
+from src.file_diff.path_filter import PathFilter
+from src.file_diff.sync_plan import SyncAction, SyncPlan
+from src.file_diff.sync_verifier import WORKER_START_METHOD
+from src.metrics.run_metrics import MetricCounter, MetricPhase, RunMetrics
+from src.settings.constants import MIB
+
+SNAPSHOT_PREFIX = "snapshot-"
+ARCHIVE_SUFFIX = ".tar.gz"
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+
+# entry kinds in the index
+DIRECTORY, FILE, SYMLINK = "d", "f", "l"
+
+# files are grouped into gzip members of about this many bytes; each member is compressed by one worker process
+DEFAULT_MEMBER_SIZE = 8 * MIB
+
+# compression is CPU bound, so one worker per core
+DEFAULT_COMPRESS_WORKERS = cpu_count() or 1
+
+DEFAULT_COMPRESS_LEVEL = 6
+
+READ_CHUNK_SIZE = MIB
+
+# tar's own safety checks on extraction, where the running Python has them
+EXTRACT_OPTIONS = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+
+
+def write_member(filename: str, src: str, rel_paths: list, compress_level: int) -> tuple:
+    """
+    Write entries as tar headers and data, compressed into a single gzip member. Runs in a worker process.
+    The member is not a complete tar file: the end-of-archive blocks are only written once, after the last member.
+    :param filename: file to write the member to
+    :param src: source folder
+    :param rel_paths: entries relative to the source folder, parents before their contents
+    :param compress_level: gzip compression level
+    :return: entries written as (relative path, kind, size, mtime_ns, mode, header offset in the uncompressed
+        member), relative paths that could not be read, and bytes of file data read
+    """
+    written, failed, data_bytes = [], [], 0
+    with open(filename, "wb") as raw, GzipFile(fileobj=raw, mode="wb", compresslevel=compress_level, mtime=0) as gz:
+        for rel_path in rel_paths:
+            path = join(src, rel_path)
+            try:
+                st = lstat(path)
+                tarinfo = tarfile.TarInfo(rel_path.replace(sep, "/"))
+                tarinfo.mode, tarinfo.mtime = S_IMODE(st.st_mode), st.st_mtime_ns / 1e9
+                tarinfo.uid, tarinfo.gid = st.st_uid, st.st_gid
+                if S_ISDIR(st.st_mode):
+                    kind, tarinfo.type = DIRECTORY, tarfile.DIRTYPE
+                elif S_ISLNK(st.st_mode):
+                    kind, tarinfo.type, tarinfo.linkname = SYMLINK, tarfile.SYMTYPE, readlink(path)
+                elif S_ISREG(st.st_mode):
+                    kind, tarinfo.type, tarinfo.size = FILE, tarfile.REGTYPE, st.st_size
+                else:
+                    print(f"Skipping {path}: not a file, directory or symlink")
+                    continue
+                f = open(path, "rb") if kind == FILE else None
+            except OSError as e:
+                print(f"Unable to archive {path}: {e}")
+                failed.append(rel_path)
+                continue
+
+            header = gz.tell()
+            gz.write(tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, "surrogateescape"))
+            remaining, ok = tarinfo.size, True
+            if f is not None:
+                with f:
+                    try:
+                        while remaining:
+                            chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+                            if not chunk:
+                                raise OSError("file shrank while being archived")
+                            gz.write(chunk)
+                            remaining -= len(chunk)
+                    except OSError as e:
+                        # the header is already written, so the stream is kept valid by padding the data with zeros
+                        print(f"Unable to archive {path}: {e}")
+                        ok = False
+                gz.write(bytes(remaining + (-tarinfo.size % tarfile.BLOCKSIZE)))
+                data_bytes += tarinfo.size - remaining
+            if ok:
+                written.append((rel_path, kind, tarinfo.size, st.st_mtime_ns, st.st_mode, header))
+            else:
+                failed.append(rel_path)
+    return written, failed, data_bytes
+
+
+class SnapshotWriter(object):
+    """
+    This class takes point-in-time snapshots of a source folder into a folder of tar.gz archives, one per snapshot.
+    Only entries that are new or changed since the previous snapshot are archived, unless a full snapshot is asked
+    for. Each snapshot's index lists every entry of the source at that time, with the archive, gzip member and
+    offset holding its data, so a single file can be restored by decompressing one member, and a whole snapshot
+    by combining its archive with the earlier ones it refers to. Older archives must be kept as long as a later
+    index refers to them.
+    Files are split into gzip members of about member_size bytes that are compressed in parallel worker processes
+    and concatenated in order. A gzip reader treats concatenated members as one stream, so every archive is also a
+    regular tar.gz that tar can list and extract.
+    """
+    def __init__(self, max_workers: int = DEFAULT_COMPRESS_WORKERS, compress_level: int = DEFAULT_COMPRESS_LEVEL,
+                 member_size: int = DEFAULT_MEMBER_SIZE, metrics: Optional[RunMetrics] = None,
+                 cancel_event: Optional[Event] = None, path_filter: Optional[PathFilter] = None) -> None:
+        self.__max_workers = max(1, max_workers)
+        self.__compress_level = compress_level
+        self.__member_size = member_size
+        self.__metrics = metrics if metrics is not None else RunMetrics("snapshot")  # progress counts entries
+        self.__cancel_event = cancel_event if cancel_event is not None else Event()
+        self.__path_filter = path_filter if path_filter else None
+
+    def plan(self, src: str, folder: str, full: bool = False) -> SyncPlan:
+        """
+        Work out what the next snapshot contains, without writing anything.
+        Operations refer to paths inside the archive: MKDIR and COPY for entries to archive, DELETE for entries
+        that were in the previous snapshot but no longer exist.
+        :param src: source folder
+        :param folder: folder holding the snapshots
+        :param full: whether to archive everything, even if a previous snapshot exists
+        :return: plan whose destination is the new archive
+        """
+        previous = SnapshotReader(folder).load_entries()
+        archive = join(folder, self.__new_name(folder) + ARCHIVE_SUFFIX)
+        plan = SyncPlan(src, archive)
+
+        with self.__metrics.phase(MetricPhase.SCAN):
+            current = self.__scan(src)
+        with self.__metrics.phase(MetricPhase.PLAN):
+            for rel_path, (kind, size, mtime_ns, mode) in sorted(current.items()):
+                old = previous.get(rel_path.replace(sep, "/"))
+                if not full and old is not None and old[:4] == [kind, size, mtime_ns, mode]:
+                    continue
+                if kind == DIRECTORY:
+                    plan.add(SyncAction.MKDIR, join(src, rel_path), join(archive, rel_path))
+                else:
+                    plan.add(SyncAction.COPY, join(src, rel_path), join(archive, rel_path), size)
+            remaining = {rel_path.replace(sep, "/") for rel_path in current}
+            for key in sorted(set(previous) - remaining):
+                plan.add(SyncAction.DELETE, None, join(archive, key.replace("/", sep)))
+        print(f"Planned {'full' if full or not previous else 'incremental'} snapshot of {src} to {archive}: "
+              f"{plan.summary()}")
+        return plan
+
+    def write(self, plan: SyncPlan) -> dict:
+        """
+        Write archive and index for a plan made by plan(). Nothing is kept if the snapshot is cancelled.
+        :param plan: snapshot plan
+        :return: count of archived entries per action, plus errors and entries skipped by cancellation
+        """
+        folder, archive = dirname(plan.dst), basename(plan.dst)
+        name = archive[:-len(ARCHIVE_SUFFIX)]
+        makedirs(folder, exist_ok=True)
+        reader = SnapshotReader(folder)
+        entries = reader.load_entries()
+        for op in plan.of_action(SyncAction.DELETE):
+            entries.pop(relpath(op.dst, plan.dst).replace(sep, "/"), None)
+
+        rel_paths = [relpath(op.src, plan.src) for op in plan.operations if op.action != SyncAction.DELETE]
+        members = self.__group(rel_paths, {relpath(op.src, plan.src): op.size for op in plan.of_action(
+            SyncAction.COPY)})
+        deleted = len(plan.of_action(SyncAction.DELETE))  # only dropped from the index
+        results = Counter({SyncAction.DELETE: deleted} if deleted else {})
+        self.__metrics.add_total(len(plan))
+        self.__metrics.advance(deleted)
+
+        temp_archive = join(folder, TEMP_PREFIX + archive)
+        parts = [f"{temp_archive}.{i}" for i in range(len(members))]
+        complete = False
+        try:
+            with self.__metrics.phase(MetricPhase.COPY), open(temp_archive, "wb") as out, \
+                    ProcessPoolExecutor(self.__max_workers, mp_context=get_context(WORKER_START_METHOD)) as executor:
+                futures = []
+                for index in range(len(members)):
+                    # keep a few members queued per worker, so finished members can be appended in order
+                    while len(futures) < min(len(members), index + self.__max_workers * 2):
+                        futures.append(executor.submit(write_member, parts[len(futures)], plan.src,
+                                                       members[len(futures)], self.__compress_level))
+                    if self.__cancel_event.is_set():
+                        for future in futures[index:]:
+                            future.cancel()
+                        results["cancelled"] += sum(len(member) for member in members[index:])
+                        break
+                    written, failed, data_bytes = futures[index].result()
+                    offset = out.tell()
+                    with open(parts[index], "rb") as part:
+                        copyfileobj(part, out, READ_CHUNK_SIZE)
+                    remove(parts[index])
+
+                    for rel_path, kind, size, mtime_ns, mode, header in written:
+                        entries[rel_path.replace(sep, "/")] = [kind, size, mtime_ns, mode, name, offset, header]
+                        results[SyncAction.MKDIR if kind == DIRECTORY else SyncAction.COPY] += 1
+                    results["errors"] += len(failed)
+                    self.__metrics.count(MetricCounter.BYTES_COPIED, data_bytes)
+                    self.__metrics.count(MetricCounter.ERRORS, len(failed))
+                    self.__metrics.advance(len(members[index]))
+
+                if not self.__cancel_event.is_set():
+                    # end-of-archive marker, as its own member
+                    with GzipFile(fileobj=out, mode="wb", compresslevel=self.__compress_level, mtime=0) as gz:
+                        gz.write(bytes(2 * tarfile.BLOCKSIZE))
+                    complete = True
+        finally:
+            for filename in parts + ([] if complete else [temp_archive]):
+                if exists(filename):
+                    remove(filename)
+
+        if not complete:
+            print(f"Snapshot cancelled: {dict(results)}")
+            return dict(results)
+
+        replace(temp_archive, join(folder, archive))
+        reader.save_index(name, {"version": INDEX_VERSION, "created": time(), "src": plan.src,
+                                 "base": reader.latest(), "entries": entries})
+        print(f"Snapshot {name} complete: {dict(results)}")
+        return dict(results)
+
+    def __scan(self, src: str) -> dict:
+        """
+        List every entry of the source folder.
+        :param src: source folder
+        :return: relative path -> [kind, size, mtime_ns, mode]
+        """
+        entries, pending = {}, [""]
+        while pending:
+            rel_dir = pending.pop()
+            self.__metrics.count(MetricCounter.DIRS_LISTED)
+            try:
+                with scandir(join(src, rel_dir)) as it:
+                    for entry in it:
+                        rel_path = join(rel_dir, entry.name)
+                        st = entry.stat(follow_symlinks=False)
+                        self.__metrics.count(MetricCounter.STAT_CALLS)
+                        if self.__path_filter is not None and \
+                                not self.__path_filter.accepts(rel_path, S_ISDIR(st.st_mode)):
+                            continue
+                        if S_ISDIR(st.st_mode):
+                            entries[rel_path] = [DIRECTORY, 0, st.st_mtime_ns, st.st_mode]
+                            pending.append(rel_path)
+                        elif S_ISLNK(st.st_mode):
+                            entries[rel_path] = [SYMLINK, 0, st.st_mtime_ns, st.st_mode]
+                        elif S_ISREG(st.st_mode):
+                            entries[rel_path] = [FILE, st.st_size, st.st_mtime_ns, st.st_mode]
+            except OSError as e:
+                print(f"Unable to list {join(src, rel_dir)}: {e}")
+                self.__metrics.count(MetricCounter.ERRORS)
+        return entries
+
+    def __group(self, rel_paths: list, sizes: dict) -> list:
+        """
+        Split entries into members of about member_size bytes. A file larger than that gets a member of its own.
+        :param rel_paths: entries in archive order
+        :param sizes: relative path -> size, for files
+        :return: list of members, each a list of relative paths
+        """
+        members, member, member_size = [], [], 0
+        for rel_path in rel_paths:
+            member.append(rel_path)
+            member_size += sizes.get(rel_path, 0) + tarfile.BLOCKSIZE
+            if member_size >= self.__member_size:
+                members.append(member)
+                member, member_size = [], 0
+        if member:
+            members.append(member)
+        return members
+
+    @staticmethod
+    def __new_name(folder: str) -> str:
+        """
+        Name for a new snapshot, sortable by creation time.
+        :param folder: folder holding the snapshots
+        :return: snapshot name, without suffix
+        """
+        name = SNAPSHOT_PREFIX + strftime("%Y%m%d-%H%M%SZ", gmtime())
+        candidate, counter = name, 1
+        while exists(join(folder, candidate + ARCHIVE_SUFFIX)) or exists(join(folder, candidate + INDEX_SUFFIX)):
+            candidate, counter = f"{name}-{counter}", counter + 1
+        return candidate
+
+
+class SnapshotReader(object):
+    """
+    This class lists the snapshots in a folder and restores entries from them using their indexes.
+    """
+    def __init__(self, folder: str) -> None:
+        self.__folder = folder
+
+    def list_snapshots(self) -> list:
+        """
+        Names of complete snapshots, i.e. those whose index was written, oldest first.
+        :return: list of snapshot names
+        """
+        if not exists(self.__folder):
+            return []
+        return sorted(entry.name[:-len(INDEX_SUFFIX)] for entry in scandir(self.__folder)
+                      if entry.name.startswith(SNAPSHOT_PREFIX) and entry.name.endswith(INDEX_SUFFIX))
+
+    def latest(self) -> Optional[str]:
+        """
+        Name of the most recent snapshot.
+        :return: snapshot name, or None if there are none
+        """
+        snapshots = self.list_snapshots()
+        return snapshots[-1] if snapshots else None
+
+    def load_index(self, name: Optional[str] = None) -> Optional[dict]:
+        """
+        Read the index of a snapshot.
+        :param name: snapshot name, or None for the latest
+        :return: index, or None if there is no such snapshot
+        """
+        name = name or self.latest()
+        if name is None or not exists(join(self.__folder, name + INDEX_SUFFIX)):
+            return None
+        with open(join(self.__folder, name + INDEX_SUFFIX), "r") as f:
+            return json.load(f)
+
+    def load_entries(self, name: Optional[str] = None) -> dict:
+        """
+        Read the entries listed in a snapshot's index.
+        :param name: snapshot name, or None for the latest
+        :return: path with forward slashes -> [kind, size, mtime_ns, mode, archive, member offset, header offset];
+            empty if there is no such snapshot
+        """
+        index = self.load_index(name)
+        return index["entries"] if index is not None else {}
+
+    def save_index(self, name: str, index: dict) -> None:
+        """
+        Write index of a new snapshot. The index is written last, so its presence marks the snapshot as complete.
+        :param name: snapshot name
+        :param index: index dictionary
+        :return: None
+        """
+        filename = join(self.__folder, name + INDEX_SUFFIX)
+        with open(join(self.__folder, TEMP_PREFIX + basename(filename)), "w") as f:
+            json.dump(index, f)
+        replace(join(self.__folder, TEMP_PREFIX + basename(filename)), filename)
+
+    def restore(self, output: str, rel_paths: Iterable[str] = ("",), name: Optional[str] = None) -> int:
+        """
+        Extract entries of a snapshot, each from whichever archive holds its data. Only the gzip members containing
+        the requested entries are decompressed, each at most once.
+        :param output: folder to restore into
+        :param rel_paths: files or directories to restore, relative to the source folder; "" restores everything
+        :param name: snapshot name, or None for the latest
+        :return: number of entries restored
+        """
+        entries = self.load_entries(name)
+        prefixes = [rel_path.replace(sep, "/").strip("/") for rel_path in rel_paths]
+        wanted = {key: entry for key, entry in entries.items()
+                  if any(not prefix or key == prefix or key.startswith(prefix + "/") for prefix in prefixes)}
+
+        members = defaultdict(set)
+        for key, (_, _, _, _, archive, offset, _) in wanted.items():
+            members[archive, offset].add(key)
+
+        restored = 0
+        for (archive, offset), keys in sorted(members.items()):
+            with open(join(self.__folder, archive + ARCHIVE_SUFFIX), "rb") as f:
+                f.seek(offset)
+                with GzipFile(fileobj=f, mode="rb") as gz, tarfile.open(fileobj=gz, mode="r|") as tar:
+                    for tarinfo in tar:
+                        if tarinfo.name in keys:
+                            tar.extract(tarinfo, output, **EXTRACT_OPTIONS)
+                            keys.discard(tarinfo.name)
+                            restored += 1
+                            if not keys:
+                                break
+            if keys:
+                print(f"Unable to find {len(keys)} entries in {archive}{ARCHIVE_SUFFIX} at offset {offset}")
+
+        # restoring files into directories bumps their mtime, so set it afterwards, deepest first
+        for key in sorted((key for key, entry in wanted.items() if entry[0] == DIRECTORY), reverse=True):
+            mtime_ns = wanted[key][2]
+            try:
+                utime(join(output, key.replace("/", sep)), ns=(mtime_ns, mtime_ns))
+            except OSError as e:
+                print(f"Unable to set modification time of {key}: {e}")
+        print(f"Restored {restored} entries to {output}")
+        return restored
+
@@ -0,0 +1,153 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from os import stat
+from threading import Lock, Semaphore
+from time import perf_counter
+from typing import Callable, Optional
+
+from src.file_diff.file_diff_evaluator import FileDiffEvaluator
+from src.file_diff.file_synchronizer import FileSynchronizer
+from src.file_diff.path_filter import PathFilter
+from src.gui.constants import Enum, SettingsKey
+from src.metrics.run_metrics import RunMetrics, publish_metrics
+
+BatchAction = Enum([
+    "EVALUATE",
+    "DRY_RUN",
+    "SYNC"
+])
+
+# jobs touching the same block device run this many at a time; jobs on separate devices don't wait on each other
+DEFAULT_PER_DEVICE_LIMIT = 1
+
+# upper bound on jobs in flight overall, regardless of how many devices are involved
+DEFAULT_MAX_JOBS = 16
+
+
+class BatchRunner(object):
+    """
+    This class runs many saved configurations concurrently and aggregates their results into one report.
+    Each job holds a slot on every device (st_dev) its source and destinations live on, so configurations that share
+    a disk are throttled to the per-device limit while configurations on separate disks run fully in parallel.
+    """
+    def __init__(self, settings: dict, per_device_limit: int = DEFAULT_PER_DEVICE_LIMIT,
+                 max_jobs: int = DEFAULT_MAX_JOBS, limits_source: Optional[Callable] = None) -> None:
+        self.__settings = settings
+        self.__limits_source = limits_source  # configuration name -> current throttle limits, polled by each job
+        self.__per_device_limit = max(1, per_device_limit)
+        self.__max_jobs = max(1, max_jobs)
+        self.__device_slots = {}  # st_dev -> Semaphore
+        self.__lock = Lock()
+
+    def run(self, configurations: dict, action: str) -> dict:
+        """
+        Run action for every configuration.
+        :param configurations: configuration name -> configuration (src, dst, sync)
+        :param action: BatchAction value
+        :return: aggregated report
+        """
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.__max_jobs, max(1, len(configurations)))) as executor:
+            futures = {name: executor.submit(self.__run_job, name, metadata, action)
+                       for name, metadata in configurations.items()}
+            jobs = {name: future.result() for name, future in futures.items()}
+
+        failed = [name for name, job in jobs.items() if job["status"] != "ok"]
+        return {
+            "action": action,
+            "elapsed": round(perf_counter() - start, 3),
+            "succeeded": len(jobs) - len(failed),
+            "failed": failed,
+            "jobs": jobs
+        }
+
+    def __slots_for(self, devices: list) -> list:
+        """
+        Get semaphores for devices, creating them on first use.
+        :param devices: device numbers
+        :return: list of semaphores, in device order
+        """
+        with self.__lock:
+            return [self.__device_slots.setdefault(device, Semaphore(self.__per_device_limit)) for device in devices]
+
+    def __run_job(self, name: str, metadata: dict, action: str) -> dict:
+        """
+        Run one configuration once its devices have free slots. Errors are captured in the job report.
+        :param name: configuration name
+        :param metadata: configuration (src, dst, sync)
+        :param action: BatchAction value
+        :return: job report
+        """
+        start = perf_counter()
+        try:
+            # always acquire in ascending device order, so two jobs can't each hold the device the other waits for
+            folders = [metadata["src"], *FileSynchronizer.destinations_of(metadata)]
+            devices = sorted({stat(folder).st_dev for folder in folders})
+            slots = self.__slots_for(devices)
+            for slot in slots:
+                slot.acquire()
+            try:
+                waited = perf_counter() - start
+                result = self.__perform(name, metadata, action)
+            finally:
+                for slot in reversed(slots):
+                    slot.release()
+        except Exception as e:  # one broken configuration shouldn't abort the batch
+            print(f"Batch job {name} failed: {e}")
+            return {"status": "error", "error": str(e), "elapsed": round(perf_counter() - start, 3)}
+
+        print(f"Batch job {name} finished")
+        return {"status": "ok", "devices": devices, "waited": round(waited, 3),
+                "elapsed": round(perf_counter() - start, 3), "result": result}
+
+    def __perform(self, name: str, metadata: dict, action: str) -> dict:
+        """
+        Carry out action for a single configuration.
+        :param name: configuration name
+        :param metadata: configuration (src, dst, sync)
+        :param action: BatchAction value
+        :return: action result
+        """
+        src, dst, style = metadata["src"], metadata["dst"], metadata["sync"]
+        dsts = FileSynchronizer.destinations_of(metadata)
+        metrics = RunMetrics(action.lower())
+        path_filter = PathFilter.from_configuration(metadata)
+        synchronizer = FileSynchronizer.from_settings(self.__settings, metadata)
+        if self.__limits_source is not None:
+            synchronizer.throttle.watch_limits(lambda: self.__limits_source(name))
+
+        if action == BatchAction.EVALUATE:
+            deltas = []
+            evaluator = FileDiffEvaluator(deltas.append, self.__settings[SettingsKey.SCAN_WORKERS],
+                                          throttle=synchronizer.throttle, low_priority=synchronizer.low_priority)
+            evaluator.generate_file_diff(src, dst, style, name, metrics, path_filter)
+            result = dict(zip(["source_only", "destination_only", "modified"], map(len, deltas[0])))
+            result["moved"] = len(evaluator.find_moves(src, dst, deltas[0][0], deltas[0][1], metrics, path_filter))
+        elif action == BatchAction.DRY_RUN:
+            plans = synchronizer.plan_fan_out(src, dsts, style, metrics=metrics, path_filter=path_filter)
+            if plans is None:
+                raise ValueError(f"Unexpected sync style: {style}")
+            result = self.__merge({dst: plan.summary() for dst, plan in plans.items()})
+        else:
+            results = synchronizer.run_fan_out(src, dsts, style, metrics=metrics, path_filter=path_filter)
+            if results is None:
+                raise ValueError(f"Unexpected sync style: {style}")
+            result = self.__merge(results)
+
+        publish_metrics(metrics, self.__settings[SettingsKey.METRICS_TEXTFILE_DIR], name)
+        return {**result, "metrics": metrics.summary()}
+
+    @staticmethod
+    def __merge(per_destination: dict) -> dict:
+        """
+        Add up counts of a fan-out job, keeping the counts per destination if there are several.
+        :param per_destination: destination -> counts
+        :return: summed counts
+        """
+        result = Counter()
+        for counts in per_destination.values():
+            result.update(counts)
+        result = dict(result)
+        if len(per_destination) > 1:
+            result["destinations"] = per_destination
+        return result
@@ -0,0 +1,70 @@
+from os import DirEntry, stat_result
+from typing import Optional
+import hashlib
+
+from src.file_diff.hash_cache import HashCache
+from src.metrics.run_metrics import MetricCounter, MetricPhase, RunMetrics
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ContentComparator(object):
+    """
+    This class decides whether a file present in both folders differs in content.
+    Comparison is staged: size first, then modification time, and only files left ambiguous are hashed.
+    """
+    def __init__(self, hash_cache: Optional[HashCache] = None, metrics: Optional[RunMetrics] = None) -> None:
+        self.__hash_cache = hash_cache if hash_cache is not None else HashCache()
+        self.__metrics = metrics if metrics is not None else RunMetrics("compare")
+
+    def is_modified(self, left: DirEntry, right: DirEntry) -> bool:
+        """
+        Compare a pair of files. Safe to call from multiple threads.
+        :param left: source file entry
+        :param right: destination file entry
+        :return: True if contents differ
+        """
+        left_stat, right_stat = left.stat(), right.stat()
+        self.__metrics.count(MetricCounter.STAT_CALLS, 2)
+        if left_stat.st_size != right_stat.st_size:
+            return True
+        if left_stat.st_mtime_ns == right_stat.st_mtime_ns:
+            return False  # same signature as filecmp's shallow comparison
+
+        with self.__metrics.phase(MetricPhase.COMPARE):
+            return self.digest(left.path, left_stat) != self.digest(right.path, right_stat)
+
+    def flush(self) -> None:
+        """
+        Persist hashes computed since last flush.
+        :return: None
+        """
+        self.__hash_cache.flush()
+
+    def digest(self, path: str, st: stat_result) -> bytes:
+        """
+        Get content digest of file, from cache if it hasn't changed since it was last hashed. Safe to call from
+        multiple threads.
+        :param path: path to file
+        :param st: stat result of file
+        :return: digest
+        """
+        digest = self.__hash_cache.get(st)
+        if digest is None:
+            digest = self.hash_file(path)
+            self.__metrics.count(MetricCounter.FILES_HASHED)
+            self.__hash_cache.put(st, digest)
+        return digest
+
+    @staticmethod
+    def hash_file(path: str) -> bytes:
+        """
+        Hash file contents in fixed-size chunks.
+        :param path: path to file
+        :return: digest
+        """
+        hasher = hashlib.blake2b()
+        with open(path, "rb") as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                hasher.update(chunk)
+        return hasher.digest()
@@ -0,0 +1,596 @@
+from errno import EBADF, EINVAL, EMLINK, ENODATA, ENOSYS, ENOTSUP, ENOTTY, ENXIO, EOPNOTSUPP, EPERM, EXDEV
+from os import SEEK_CUR, fstat, ftruncate, link, lseek, pread, pwrite, replace, stat, unlink
+from os.path import dirname, join
+from shutil import copystat
+from stat import S_IMODE
+from tempfile import NamedTemporaryFile
+from threading import Event, Lock
+from typing import Iterator, Optional
+from uuid import uuid4
+import os
+
+from src.file_diff.throttle import Throttle
+from src.gui.constants import Enum
+from src.settings.constants import COPY_CHUNK_SIZE
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+CopyMethod = Enum([
+    "REFLINK",
+    "COPY_FILE_RANGE",
+    "SENDFILE",
+    "BUFFERED",
+    "HARDLINK",
+    "SPARSE"
+])
+
+# ioctl request number of FICLONE on Linux (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+# files up to this size are copied by copy_small, with as few system calls as possible
+SMALL_COPY_MAX_SIZE = 1024 * 1024
+
+# files at least this large are preallocated, so the filesystem can lay them out contiguously
+PREALLOCATE_MIN_SIZE = 1024 * 1024
+
+# not available on every platform; without them sparse files are copied in full
+SEEK_DATA = getattr(os, "SEEK_DATA", None)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", None)
+
+# st_blocks is counted in 512-byte units, regardless of the filesystem block size
+STAT_BLOCK_SIZE = 512
+
+# errors shutil.copystat ignores when copying extended attributes
+XATTR_IGNORED_ERRORS = frozenset([EPERM, ENOTSUP, ENODATA, EINVAL])
+
+# errors meaning "this mechanism doesn't work between these filesystems", as opposed to a real I/O failure
+UNSUPPORTED_ERRORS = frozenset([EBADF, EINVAL, ENOSYS, ENOTSUP, ENOTTY, EOPNOTSUPP, EPERM, EXDEV])
+
+# files are written under this prefix next to their destination, then renamed over it
+TEMP_PREFIX = ".lockstep-"
+
+
+class CopyCancelled(Exception):
+    """
+    Raised when a copy is stopped through its cancel event. The destination is left untouched.
+    """
+
+
+class CopyBackend(object):
+    """
+    This class copies files with the cheapest mechanism available between two filesystems: reflink (FICLONE),
+    then copy_file_range, then sendfile, then a large-buffer userspace copy. The first mechanism that works for a
+    (source device, destination device) pair is remembered, so later copies go straight to it.
+    Sparse files are copied region by region (SEEK_DATA/SEEK_HOLE), so holes stay holes; other large files are
+    preallocated first. The kernel is told that sources are read sequentially, so it reads ahead aggressively.
+    Metadata is copied afterwards the same way shutil.copy2 does. With a throttle, every chunk waits for its bytes.
+    Contents are written to a temporary file in the destination folder that replaces the destination only once it
+    is complete, so an interrupted copy never leaves a partial file in place of a good one.
+    """
+    def __init__(self, buffer_size: int = COPY_CHUNK_SIZE, throttle: Optional[Throttle] = None) -> None:
+        self.__buffer_size = max(64 * 1024, buffer_size)
+        self.__throttle = throttle
+        self.__methods = {}  # (src st_dev, dst st_dev) -> CopyMethod
+        self.__link_methods = {}  # st_dev -> CopyMethod that worked for link()
+        self.__lock = Lock()
+        self.__copiers = {
+            CopyMethod.REFLINK: self.__copy_reflink,
+            CopyMethod.COPY_FILE_RANGE: self.__copy_file_range,
+            CopyMethod.SENDFILE: self.__copy_sendfile,
+            CopyMethod.BUFFERED: self.__copy_buffered,
+            CopyMethod.SPARSE: self.__copy_sparse
+        }
+
+    @staticmethod
+    def supports_reflink(folder: str) -> bool:
+        """
+        Whether files in a folder can be reflinked to each other, tried on two empty temporary files.
+        :param folder: existing folder
+        :return: True if FICLONE works there
+        """
+        if fcntl is None:
+            return False
+        try:
+            with NamedTemporaryFile(dir=folder, prefix=TEMP_PREFIX) as sf, \
+                    NamedTemporaryFile(dir=folder, prefix=TEMP_PREFIX) as df:
+                fcntl.ioctl(df.fileno(), FICLONE, sf.fileno())
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def available_methods() -> list:
+        """
+        Copy mechanisms supported by this platform, in order of preference.
+        :return: list of CopyMethod values
+        """
+        methods = []
+        if fcntl is not None:
+            methods.append(CopyMethod.REFLINK)
+        if hasattr(os, "copy_file_range"):
+            methods.append(CopyMethod.COPY_FILE_RANGE)
+        if hasattr(os, "sendfile"):
+            methods.append(CopyMethod.SENDFILE)
+        methods.append(CopyMethod.BUFFERED)
+        return methods
+
+    def copy(self, src: str, dst: str, cancel_event: Optional[Event] = None) -> str:
+        """
+        Copy file contents and metadata, atomically replacing destination if it exists.
+        :param src: source file
+        :param dst: destination file
+        :param cancel_event: stops the copy between chunks when set, raising CopyCancelled
+        :return: CopyMethod used
+        """
+        temp, method = self.copy_to_temp(src, dirname(dst), cancel_event)
+        try:
+            copystat(src, temp)
+            replace(temp, dst)
+        except BaseException:
+            unlink(temp)
+            raise
+        return method
+
+    def copy_small(self, src: str, dst: str, cancel_event: Optional[Event] = None) -> str:
+        """
+        Copy a small file with as few system calls as possible: contents are normally read and written in one go, and
+        metadata is applied through the open descriptors instead of by path. Reflinks are still used where they work.
+        Large and sparse files, and the first file between two devices, take the regular path of copy().
+        :param src: source file
+        :param dst: destination file
+        :param cancel_event: stops the copy before it starts when set, raising CopyCancelled
+        :return: CopyMethod used
+        """
+        with open(src, "rb", buffering=0) as sf:
+            st = fstat(sf.fileno())
+            if st.st_size <= SMALL_COPY_MAX_SIZE and not self.__is_sparse(st):
+                temp = join(dirname(dst), f"{TEMP_PREFIX}{uuid4().hex}")
+                fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                try:
+                    try:
+                        method = self.__copy_small_contents(sf.fileno(), fd, st, cancel_event)
+                    finally:
+                        os.close(fd)
+                    if method is not None:
+                        replace(temp, dst)
+                        return method
+                except BaseException:
+                    unlink(temp)
+                    raise
+                unlink(temp)
+        return self.copy(src, dst, cancel_event)
+
+    def __copy_small_contents(self, src_fd: int, dst_fd: int, st, cancel_event: Optional[Event]) -> Optional[str]:
+        """
+        Write contents and metadata of a small file to an open temporary file, with the mechanism that copy() found
+        to work between the two devices.
+        :param src_fd: source descriptor
+        :param dst_fd: destination descriptor
+        :param st: stat result of the source
+        :param cancel_event: checked before copying
+        :return: CopyMethod used, or None if no mechanism is known for these devices yet
+        """
+        method = self.__methods.get((st.st_dev, fstat(dst_fd).st_dev))
+        if method is None:
+            return None
+        self.__pace(st.st_size, cancel_event)
+        if method == CopyMethod.REFLINK:
+            self.__copy_reflink(src_fd, dst_fd, st.st_size, cancel_event)
+        else:
+            # reads may return less than asked, e.g. on network filesystems; stop at EOF if the file shrank
+            position = 0
+            while position < st.st_size:
+                data = os.read(src_fd, st.st_size - position)
+                if not data:
+                    break
+                self.__write_all(dst_fd, data, position)
+                position += len(data)
+            method = CopyMethod.BUFFERED
+
+        # same metadata as copystat, in the same order; st_flags don't exist where xattrs do
+        os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        if hasattr(os, "listxattr"):
+            try:
+                names = os.listxattr(src_fd)
+            except OSError as e:
+                if e.errno not in XATTR_IGNORED_ERRORS:
+                    raise
+                names = []
+            for name in names:
+                try:
+                    os.setxattr(dst_fd, name, os.getxattr(src_fd, name))
+                except OSError as e:
+                    if e.errno not in XATTR_IGNORED_ERRORS:
+                        raise
+        os.fchmod(dst_fd, S_IMODE(st.st_mode))
+        return method
+
+    def copy_many(self, src: str, dsts: list, cancel_event: Optional[Event] = None) -> list:
+        """
+        Copy one file to several destinations, reading the source only once: each chunk read is written to every
+        destination's temporary file before the next one is read. Holes of sparse sources are skipped. A
+        destination that fails is dropped without affecting the others.
+        :param src: source file
+        :param dsts: destination files
+        :param cancel_event: stops the copy between chunks when set, raising CopyCancelled
+        :return: per destination, None if it was written or the OSError that stopped it
+        """
+        errors = [None] * len(dsts)
+        temps = {}  # destination index -> open temporary file
+        try:
+            with open(src, "rb") as sf:
+                st = fstat(sf.fileno())
+                sparse = self.__is_sparse(st)
+                self.__advise_sequential(sf.fileno())
+                for i, dst in enumerate(dsts):
+                    try:
+                        temps[i] = NamedTemporaryFile(dir=dirname(dst) or ".", prefix=TEMP_PREFIX, delete=False)
+                        if not sparse:
+                            self.__preallocate(temps[i].fileno(), st.st_size)
+                    except OSError as e:
+                        errors[i] = e
+                        if i in temps:
+                            self.__discard(temps.pop(i))
+
+                regions = self.__data_regions(sf.fileno(), st.st_size) if sparse else [(0, st.st_size)]
+                for start, end in regions:
+                    offset = start
+                    while temps and offset < end:
+                        length = min(end - offset, self.__buffer_size)
+                        self.__pace(length * len(temps), cancel_event)  # every destination is written
+                        chunk = pread(sf.fileno(), length, offset)
+                        if not chunk:
+                            break  # file shrank while copying
+                        for i, df in list(temps.items()):
+                            try:
+                                self.__write_all(df.fileno(), chunk, offset)
+                            except OSError as e:
+                                errors[i] = e
+                                self.__discard(temps.pop(i))
+                        offset += len(chunk)
+
+            for i, df in list(temps.items()):
+                try:
+                    ftruncate(df.fileno(), offset if not sparse else st.st_size)
+                    df.close()
+                    copystat(src, df.name)
+                    replace(df.name, dsts[i])
+                except OSError as e:
+                    errors[i] = e
+                    self.__discard(df)
+                del temps[i]
+        finally:
+            for df in temps.values():  # cancelled, or the source couldn't be read
+                self.__discard(df)
+        return errors
+
+    @staticmethod
+    def __discard(df) -> None:
+        """
+        Close and remove a temporary file that won't be renamed into place.
+        :param df: open or closed temporary file
+        :return: None
+        """
+        try:
+            df.close()
+        except OSError:
+            pass
+        try:
+            unlink(df.name)
+        except FileNotFoundError:
+            pass
+
+    def link(self, existing: str, dst: str, cancel_event: Optional[Event] = None, origin: Optional[str] = None) -> str:
+        """
+        Give dst the contents of existing, a file with the same content on the same filesystem, without copying data:
+        a reflink where the filesystem supports it, otherwise a hard link. Falls back to a regular copy where
+        neither works, e.g. across filesystems or past the link limit. The destination is replaced atomically.
+        Reflinks and copies take their metadata from origin, the source dst stands for; hard links share it.
+        :param existing: file to share contents with
+        :param dst: destination file
+        :param cancel_event: stops a fallback copy between chunks when set, raising CopyCancelled
+        :param origin: source file of dst, with the same content as existing; existing itself if not given
+        :return: CopyMethod used
+        """
+        origin = origin or existing
+        existing_stat = stat(existing)
+        try:
+            dst_stat = stat(dst)
+        except FileNotFoundError:
+            dst_stat = None
+        if dst_stat is not None and (dst_stat.st_dev, dst_stat.st_ino) == (existing_stat.st_dev, existing_stat.st_ino):
+            return CopyMethod.HARDLINK  # already linked; renaming a link over the same file would do nothing
+
+        device = existing_stat.st_dev
+        method = self.__link_methods.get(device, CopyMethod.REFLINK if fcntl is not None else CopyMethod.HARDLINK)
+        if method == CopyMethod.REFLINK:
+            with open(existing, "rb") as sf, NamedTemporaryFile(dir=dirname(dst) or ".", prefix=TEMP_PREFIX,
+                                                                delete=False) as df:
+                try:
+                    self.__copy_reflink(sf.fileno(), df.fileno(), 0, None)
+                except OSError as e:
+                    df.close()
+                    unlink(df.name)
+                    if e.errno not in UNSUPPORTED_ERRORS:
+                        raise
+                    method = CopyMethod.HARDLINK
+            if method == CopyMethod.REFLINK:
+                try:
+                    copystat(origin, df.name)
+                    replace(df.name, dst)
+                except BaseException:
+                    unlink(df.name)
+                    raise
+
+        if method == CopyMethod.HARDLINK:
+            temp = join(dirname(dst), f"{TEMP_PREFIX}{uuid4().hex}")
+            try:
+                link(existing, temp)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRORS and e.errno != EMLINK:
+                    raise
+                return self.copy(origin, dst, cancel_event)  # not remembered, the link limit is per file
+            try:
+                replace(temp, dst)
+            except BaseException:
+                unlink(temp)
+                raise
+
+        if self.__link_methods.get(device) != method:
+            with self.__lock:
+                self.__link_methods[device] = method
+        return method
+
+    def copy_to_temp(self, src: str, folder: str, cancel_event: Optional[Event] = None) -> tuple:
+        """
+        Copy file contents into a new temporary file. The caller renames it into place or removes it.
+        :param src: source file
+        :param folder: folder to create the temporary file in, on the destination's filesystem
+        :param cancel_event: stops the copy between chunks when set, raising CopyCancelled
+        :return: temporary file path and CopyMethod used
+        """
+        with open(src, "rb") as sf, NamedTemporaryFile(dir=folder or ".", prefix=TEMP_PREFIX, delete=False) as df:
+            try:
+                self.__advise_sequential(sf.fileno())
+                key = (fstat(sf.fileno()).st_dev, fstat(df.fileno()).st_dev)
+                method = self.__copy_contents(key, sf, df, cancel_event)
+            except BaseException:
+                df.close()
+                unlink(df.name)
+                raise
+        return df.name, method
+
+    def __copy_contents(self, key: tuple, sf, df, cancel_event: Optional[Event]) -> str:
+        """
+        Try mechanisms from the cached (or most preferred) one down until one succeeds. Sparse sources are copied
+        region by region unless they can be reflinked, which keeps holes as well; that choice depends on the file,
+        so it isn't remembered for the device pair.
+        :param key: device pair
+        :param sf: open source file
+        :param df: open destination file
+        :param cancel_event: checked between chunks
+        :return: CopyMethod used
+        """
+        methods = self.available_methods()
+        cached = self.__methods.get(key)
+        if cached is not None:
+            methods = methods[methods.index(cached):]
+
+        st = fstat(sf.fileno())
+        size = st.st_size
+        if self.__is_sparse(st):
+            dense = [method for method in methods if method != CopyMethod.REFLINK]
+            methods = [method for method in methods if method == CopyMethod.REFLINK] + [CopyMethod.SPARSE] + dense
+
+        for method in methods:
+            try:
+                preallocated = method not in (CopyMethod.REFLINK, CopyMethod.SPARSE) and \
+                    self.__preallocate(df.fileno(), size)
+                self.__copiers[method](sf.fileno(), df.fileno(), size, cancel_event)
+                if preallocated:
+                    ftruncate(df.fileno(), lseek(df.fileno(), 0, SEEK_CUR))  # in case the source shrank meanwhile
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRORS or method == CopyMethod.BUFFERED:
+                    raise
+                # start over with the next mechanism; nothing useful was written
+                df.seek(0)
+                df.truncate()
+                sf.seek(0)
+                continue
+
+            if method == CopyMethod.SPARSE:
+                return method
+            if cached != method:
+                with self.__lock:
+                    self.__methods[key] = method
+                print(f"Using {method} for copies between devices {key}")
+            return method
+
+    @staticmethod
+    def __copy_reflink(src_fd: int, dst_fd: int, size: int, cancel_event: Optional[Event]) -> None:
+        """
+        Share source extents with destination (btrfs, XFS). No data is read or written.
+        :param src_fd: source descriptor
+        :param dst_fd: destination descriptor
+        :param size: bytes to copy
+        :param cancel_event: unused, cloning is a single call
+        :return: None
+        """
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+    def __copy_file_range(self, src_fd: int, dst_fd: int, size: int, cancel_event: Optional[Event]) -> None:
+        """
+        Copy in the kernel; may be offloaded to the filesystem or storage server.
+        :param src_fd: source descriptor
+        :param dst_fd: destination descriptor
+        :param size: bytes to copy
+        :param cancel_event: checked between chunks
+        :return: None
+        """
+        remaining = size
+        while remaining > 0:
+            length = min(remaining, self.__buffer_size)
+            self.__pace(length, cancel_event)
+            copied = os.copy_file_range(src_fd, dst_fd, length)
+            if copied == 0:
+                break  # file shrank while copying
+            remaining -= copied
+
+    def __copy_sendfile(self, src_fd: int, dst_fd: int, size: int, cancel_event: Optional[Event]) -> None:
+        """
+        Copy through the kernel page cache without a userspace buffer.
+        :param src_fd: source descriptor
+        :param dst_fd: destination descriptor
+        :param size: bytes to copy
+        :param cancel_event: checked between chunks
+        :return: None
+        """
+        offset = 0
+        while offset < size:
+            length = min(size - offset, self.__buffer_size)
+            self.__pace(length, cancel_event)
+            sent = os.sendfile(dst_fd, src_fd, offset, length)
+            if sent == 0:
+                break
+            offset += sent
+
+    def __copy_buffered(self, src_fd: int, dst_fd: int, size: int, cancel_event: Optional[Event]) -> None:
+        """
+        Portable fallback with a large userspace buffer.
+        :param src_fd: source descriptor
+        :param dst_fd: destination descriptor
+        :param size: bytes to copy
+        :param cancel_event: checked between chunks
+        :return: None
+        """
+        with open(src_fd, "rb", closefd=False) as sf, open(dst_fd, "wb", closefd=False) as df:
+            while True:
+                self.__pace(self.__buffer_size, cancel_event)
+                chunk = sf.read(self.__buffer_size)
+                if not chunk:
+                    break
+                df.write(chunk)
+
+    def __copy_sparse(self, src_fd: int, dst_fd: int, size: int, cancel_event: Optional[Event]) -> None:
+        """
+        Copy only the data regions of a file with holes. The destination is extended to the full size at the end,
+        so trailing holes stay holes too.
+        :param src_fd: source descriptor
+        :param dst_fd: destination descriptor
+        :param size: bytes to copy
+        :param cancel_event: checked between chunks
+        :return: None
+        """
+        for start, end in self.__data_regions(src_fd, size):
+            offset = start
+            while offset < end:
+                length = min(end - offset, self.__buffer_size)
+                self.__pace(length, cancel_event)
+                chunk = pread(src_fd, length, offset)
+                if not chunk:
+                    break
+                self.__write_all(dst_fd, chunk, offset)
+                offset += len(chunk)
+        ftruncate(dst_fd, size)
+
+    @staticmethod
+    def __data_regions(fd: int, size: int) -> Iterator[tuple]:
+        """
+        Find the regions of a file that hold data, skipping holes.
+        :param fd: open file
+        :param size: file size
+        :return: iterator of (start, end) offsets
+        """
+        offset = 0
+        while offset < size:
+            try:
+                start = lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == ENXIO:
+                    return  # only a hole is left
+                raise
+            if start >= size:
+                return
+            offset = min(lseek(fd, start, SEEK_HOLE), size)
+            yield start, offset
+
+    @staticmethod
+    def __write_all(fd: int, data: bytes, offset: int) -> None:
+        """
+        Write data at an offset, continuing after short writes.
+        :param fd: open file
+        :param data: bytes to write
+        :param offset: position in file
+        :return: None
+        """
+        view = memoryview(data)
+        while view:
+            written = pwrite(fd, view, offset)
+            view, offset = view[written:], offset + written
+
+    @staticmethod
+    def __is_sparse(st) -> bool:
+        """
+        Whether a file has holes, i.e. fewer blocks allocated than its size needs.
+        :param st: stat result of the file
+        :return: True if only its data regions should be copied
+        """
+        blocks = getattr(st, "st_blocks", None)
+        return SEEK_DATA is not None and blocks is not None and blocks * STAT_BLOCK_SIZE < st.st_size
+
+    @staticmethod
+    def __advise_sequential(fd: int) -> None:
+        """
+        Tell the kernel a file will be read from start to end, so it reads ahead further.
+        :param fd: open source file
+        :return: None
+        """
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass  # only a hint
+
+    @staticmethod
+    def __preallocate(fd: int, size: int) -> bool:
+        """
+        Reserve space for a large file before writing it, so it is laid out contiguously and a full disk is
+        noticed before anything is copied. Extends the file to size.
+        :param fd: open destination file
+        :param size: final size
+        :return: True if the space was reserved
+        """
+        if size < PREALLOCATE_MIN_SIZE or not hasattr(os, "posix_fallocate"):
+            return False
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRORS:
+                raise
+            return False
+        return True
+
+    def __pace(self, size: int, cancel_event: Optional[Event]) -> None:
+        """
+        Wait until the throttle allows the next chunk, stopping the copy if cancellation was requested.
+        :param size: bytes about to be copied
+        :param cancel_event: cancel event, if any
+        :return: None
+        """
+        self.__check_cancelled(cancel_event)
+        if self.__throttle is not None:
+            self.__throttle.transfer(size, cancel_event)
+            self.__check_cancelled(cancel_event)
+
+    @staticmethod
+    def __check_cancelled(cancel_event: Optional[Event]) -> None:
+        """
+        Stop copy if cancellation was requested.
+        :param cancel_event: cancel event, if any
+        :return: None
+        """
+        if cancel_event is not None and cancel_event.is_set():
+            raise CopyCancelled()
@@ -0,0 +1,85 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from os import stat
+from typing import Optional
+
+from src.file_diff.content_comparator import ContentComparator
+from src.file_diff.copy_backend import CopyBackend
+from src.file_diff.hash_cache import HashCache
+from src.file_diff.move_detector import DEFAULT_HASH_WORKERS
+from src.file_diff.sync_plan import SyncAction, SyncOperation, SyncPlan
+from src.metrics.run_metrics import MetricCounter, MetricPhase, RunMetrics
+
+# a file smaller than one filesystem block takes up a block either way, so linking it saves no space
+MIN_DEDUP_SIZE = 4096
+
+
+class Deduplicator(object):
+    """
+    This class finds copies in a sync plan whose sources have identical content, so each distinct content is copied
+    once and the other destinations are linked to that copy (SyncAction.LINK) instead of being copied again.
+    Sources are grouped by size first; only sizes that occur more than once are hashed.
+    The copy that is kept is the one whose source was modified last. Hard links share a single mtime, so every other
+    source in the group is then no newer than its destination, and the next sync doesn't copy it again.
+    Hard links also share mode and owner, so where the destination can't reflink, only sources with the same
+    permission bits, owner and group are grouped together.
+    """
+    def __init__(self, hash_cache: Optional[HashCache] = None, metrics: Optional[RunMetrics] = None,
+                 max_workers: int = DEFAULT_HASH_WORKERS, min_size: int = MIN_DEDUP_SIZE) -> None:
+        self.__metrics = metrics if metrics is not None else RunMetrics("deduplicate")
+        self.__content_comparator = ContentComparator(hash_cache, self.__metrics)
+        self.__max_workers = max(1, max_workers)
+        self.__min_size = min_size
+
+    def deduplicate(self, plan: SyncPlan) -> int:
+        """
+        Replace copies of duplicate content with links, in place.
+        :param plan: plan whose copies and overwrites all write into the destination folder
+        :return: number of operations turned into links
+        """
+        by_size = defaultdict(list)
+        for op in plan.of_action(SyncAction.COPY, SyncAction.OVERWRITE):
+            if op.size >= self.__min_size:
+                by_size[op.size].append(op)
+        candidates = [op for ops in by_size.values() if len(ops) > 1 for op in ops]
+        if not candidates:
+            return 0
+
+        with self.__metrics.phase(MetricPhase.COMPARE), ThreadPoolExecutor(self.__max_workers) as executor:
+            hashed = list(executor.map(self.__digest, candidates))
+        self.__content_comparator.flush()
+
+        # reflinks keep their own metadata; hard links share the inode, and with it mode, owner and group
+        hard_links = not CopyBackend.supports_reflink(plan.dst)
+        groups = defaultdict(list)
+        for op, st, digest in hashed:
+            if digest is not None:
+                key = (op.size, digest, st.st_mode & 0o7777, st.st_uid, st.st_gid) if hard_links else (op.size, digest)
+                groups[key].append((st.st_mtime_ns, op.dst, op))
+
+        links = {}  # destination -> destination of the copy holding the same content
+        for group in groups.values():
+            if len(group) > 1:
+                _, kept, _ = max(group)
+                links.update((dst, kept) for _, dst, _ in group if dst != kept)
+
+        plan.operations = [SyncOperation(SyncAction.LINK, links[op.dst], op.dst, origin=op.src) if op.dst in links
+                           else op for op in plan.operations]
+        if links:
+            saved = sum(op.size for op, _, _ in hashed if op.dst in links)
+            print(f"Deduplicated {len(links)} copies, saving {saved} bytes")
+        return len(links)
+
+    def __digest(self, op: SyncOperation) -> tuple:
+        """
+        Hash source of a copy. Runs on a worker thread.
+        :param op: copy or overwrite
+        :return: operation, stat result and digest; digest is None if the file can't be read
+        """
+        try:
+            st = stat(op.src)
+            self.__metrics.count(MetricCounter.STAT_CALLS)
+            return op, st, self.__content_comparator.digest(op.src, st)
+        except OSError as e:
+            print(f"Unable to hash {op.src} for deduplication: {e}")
+            return op, None, None
@@ -0,0 +1,256 @@
+from mmap import ACCESS_READ, mmap
+from os import replace, unlink
+from threading import Event
+from os.path import dirname, getsize
+from shutil import copystat
+from tempfile import NamedTemporaryFile
+from typing import Optional
+from zlib import adler32
+import hashlib
+
+from src.file_diff.copy_backend import TEMP_PREFIX, CopyBackend, CopyCancelled
+from src.file_diff.throttle import Throttle
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+# byte-by-byte search for shifted blocks runs in Python, so cap it per file and fall back to aligned blocks only
+DEFAULT_ROLL_BUDGET = 4 * 1024 * 1024
+
+ADLER_MOD = 65521
+
+# reads and writes are paced through the throttle in chunks of this size
+PACE_CHUNK_SIZE = 1024 * 1024
+
+
+class DeltaTransfer(object):
+    """
+    This class updates an existing destination file from its source by rewriting only the blocks that changed.
+    Blocks of the destination are signed with a weak Adler-32 checksum and a strong BLAKE2b hash, then the
+    source is scanned for matching blocks, rsync-style, with a rolling checksum to find content that moved.
+    The new contents are always assembled in a temporary file that atomically replaces the destination.
+    With a throttle, every read and write waits for its bytes, like the copies of CopyBackend. Once the cancel
+    event is set, the transfer stops between chunks, removes its temporary file and raises CopyCancelled.
+    """
+    def __init__(self, block_size: int = DEFAULT_BLOCK_SIZE, roll_budget: int = DEFAULT_ROLL_BUDGET,
+                 copy_backend: Optional[CopyBackend] = None, throttle: Optional[Throttle] = None,
+                 cancel_event: Optional[Event] = None) -> None:
+        self.__block_size = block_size
+        self.__roll_budget = roll_budget
+        self.__throttle = throttle
+        self.__cancel_event = cancel_event
+        self.__copy_backend = copy_backend if copy_backend is not None else CopyBackend(throttle=throttle)
+
+    def transfer(self, src: str, dst: str) -> int:
+        """
+        Bring destination in line with source, then copy source metadata over.
+        :param src: source file
+        :param dst: existing destination file
+        :return: number of bytes written to destination
+        """
+        size = getsize(src)
+        if size == 0 or getsize(dst) == 0:
+            self.__copy_backend.copy(src, dst, self.__cancel_event)
+            return size
+
+        signatures = self.__sign(dst)
+        with open(src, "rb") as sf, mmap(sf.fileno(), 0, access=ACCESS_READ) as data:
+            instructions = self.__match(data, signatures)
+            if all(kind == "literal" or offset == position for kind, position, offset, _ in instructions):
+                temp, written = self.__patch_copy(data, dst, instructions)
+            else:
+                temp, written = self.__rebuild(data, dst, instructions)
+
+        try:
+            copystat(src, temp)
+            replace(temp, dst)
+        except BaseException:
+            unlink(temp)
+            raise
+        print(f"Delta transfer of {src}: wrote {written} of {size} bytes")
+        return written
+
+    @staticmethod
+    def __strong(block) -> bytes:
+        """
+        Strong hash used to confirm weak checksum hits.
+        :param block: block data
+        :return: digest
+        """
+        return hashlib.blake2b(block, digest_size=16).digest()
+
+    def __sign(self, path: str) -> dict:
+        """
+        Compute block signatures of file.
+        :param path: destination file
+        :return: weak checksum -> {strong hash -> set of block offsets}
+        """
+        signatures = {}
+        offset = 0
+        with open(path, "rb") as f:
+            while True:
+                self.__pace(self.__block_size)
+                block = f.read(self.__block_size)
+                if not block:
+                    break
+                signatures.setdefault(adler32(block), {}).setdefault(self.__strong(block), set()).add(offset)
+                offset += len(block)
+        return signatures
+
+    def __lookup(self, signatures: dict, weak: int, block, position: int) -> Optional[int]:
+        """
+        Find destination block identical to source block, preferring one at the same offset.
+        :param signatures: destination signatures
+        :param weak: weak checksum of source block
+        :param block: source block data
+        :param position: offset of block in source
+        :return: destination offset, or None if no block matches
+        """
+        candidates = signatures.get(weak)
+        if candidates is None:
+            return None
+        offsets = candidates.get(self.__strong(block))
+        if offsets is None:
+            return None
+        return position if position in offsets else next(iter(offsets))
+
+    def __match(self, data: mmap, signatures: dict) -> list:
+        """
+        Describe source as a sequence of destination blocks and literal source ranges.
+        :param data: mapped source file
+        :param signatures: destination signatures
+        :return: list of (kind, source position, destination offset, length); offset is unused for literals
+        """
+        block_size, size = self.__block_size, len(data)
+        instructions = []
+        position, literal_start, roll_budget = 0, 0, self.__roll_budget
+        weak = None
+        paced = 0  # source bytes paced through the throttle so far
+
+        def emit(kind: str, start: int, offset: int, length: int) -> None:
+            # merge with previous instruction if contiguous on both sides
+            if instructions:
+                last_kind, last_start, last_offset, last_length = instructions[-1]
+                if last_kind == kind and last_start + last_length == start and \
+                        (kind == "literal" or last_offset + last_length == offset):
+                    instructions[-1] = (kind, last_start, last_offset, last_length + length)
+                    return
+            instructions.append((kind, start, offset, length))
+
+        while position < size:
+            length = min(block_size, size - position)
+            if position + length > paced:
+                self.__pace(min(PACE_CHUNK_SIZE, size - paced))
+                paced += PACE_CHUNK_SIZE
+            if weak is None:
+                weak = adler32(data[position:position + length])
+
+            offset = None
+            if weak in signatures:  # only slice out the block once the weak checksum hits
+                offset = self.__lookup(signatures, weak, data[position:position + length], position)
+            if offset is not None:
+                if literal_start < position:
+                    emit("literal", literal_start, 0, position - literal_start)
+                emit("block", position, offset, length)
+                position += length
+                literal_start, weak = position, None
+            elif roll_budget > 0 and position + block_size < size:
+                # slide window by one byte: drop data[position], add data[position + block_size]
+                a, b = weak & 0xFFFF, weak >> 16
+                out_byte, in_byte = data[position], data[position + block_size]
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                weak = (b << 16) | a
+                position += 1
+                roll_budget -= 1
+            else:
+                # budget spent: only check block-aligned positions from here on
+                position += length
+                weak = None
+
+        if literal_start < size:
+            emit("literal", literal_start, 0, size - literal_start)
+        return instructions
+
+    def __patch_copy(self, data: mmap, dst: str, instructions: list) -> tuple:
+        """
+        Copy destination (a reflink where supported, otherwise an in-kernel copy), then write changed ranges into
+        the copy. Used when every matched block is already in place.
+        :param data: mapped source file
+        :param dst: destination file
+        :param instructions: delta instructions
+        :return: path of patched temporary file, and number of bytes written from the source
+        """
+        temp, _ = self.__copy_backend.copy_to_temp(dst, dirname(dst), self.__cancel_event)
+        written = 0
+        try:
+            with open(temp, "r+b") as f:
+                for kind, position, _, length in instructions:
+                    if kind == "literal":
+                        f.seek(position)
+                        self.__write_range(f, data, position, length)
+                        written += length
+                f.truncate(len(data))
+        except BaseException:
+            unlink(temp)
+            raise
+        return temp, written
+
+    def __rebuild(self, data: mmap, dst: str, instructions: list) -> tuple:
+        """
+        Assemble new file from old destination blocks and source literals in a temporary file.
+        :param data: mapped source file
+        :param dst: destination file
+        :param instructions: delta instructions
+        :return: path of temporary file, and number of bytes written
+        """
+        with open(dst, "rb") as old, NamedTemporaryFile(dir=dirname(dst), prefix=TEMP_PREFIX, delete=False) as new:
+            try:
+                for kind, position, offset, length in instructions:
+                    if kind == "literal":
+                        self.__write_range(new, data, position, length)
+                    else:
+                        old.seek(offset)
+                        for start in range(0, length, PACE_CHUNK_SIZE):
+                            chunk_length = min(PACE_CHUNK_SIZE, length - start)
+                            self.__pace(2 * chunk_length)  # read from the old file, then written
+                            new.write(old.read(chunk_length))
+            except BaseException:
+                new.close()
+                unlink(new.name)
+                raise
+
+        return new.name, len(data)
+
+    def __write_range(self, f, data: mmap, position: int, length: int) -> None:
+        """
+        Write a range of the source at the current position of a file, in paced chunks.
+        :param f: open file
+        :param data: mapped source file
+        :param position: start of range in source
+        :param length: length of range
+        :return: None
+        """
+        for start in range(position, position + length, PACE_CHUNK_SIZE):
+            end = min(start + PACE_CHUNK_SIZE, position + length)
+            self.__pace(end - start)
+            f.write(data[start:end])
+
+    def __pace(self, size: int) -> None:
+        """
+        Wait until the throttle allows the next chunk, if there is a throttle, stopping the transfer if cancellation
+        was requested.
+        :param size: bytes about to be read or written
+        :return: None
+        """
+        self.__check_cancelled()
+        if self.__throttle is not None:
+            self.__throttle.transfer(size, self.__cancel_event)
+            self.__check_cancelled()
+
+    def __check_cancelled(self) -> None:
+        """
+        Stop transfer if cancellation was requested. Callers remove their temporary file on the way out.
+        :return: None
+        """
+        if self.__cancel_event is not None and self.__cancel_event.is_set():
+            raise CopyCancelled()
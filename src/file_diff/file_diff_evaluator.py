@@ -1,52 +1,147 @@
-from filecmp import dircmp
-from os.path import join, normpath
-from typing import Callable
+from typing import Callable, Iterator, Optional
+
+from src.file_diff.content_comparator import ContentComparator
+from src.file_diff.hash_cache import HashCache
+from src.file_diff.move_detector import MoveDetector
+from src.file_diff.path_filter import PathFilter
+from src.file_diff.scan_manifest import ScanManifest
+from src.file_diff.throttle import Throttle
+from src.file_diff.tree_walker import DEFAULT_BATCH_SIZE, TreeWalker
+from src.metrics.run_metrics import MetricPhase, RunMetrics
+from src.settings.constants import DEFAULT_MAX_WORKERS
 
 
 class FileDiffEvaluator(object):
     """
     This class is responsible for producing the delta between the source and destination folders.
+    Like the sync planner's scan, it lists directories within the limits of a throttle, if given.
     """
-    def __init__(self, callback: Callable) -> None:
+    def __init__(self, callback: Callable, max_workers: int = DEFAULT_MAX_WORKERS,
+                 batch_callback: Optional[Callable] = None, throttle: Optional[Throttle] = None,
+                 low_priority: bool = False) -> None:
         self.__callback = callback  # called after diff is completed
+        self.__batch_callback = batch_callback  # enables streaming mode, called with each batch of results
+        self.__max_workers = max_workers
+        self.__throttle = throttle  # may be shared with a synchronizer, so limits set on either apply to both
+        self.__low_priority = low_priority
+        self.__hash_cache = HashCache()
+
+    @property
+    def max_workers(self) -> int:
+        """
+        Getter for number of threads used to list directories.
+        :return: max_workers value
+        """
+        return self.__max_workers
+
+    @max_workers.setter
+    def max_workers(self, max_workers: int) -> None:
+        """
+        Setter for number of threads used to list directories. Applies to the next evaluation.
+        :param max_workers: thread count
+        :return: None
+        """
+        self.__max_workers = max_workers
+
+    @property
+    def low_priority(self) -> bool:
+        """
+        Getter for whether directories are listed at idle I/O priority.
+        :return: low_priority value
+        """
+        return self.__low_priority
 
-    def generate_file_diff(self, src: str, dst: str, sync_style: str) -> None:
+    @low_priority.setter
+    def low_priority(self, low_priority: bool) -> None:
+        """
+        Setter for whether directories are listed at idle I/O priority. Applies to the next evaluation.
+        :param low_priority: boolean
+        :return: None
+        """
+        self.__low_priority = low_priority
+
+    def generate_file_diff(self, src: str, dst: str, sync_style: str, configuration: Optional[str] = None,
+                           metrics: Optional[RunMetrics] = None, path_filter: Optional[PathFilter] = None) -> None:
         """
         Generates differences in files between source and destination folder.
+        Callback receives ScanResults of source-only, destination-only and modified (source) entries.
+        In streaming mode those arrive in batches through the batch callback, and the callback only gets totals.
         :param src: source folder
         :param dst: destination folder
         :param sync_style: currently used for debug
+        :param configuration: name of saved configuration, enables incremental scan from its manifest
+        :param metrics: collects timings, counters and progress of this run, if given
+        :param path_filter: include/exclude rules of the configuration, if any
         :return: None
         """
         print(f"Received file diff options: src={src}, dst={dst}, sync_style={sync_style}")
-        deltas = self.__file_diff(src, dst)
-        self.__callback([self.__normalize_paths(delta) for delta in deltas])
+        if self.__batch_callback is None:
+            deltas = None
+            for batch in self.iter_file_diff(src, dst, configuration, metrics=metrics, path_filter=path_filter):
+                if deltas is None:
+                    deltas = batch
+                else:
+                    for delta, entries in zip(deltas, batch):
+                        delta.extend(entries)
+            self.__callback(deltas)
+        else:
+            totals = [0, 0, 0]
+            for batch in self.iter_file_diff(src, dst, configuration, metrics=metrics, path_filter=path_filter):
+                self.__batch_callback(batch)  # may block, which pauses the scan
+                totals = [total + len(entries) for total, entries in zip(totals, batch)]
+            self.__callback(totals)
 
-    @staticmethod
-    def __normalize_paths(paths: list) -> list:
+    def iter_file_diff(self, src: str, dst: str, configuration: Optional[str] = None,
+                       batch_size: int = DEFAULT_BATCH_SIZE, metrics: Optional[RunMetrics] = None,
+                       path_filter: Optional[PathFilter] = None) -> Iterator[list]:
         """
-        Makes path separators consistent, then swaps to forward slash to mitigate rendering errors.
-        PySimpleGUI doesn't appear to handle escaping backslashes cleanly.
-        :param paths: list of raw file paths
-        :return: list of normalized file paths
+        Generates differences in bounded batches while the folders are being walked.
+        :param src: source folder
+        :param dst: destination folder
+        :param configuration: name of saved configuration, if any
+        :param batch_size: maximum number of entries per batch
+        :param metrics: collects timings, counters and progress of this run, if given
+        :param path_filter: include/exclude rules of the configuration, if any
+        :return: iterator of [source deltas, destination deltas, modified files] as ScanResult; at least one batch
         """
-        return [normpath(path).replace("\\", "/") for path in paths]
+        manifest = None
+        if configuration:
+            manifest = ScanManifest(configuration)
+            manifest.load(src, dst)
+
+        if metrics is None:
+            metrics = RunMetrics("evaluate")
+        content_comparator = ContentComparator(self.__hash_cache, metrics)
+        walker = TreeWalker(self.max_workers, content_comparator.is_modified, manifest, metrics=metrics,
+                            path_filter=path_filter, throttle=self.__throttle, low_priority=self.__low_priority)
+        batches = walker.iter_batches(src, dst, batch_size)
+        try:
+            while True:
+                with metrics.phase(MetricPhase.SCAN):  # time spent by the consumer between batches isn't scanning
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                yield list(batch)
+        finally:
+            batches.close()
+            content_comparator.flush()
+
+        if manifest is not None:
+            manifest.save()  # only reached if the walk ran to completion
 
-    def __file_diff(self, src: str, dst: str) -> tuple:
+    def find_moves(self, src: str, dst: str, left_only: list, right_only: list, metrics: Optional[RunMetrics] = None,
+                   path_filter: Optional[PathFilter] = None) -> list:
         """
-        Find full paths of files that differ between source and destination folder.
-        Recursive solution from: https://stackoverflow.com/a/43462738
+        Pair source-only entries with destination-only entries of the same content, i.e. entries that were moved or
+        renamed in the source since the last sync.
         :param src: source folder
         :param dst: destination folder
-        :return: source and destination deltas
+        :param left_only: source-only entries (ScanResult or paths) from a completed diff
+        :param right_only: destination-only entries from the same diff
+        :param metrics: collects timings and counters, if given
+        :param path_filter: include/exclude rules the diff was made with, if any
+        :return: sorted list of [source path, destination path] pairs
         """
-        dcmp = dircmp(src, dst)
-        src_delta = [join(src, f) for f in dcmp.left_only]
-        dst_delta = [join(dst, f) for f in dcmp.right_only]
-
-        for sub_dir in dcmp.common_dirs:
-            child_src_delta, child_dst_delta = self.__file_diff(join(src, sub_dir), join(dst, sub_dir))
-            src_delta.extend(child_src_delta)
-            dst_delta.extend(child_dst_delta)
-
-        return src_delta, dst_delta
+        detector = MoveDetector(self.__hash_cache, metrics, path_filter=path_filter)
+        moves = detector.detect(src, dst, left_only, right_only)
+        return sorted([path, target] for path, target in moves.items())
@@ -1,16 +1,84 @@
-from dirsync import sync
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from typing import Iterable, Optional
 
-from src.gui.constants import SyncOptions
+from src.file_diff.archive_snapshot import SnapshotWriter
+from src.file_diff.deduplicator import Deduplicator
+from src.file_diff.path_filter import PathFilter
+from src.file_diff.shared_listing import SharedListing
+from src.file_diff.sync_executor import SyncExecutor
+from src.file_diff.sync_journal import SyncJournal
+from src.file_diff.sync_plan import SyncPlan, SyncPlanner
+from src.file_diff.sync_verifier import SyncVerifier
+from src.file_diff.throttle import Throttle
+from src.gui.constants import SettingsKey, SyncOptions
+from src.metrics.run_metrics import RunMetrics
+from src.settings.constants import COPY_CHUNK_SIZE, DEFAULT_COPY_WORKERS, DEFAULT_DELTA_THRESHOLD, \
+    DEFAULT_SMALL_FILE_WORKERS, DEFAULT_VERIFY_ALGORITHM, MIB
+from src.settings.settings import limits_of
 
 
 class FileSynchronizer(object):
     """
     This class is responsible for managing the synchronization process between two folders.
+    With the snapshot style, the destination is a folder of compressed archive snapshots instead of a copy.
+    With deduplication, one-way and update syncs copy identical source files once and link the other destinations
+    to that copy (reflink where supported, otherwise hard link). Two-way syncs copy in both directions, so they
+    aren't deduplicated.
+    A configuration may list several destinations. Fan-out syncs plan every destination concurrently from a single
+    scan of the source, then read each changed source file once and write it to every destination that needs it.
+    With verification, every file a sync wrote is hashed afterwards and compared with its source; mismatched files
+    can be copied again automatically.
+    Scans and copies share one throttle, limiting bytes and operations per second; its limits can be changed while a
+    sync runs. With low priority, scan and copy workers run at idle I/O priority and raised niceness.
+    Small-file mode is meant for trees of many tiny files, whose cost is almost all metadata operations: small files
+    are copied in disk order on a large pool of their own, next to the regular workers for large files.
     """
-    def __init__(self, enable_purge):
+    def __init__(self, enable_purge, max_workers: int = DEFAULT_COPY_WORKERS,
+                 delta_threshold: int = DEFAULT_DELTA_THRESHOLD, deduplicate: bool = False,
+                 copy_buffer_size: int = COPY_CHUNK_SIZE, verify: bool = False,
+                 verify_algorithm: str = DEFAULT_VERIFY_ALGORITHM, repair_mismatches: bool = False,
+                 max_bytes_per_second: float = 0, max_ops_per_second: float = 0, low_priority: bool = False,
+                 small_file_mode: bool = False, small_file_workers: int = DEFAULT_SMALL_FILE_WORKERS):
         # inverse dictionary to look up text values from GUI
         self.__sync_option_dict = {v: k for k, v in SyncOptions.items()}
         self.__enable_purge = enable_purge
+        self.__max_workers = max_workers
+        self.__delta_threshold = delta_threshold
+        self.__deduplicate = deduplicate
+        self.__copy_buffer_size = copy_buffer_size
+        self.__verify = verify
+        self.__verify_algorithm = verify_algorithm
+        self.__repair_mismatches = repair_mismatches
+        self.__throttle = Throttle(max_bytes_per_second, max_ops_per_second)
+        self.__low_priority = low_priority
+        self.__small_file_mode = small_file_mode
+        self.__small_file_workers = small_file_workers
+        self.__cancel_event = Event()
+
+    @classmethod
+    def from_settings(cls, settings: dict, configuration: Optional[dict] = None) -> "FileSynchronizer":
+        """
+        Create synchronizer configured from saved GUI settings.
+        :param settings: GUI settings dictionary
+        :param configuration: configuration whose own throttle limits take precedence, if any
+        :return: FileSynchronizer
+        """
+        return cls(settings[SettingsKey.ENABLE_PURGE], settings[SettingsKey.SYNC_WORKERS],
+                   settings[SettingsKey.DELTA_THRESHOLD_MIB] * MIB, settings[SettingsKey.DEDUPLICATE],
+                   settings[SettingsKey.COPY_BUFFER_MIB] * MIB, settings[SettingsKey.VERIFY_AFTER_SYNC],
+                   settings[SettingsKey.VERIFY_ALGORITHM], settings[SettingsKey.REPAIR_MISMATCHES],
+                   *limits_of(settings, configuration), settings[SettingsKey.LOW_PRIORITY],
+                   settings[SettingsKey.SMALL_FILE_MODE], settings[SettingsKey.SMALL_FILE_WORKERS])
+
+    @staticmethod
+    def destinations_of(configuration: dict) -> list:
+        """
+        Destination folders of a configuration. Configurations saved before fan-out only have "dst".
+        :param configuration: configuration (src, dst, destinations, sync, ...)
+        :return: list of destination folders, the first being "dst"
+        """
+        return configuration.get("destinations") or [configuration["dst"]]
 
     @property
     def enable_purge(self):
@@ -29,19 +97,430 @@ class FileSynchronizer(object):
         """
         self.__enable_purge = enable_purge
 
-    def run_sync(self, src, dst, style):
+    @property
+    def max_workers(self) -> int:
+        """
+        Getter for number of parallel copy workers.
+        :return: max_workers value
+        """
+        return self.__max_workers
+
+    @max_workers.setter
+    def max_workers(self, max_workers: int) -> None:
         """
-        Run synchronization process from dirsync.
+        Setter for number of parallel copy workers. Applies to the next sync.
+        :param max_workers: worker count
+        :return: None
+        """
+        self.__max_workers = max_workers
+
+    @property
+    def delta_threshold(self) -> int:
+        """
+        Getter for minimum size of modified files that are updated by block-level delta instead of full copy.
+        :return: delta_threshold value in bytes
+        """
+        return self.__delta_threshold
+
+    @delta_threshold.setter
+    def delta_threshold(self, delta_threshold: int) -> None:
+        """
+        Setter for delta transfer size threshold. Applies to the next sync.
+        :param delta_threshold: size in bytes
+        :return: None
+        """
+        self.__delta_threshold = delta_threshold
+
+    @property
+    def deduplicate(self) -> bool:
+        """
+        Getter for whether files of identical content are copied once and linked.
+        :return: deduplicate value
+        """
+        return self.__deduplicate
+
+    @deduplicate.setter
+    def deduplicate(self, deduplicate: bool) -> None:
+        """
+        Setter for deduplication. Applies to the next sync.
+        :param deduplicate: boolean
+        :return: None
+        """
+        self.__deduplicate = deduplicate
+
+    @property
+    def copy_buffer_size(self) -> int:
+        """
+        Getter for size of each read and write when copying file contents.
+        :return: copy_buffer_size value in bytes
+        """
+        return self.__copy_buffer_size
+
+    @copy_buffer_size.setter
+    def copy_buffer_size(self, copy_buffer_size: int) -> None:
+        """
+        Setter for copy buffer size. Applies to the next sync.
+        :param copy_buffer_size: size in bytes
+        :return: None
+        """
+        self.__copy_buffer_size = copy_buffer_size
+
+    @property
+    def verify(self) -> bool:
+        """
+        Getter for whether written files are verified against their sources after a sync.
+        :return: verify value
+        """
+        return self.__verify
+
+    @verify.setter
+    def verify(self, verify: bool) -> None:
+        """
+        Setter for post-sync verification. Applies to the next sync.
+        :param verify: boolean
+        :return: None
+        """
+        self.__verify = verify
+
+    @property
+    def verify_algorithm(self) -> str:
+        """
+        Getter for hash algorithm used for verification.
+        :return: hashlib algorithm name
+        """
+        return self.__verify_algorithm
+
+    @verify_algorithm.setter
+    def verify_algorithm(self, verify_algorithm: str) -> None:
+        """
+        Setter for verification hash algorithm. Applies to the next verification.
+        :param verify_algorithm: hashlib algorithm name
+        :return: None
+        """
+        self.__verify_algorithm = verify_algorithm
+
+    @property
+    def repair_mismatches(self) -> bool:
+        """
+        Getter for whether files that fail verification are copied again.
+        :return: repair_mismatches value
+        """
+        return self.__repair_mismatches
+
+    @repair_mismatches.setter
+    def repair_mismatches(self, repair_mismatches: bool) -> None:
+        """
+        Setter for repairing mismatched files. Applies to the next verification.
+        :param repair_mismatches: boolean
+        :return: None
+        """
+        self.__repair_mismatches = repair_mismatches
+
+    @property
+    def throttle(self) -> Throttle:
+        """
+        Getter for the throttle shared by scans and copies. Its limits can be changed while a sync runs.
+        :return: throttle
+        """
+        return self.__throttle
+
+    @property
+    def low_priority(self) -> bool:
+        """
+        Getter for whether scan and copy workers run at idle I/O priority and raised niceness.
+        :return: low_priority value
+        """
+        return self.__low_priority
+
+    @low_priority.setter
+    def low_priority(self, low_priority: bool) -> None:
+        """
+        Setter for low priority workers. Applies to the next sync.
+        :param low_priority: boolean
+        :return: None
+        """
+        self.__low_priority = low_priority
+
+    @property
+    def small_file_mode(self) -> bool:
+        """
+        Getter for whether small files are copied in inode order on a pool of their own.
+        :return: small_file_mode value
+        """
+        return self.__small_file_mode
+
+    @small_file_mode.setter
+    def small_file_mode(self, small_file_mode: bool) -> None:
+        """
+        Setter for small-file mode. Applies to the next sync.
+        :param small_file_mode: boolean
+        :return: None
+        """
+        self.__small_file_mode = small_file_mode
+
+    @property
+    def small_file_workers(self) -> int:
+        """
+        Getter for number of parallel workers copying small files in small-file mode.
+        :return: small_file_workers value
+        """
+        return self.__small_file_workers
+
+    @small_file_workers.setter
+    def small_file_workers(self, small_file_workers: int) -> None:
+        """
+        Setter for number of small file copy workers. Applies to the next sync.
+        :param small_file_workers: worker count
+        :return: None
+        """
+        self.__small_file_workers = small_file_workers
+
+    def plan_sync(self, src: str, dst: str, style: str, diff: Optional[list] = None,
+                  metrics: Optional[RunMetrics] = None, path_filter: Optional[PathFilter] = None,
+                  listing: Optional[SharedListing] = None) -> Optional[SyncPlan]:
+        """
+        Work out which operations a sync would perform, without touching either folder.
         :param src: source folder
         :param dst: destination folder
         :param style: how to sync folder (one-way, two-way, update)
+        :param diff: result of FileDiffEvaluator for the same folders, to avoid rescanning
+        :param metrics: collects timings, counters and progress, if given
+        :param path_filter: include/exclude rules of the configuration, if any
+        :param listing: source listings shared with plans for other destinations, if any
+        :return: sync plan, or None if style is unknown
+        """
+        sync_option = self.__sync_option_dict.get(style)
+        if sync_option is None:
+            print(f"Received unexpected sync style: {style}")
+            return None
+        if sync_option == "SNAPSHOT":
+            return SnapshotWriter(metrics=metrics, path_filter=path_filter).plan(src, dst)
+
+        # purge never applied to update, same as dirsync
+        enable_purge = self.enable_purge and sync_option != "UPDATE"
+        planner = SyncPlanner(metrics=metrics, path_filter=path_filter, listing=listing, throttle=self.throttle,
+                              low_priority=self.low_priority)
+        plan = planner.plan(src, dst, sync_option, enable_purge, diff)
+        self.__add_links(plan, sync_option, metrics)
+        return plan
+
+    def plan_fan_out(self, src: str, dsts: list, style: str, metrics: Optional[RunMetrics] = None,
+                     path_filter: Optional[PathFilter] = None) -> Optional[dict]:
+        """
+        Plan syncs from one source to several destinations concurrently. Each source directory is listed once for
+        all of them.
+        :param src: source folder
+        :param dsts: destination folders
+        :param style: how to sync folder (one-way, two-way, update)
+        :param metrics: collects timings, counters and progress, if given
+        :param path_filter: include/exclude rules of the configuration, if any
+        :return: destination -> sync plan, or None if style is unknown
+        """
+        if style not in self.__sync_option_dict:
+            print(f"Received unexpected sync style: {style}")
+            return None
+        dsts = list(dict.fromkeys(dsts))  # a folder listed twice is only synced once
+        if not dsts:
+            return {}
+
+        listing = SharedListing(src, len(dsts))
+        with ThreadPoolExecutor(max_workers=len(dsts)) as executor:
+            plans = executor.map(lambda dst: self.plan_sync(src, dst, style, metrics=metrics, path_filter=path_filter,
+                                                            listing=listing), dsts)
+            return dict(zip(dsts, plans))
+
+    def __add_links(self, plan: SyncPlan, sync_option: str, metrics: Optional[RunMetrics] = None) -> None:
+        """
+        Turn copies of duplicate content into links, if deduplication is enabled.
+        :param plan: sync plan
+        :param sync_option: key of SyncOptions
+        :param metrics: collects hashing time and counters, if given
         :return: None
         """
-        if self.__sync_option_dict[style] == "ONE_WAY":
-            sync(src, dst, "sync", purge=self.enable_purge)
-        elif self.__sync_option_dict[style] == "TWO_WAY":
-            sync(src, dst, "sync", twoway=True, purge=self.enable_purge)
-        elif self.__sync_option_dict[style] == "UPDATE":
-            sync(src, dst, "update")
+        if self.deduplicate and sync_option in ("ONE_WAY", "UPDATE"):
+            Deduplicator(metrics=metrics).deduplicate(plan)
+
+    def cancel(self) -> None:
+        """
+        Ask the running sync to stop. Copies in progress stop between chunks; the job can be resumed later.
+        Safe to call from any thread, e.g. a GUI event handler or a signal handler.
+        :return: None
+        """
+        print("Cancelling sync")
+        self.__cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        """
+        Whether the last sync was cancelled before it finished.
+        :return: True if cancelled
+        """
+        return self.__cancel_event.is_set()
+
+    def run_sync(self, src: str, dst: str, style: str, diff: Optional[list] = None,
+                 metrics: Optional[RunMetrics] = None, resume: bool = True,
+                 path_filter: Optional[PathFilter] = None, full_snapshot: bool = False) -> Optional[dict]:
+        """
+        Run synchronization process: build a plan, then execute it on parallel copy workers.
+        The job is journaled; if an earlier job for the same folders and style was cancelled or crashed, the
+        operations it already did are skipped, while changes made since it stopped are planned as usual. Snapshots
+        aren't journaled: a cancelled snapshot leaves nothing behind, and the next one starts over.
+        :param src: source folder
+        :param dst: destination folder
+        :param style: how to sync folder (one-way, two-way, update)
+        :param diff: result of FileDiffEvaluator for the same folders, to avoid rescanning
+        :param metrics: collects timings, counters and progress, if given
+        :param resume: whether to continue an unfinished job; if False, its journal is discarded
+        :param path_filter: include/exclude rules of the configuration, if any
+        :param full_snapshot: with the snapshot style, archive everything rather than changes since the last one
+        :return: count of completed operations per action, or None if style is unknown
+        """
+        self.__cancel_event.clear()
+        if self.__sync_option_dict.get(style) == "SNAPSHOT":
+            writer = SnapshotWriter(metrics=metrics, cancel_event=self.__cancel_event, path_filter=path_filter)
+            return writer.write(writer.plan(src, dst, full_snapshot))
+
+        plan = self.plan_sync(src, dst, style, diff, metrics, path_filter)
+        if plan is None:
+            return None
+        journal = SyncJournal(src, dst, style)
+        if journal.exists() and resume:
+            plan = journal.resume(plan)
         else:
+            journal.start(plan)
+
+        try:
+            results = self.__executor(metrics, journal).execute(plan)
+        finally:
+            journal.close()
+
+        if not self.cancelled:
+            journal.discard()
+        return self.__verify_plan(plan, results, metrics)
+
+    def run_fan_out(self, src: str, dsts: list, style: str, metrics: Optional[RunMetrics] = None,
+                    resume: bool = True, path_filter: Optional[PathFilter] = None,
+                    full_snapshot: bool = False) -> Optional[dict]:
+        """
+        Sync one source to several destinations, reading each changed source file once for all of them.
+        Every destination has its own journal, so an interrupted fan-out resumes per destination. Two-way syncs
+        write into the source and snapshots archive the source themselves, so those run one destination at a time.
+        :param src: source folder
+        :param dsts: destination folders
+        :param style: how to sync folder (one-way, two-way, update)
+        :param metrics: collects timings, counters and progress, if given
+        :param resume: whether to continue unfinished jobs; if False, their journals are discarded
+        :param path_filter: include/exclude rules of the configuration, if any
+        :param full_snapshot: with the snapshot style, archive everything rather than changes since the last one
+        :return: destination -> count of completed operations per action, or None if style is unknown
+        """
+        sync_option = self.__sync_option_dict.get(style)
+        if sync_option is None:
+            print(f"Received unexpected sync style: {style}")
+            return None
+        dsts = list(dict.fromkeys(dsts))
+        if len(dsts) < 2 or sync_option in ("TWO_WAY", "SNAPSHOT"):
+            results = {}
+            for dst in dsts:
+                results[dst] = self.run_sync(src, dst, style, metrics=metrics, resume=resume, path_filter=path_filter,
+                                             full_snapshot=full_snapshot)
+                if self.cancelled:
+                    break
+            return results
+
+        self.__cancel_event.clear()
+        journals = [SyncJournal(src, dst, style) for dst in dsts]
+        plans = self.plan_fan_out(src, dsts, style, metrics, path_filter)
+        for dst, journal in zip(dsts, journals):
+            if journal.exists() and resume:
+                plans[dst] = journal.resume(plans[dst])
+            else:
+                journal.start(plans[dst])
+
+        try:
+            results = self.__executor(metrics).execute_many([plans[dst] for dst in dsts], journals)
+        finally:
+            for journal in journals:
+                journal.close()
+
+        if not self.cancelled:
+            for journal in journals:
+                journal.discard()
+        return {dst: self.__verify_plan(plans[dst], counts, metrics) for dst, counts in zip(dsts, results)}
+
+    def __executor(self, metrics: Optional[RunMetrics] = None, journal: Optional[SyncJournal] = None) -> SyncExecutor:
+        """
+        Create executor with the current copy settings and throttle.
+        :param metrics: collects timings, counters and progress, if given
+        :param journal: journal of the plan to execute, if any
+        :return: SyncExecutor
+        """
+        return SyncExecutor(self.max_workers, self.delta_threshold, metrics, self.__cancel_event, journal,
+                            self.copy_buffer_size, self.throttle, self.low_priority, self.small_file_mode,
+                            self.small_file_workers)
+
+    def __verify_plan(self, plan: SyncPlan, results: dict, metrics: Optional[RunMetrics] = None) -> dict:
+        """
+        Verify the files an executed plan wrote, if verification is enabled and the sync wasn't cancelled.
+        :param plan: executed sync plan
+        :param results: count of completed operations per action
+        :param metrics: collects hashing time and counters, if given
+        :return: results, with counts of verified, mismatched and repaired files added
+        """
+        if not self.verify or self.cancelled:
+            return results
+        report = SyncVerifier(self.verify_algorithm, metrics=metrics,
+                              cancel_event=self.__cancel_event).verify_plan(plan, self.repair_mismatches)
+        return {**results, "verified": report["verified"], "mismatches": len(report["mismatches"]),
+                "repaired": report["repaired"]}
+
+    def verify_folders(self, src: str, dsts: list, metrics: Optional[RunMetrics] = None,
+                       path_filter: Optional[PathFilter] = None, repair: Optional[bool] = None) -> dict:
+        """
+        Verify every source file against each destination, independently of a sync.
+        :param src: source folder
+        :param dsts: destination folders
+        :param metrics: collects timings, counters and progress, if given
+        :param path_filter: include/exclude rules of the configuration, if any
+        :param repair: whether to copy mismatched files again; defaults to the repair_mismatches setting
+        :return: destination -> verification report
+        """
+        self.__cancel_event.clear()
+        verifier = SyncVerifier(self.verify_algorithm, metrics=metrics, cancel_event=self.__cancel_event)
+        repair = self.repair_mismatches if repair is None else repair
+        reports = {}
+        for dst in dict.fromkeys(dsts):
+            reports[dst] = verifier.verify_tree(src, dst, path_filter, repair)
+            if self.cancelled:
+                break
+        return reports
+
+    def sync_paths(self, src: str, dst: str, style: str, rel_paths: Iterable[str],
+                   path_filter: Optional[PathFilter] = None, metrics: Optional[RunMetrics] = None) -> Optional[dict]:
+        """
+        Synchronize only the given source entries, without scanning the rest of either folder.
+        Like run_sync, it can be cancelled and verifies what it wrote if verification is enabled.
+        :param src: source folder
+        :param dst: destination folder
+        :param style: how to sync folder (one-way, two-way, update)
+        :param rel_paths: changed entries, relative to the source folder
+        :param path_filter: include/exclude rules of the configuration, if any
+        :param metrics: collects timings, counters and progress, if given
+        :return: count of completed operations per action, or None if style is unknown
+        """
+        sync_option = self.__sync_option_dict.get(style)
+        if sync_option is None:
             print(f"Received unexpected sync style: {style}")
+            return None
+        if sync_option == "SNAPSHOT":
+            # a snapshot covers the whole folder, but only archives what changed
+            return self.run_sync(src, dst, style, metrics=metrics, path_filter=path_filter)
+
+        self.__cancel_event.clear()
+        enable_purge = self.enable_purge and sync_option != "UPDATE"
+        planner = SyncPlanner(metrics=metrics, path_filter=path_filter, throttle=self.throttle,
+                              low_priority=self.low_priority)
+        plan = planner.plan_paths(src, dst, sync_option, enable_purge, rel_paths)
+        self.__add_links(plan, sync_option, metrics)
+        results = self.__executor(metrics, None).execute(plan)
+        return self.__verify_plan(plan, results, metrics)
@@ -0,0 +1,80 @@
+from os import makedirs, stat_result
+from os.path import dirname, join
+from threading import Lock
+from typing import Optional
+import sqlite3
+
+from src.settings.constants import LOCKSTEP_FOLDER
+
+HASH_CACHE_FILE = join(LOCKSTEP_FOLDER, "hash_cache.db")
+
+
+class HashCache(object):
+    """
+    This class persists file content hashes keyed by (device, inode, size, mtime_ns).
+    Any change to a file's size or modification time produces a new key, so stale hashes are never returned.
+    """
+    def __init__(self, filename: str = HASH_CACHE_FILE) -> None:
+        self.__filename = filename
+        self.__connection = None  # opened on first use
+        self.__pending = []  # inserts not yet committed to disk
+        self.__lock = Lock()  # shared by evaluator worker threads
+
+    @staticmethod
+    def __key(st: stat_result) -> tuple:
+        """
+        Build cache key from stat result.
+        :param st: stat result of file
+        :return: key tuple
+        """
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+    def __connect(self) -> sqlite3.Connection:
+        """
+        Open cache database, creating it if necessary. Caller must hold the lock.
+        :return: database connection
+        """
+        if self.__connection is None:
+            makedirs(dirname(self.__filename), exist_ok=True)
+            self.__connection = sqlite3.connect(self.__filename, check_same_thread=False)
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest BLOB, "
+                "PRIMARY KEY (dev, ino, size, mtime_ns))"
+            )
+        return self.__connection
+
+    def get(self, st: stat_result) -> Optional[bytes]:
+        """
+        Look up cached digest for file.
+        :param st: stat result of file
+        :return: digest, or None if file has not been hashed in its current state
+        """
+        with self.__lock:
+            row = self.__connect().execute(
+                "SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime_ns=?", self.__key(st)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, st: stat_result, digest: bytes) -> None:
+        """
+        Queue digest for file. Written to disk on flush.
+        :param st: stat result of file at time of hashing
+        :param digest: content digest
+        :return: None
+        """
+        with self.__lock:
+            self.__pending.append((*self.__key(st), digest))
+
+    def flush(self) -> None:
+        """
+        Commit queued digests to disk.
+        :return: None
+        """
+        with self.__lock:
+            if not self.__pending:
+                return
+            connection = self.__connect()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", self.__pending)
+            self.__pending = []
@@ -0,0 +1,192 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from os import lstat, scandir, stat_result
+from os.path import basename, join, relpath
+from stat import S_ISDIR, S_ISREG
+from typing import NamedTuple, Optional
+
+from src.file_diff.content_comparator import ContentComparator
+from src.file_diff.hash_cache import HashCache
+from src.file_diff.path_filter import PathFilter
+from src.metrics.run_metrics import MetricCounter, MetricPhase, RunMetrics
+
+# hashing is mostly waiting on disk, same as copying
+DEFAULT_HASH_WORKERS = 4
+
+# empty files all look alike and cost nothing to create, so they are never paired
+MIN_MOVE_SIZE = 1
+
+
+class TreeFile(NamedTuple):
+    """
+    Regular file found below a source-only or destination-only entry. rel is relative to that entry, or empty if the
+    entry is the file itself.
+    """
+    top: str
+    rel: str
+    path: str
+    st: stat_result
+
+
+class MoveDetector(object):
+    """
+    This class pairs entries that only exist in the source with destination-only entries of the same content, so a
+    reorganized tree can be synced by renaming within the destination instead of copying everything again.
+    Files are paired by inode first, which needs no hashing when both sides are hard links to the same file, and
+    then by size and content hash. A source-only directory whose files all pair up with the identically laid out
+    files of one destination-only directory is paired as a whole. Entries rejected by the path filter are ignored.
+    """
+    def __init__(self, hash_cache: Optional[HashCache] = None, metrics: Optional[RunMetrics] = None,
+                 max_workers: int = DEFAULT_HASH_WORKERS, min_size: int = MIN_MOVE_SIZE,
+                 path_filter: Optional[PathFilter] = None) -> None:
+        self.__metrics = metrics if metrics is not None else RunMetrics("moves")
+        self.__content_comparator = ContentComparator(hash_cache, self.__metrics)
+        self.__max_workers = max(1, max_workers)
+        self.__min_size = min_size
+        self.__path_filter = path_filter if path_filter else None
+
+    def detect(self, src: str, dst: str, left_only: list, right_only: list) -> dict:
+        """
+        Find source-only entries whose content already exists in the destination under another path.
+        :param src: source folder
+        :param dst: destination folder
+        :param left_only: source-only paths, files or directories
+        :param right_only: destination-only paths, files or directories
+        :return: dictionary of source path -> destination path holding the same content; keys are entries of
+            left_only, or files below them if their directory doesn't pair up as a whole
+        """
+        left_files, left_layouts = self.__expand(src, left_only)
+        right_files, right_layouts = self.__expand(dst, right_only)
+        matches = self.__match_inodes(left_files, right_files)
+        matches.update(self.__match_contents([f for f in left_files if f.path not in matches],
+                                             right_files, {f.path for f in matches.values()}))
+        self.__content_comparator.flush()
+
+        by_top = defaultdict(list)
+        for f in left_files:
+            by_top[f.top].append(f)
+
+        moves = {}
+        for top, files in by_top.items():
+            targets = {matches[f.path].top for f in files if f.path in matches}
+            if len(targets) == 1 and left_layouts.get(top) is not None and \
+                    all(f.path in matches and matches[f.path].rel == f.rel for f in files):
+                target = targets.pop()
+                if left_layouts[top] == right_layouts.get(target):
+                    moves[top] = target
+                    continue
+            moves.update((f.path, matches[f.path].path) for f in files if f.path in matches)
+
+        if moves:
+            print(f"Detected {len(moves)} moved entries covering {len(matches)} files")
+        return moves
+
+    def __expand(self, root: str, tops: list) -> tuple:
+        """
+        List regular files below each entry.
+        :param root: folder the entries are in
+        :param tops: files or directories
+        :return: list of TreeFile, and per directory its layout (file count and relative subdirectories), or None
+            if it contains anything other than files and directories, or couldn't be listed completely
+        """
+        files, layouts = [], {}
+        for top in tops:
+            try:
+                st = lstat(top)
+            except OSError:
+                continue
+            self.__metrics.count(MetricCounter.STAT_CALLS)
+            if S_ISREG(st.st_mode):
+                files.append(TreeFile(top, "", top, st))
+                continue
+            if not S_ISDIR(st.st_mode):
+                continue
+
+            dirs, count, pending = set(), 0, [""]
+            layout_complete = True
+            while pending:
+                rel_dir = pending.pop()
+                self.__metrics.count(MetricCounter.DIRS_LISTED)
+                try:
+                    with scandir(join(top, rel_dir)) as it:
+                        for entry in it:
+                            rel = join(rel_dir, entry.name)
+                            st = entry.stat(follow_symlinks=False)
+                            self.__metrics.count(MetricCounter.STAT_CALLS)
+                            if self.__path_filter is not None and \
+                                    not self.__path_filter.accepts(relpath(entry.path, root), S_ISDIR(st.st_mode)):
+                                continue
+                            if S_ISDIR(st.st_mode):
+                                dirs.add(rel)
+                                pending.append(rel)
+                            elif S_ISREG(st.st_mode):
+                                files.append(TreeFile(top, rel, entry.path, st))
+                                count += 1
+                            else:
+                                layout_complete = False  # symlinks etc. can't be verified by content
+                except OSError as e:
+                    print(f"Unable to list {join(top, rel_dir)} for move detection: {e}")
+                    layout_complete = False
+            layouts[top] = (count, frozenset(dirs)) if layout_complete else None
+        return files, layouts
+
+    def __match_inodes(self, left_files: list, right_files: list) -> dict:
+        """
+        Pair files that are the same inode on the same device, e.g. hard-linked snapshots.
+        :param left_files: source-only files
+        :param right_files: destination-only files
+        :return: dictionary of source path -> destination TreeFile
+        """
+        by_inode = {(f.st.st_dev, f.st.st_ino): f for f in right_files}
+        matches = {}
+        for f in left_files:
+            other = by_inode.pop((f.st.st_dev, f.st.st_ino), None)
+            if other is not None:
+                matches[f.path] = other
+        return matches
+
+    def __match_contents(self, left_files: list, right_files: list, used: set) -> dict:
+        """
+        Pair files by size, then content hash. Only files whose size occurs on both sides are hashed.
+        :param left_files: unpaired source-only files
+        :param right_files: destination-only files
+        :param used: paths of destination files that are already paired
+        :return: dictionary of source path -> destination TreeFile
+        """
+        right_by_size = defaultdict(list)
+        for f in right_files:
+            if f.path not in used and f.st.st_size >= self.__min_size:
+                right_by_size[f.st.st_size].append(f)
+        left_files = [f for f in left_files if f.st.st_size in right_by_size]
+        candidates = [f for size in {f.st.st_size for f in left_files} for f in right_by_size[size]]
+
+        with self.__metrics.phase(MetricPhase.COMPARE), ThreadPoolExecutor(self.__max_workers) as executor:
+            digests = dict(executor.map(self.__digest, left_files + candidates))
+
+        right_by_digest = defaultdict(list)
+        for f in candidates:
+            if digests[f.path] is not None:
+                right_by_digest[f.st.st_size, digests[f.path]].append(f)
+
+        matches = {}
+        for f in left_files:
+            group = right_by_digest.get((f.st.st_size, digests[f.path]))
+            if not group:
+                continue
+            # among duplicates, prefer the one at the same place, so whole directories still pair up
+            best = min(group, key=lambda other: (other.rel != f.rel, basename(other.path) != basename(f.path)))
+            group.remove(best)
+            matches[f.path] = best
+        return matches
+
+    def __digest(self, f: TreeFile) -> tuple:
+        """
+        Hash file contents. Runs on a worker thread.
+        :param f: file to hash
+        :return: path and digest, or None as digest if the file can't be read
+        """
+        try:
+            return f.path, self.__content_comparator.digest(f.path, f.st)
+        except OSError as e:
+            print(f"Unable to hash {f.path} for move detection: {e}")
+            return f.path, None
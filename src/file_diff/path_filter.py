@@ -0,0 +1,135 @@
+from os import sep
+from os.path import dirname, normcase
+from typing import Iterable
+import re
+
+# match case-insensitively where the filesystem does, same as TreeWalker's name comparison
+PATTERN_FLAGS = re.IGNORECASE if normcase("A") == "a" else 0
+
+
+class PathFilter(object):
+    """
+    This class decides which entries of a configuration take part in evaluation and sync.
+    Exclude rules use gitignore syntax: "*" and "?" stay within a path component, "**" spans components, a trailing
+    "/" only matches directories, a pattern containing "/" is anchored at the folder root, "!" re-includes, and later
+    rules override earlier ones. Include rules use the same glob syntax; if any are given, only files matching one of
+    them are kept. Directories are always walked unless excluded, and excluded directories are never listed.
+    All rules are compiled into one regular expression per entry type, so each entry is checked with a single match.
+    """
+    def __init__(self, include: Iterable[str] = (), exclude: Iterable[str] = ()) -> None:
+        exclude_rules = [rule for rule in map(self.__translate, exclude) if rule is not None]
+        include_rules = [rule for rule in map(self.__translate, include) if rule is not None]
+        self.__file_excludes = self.__compile(exclude_rules, directories=False)
+        self.__dir_excludes = self.__compile(exclude_rules, directories=True)
+        self.__includes = re.compile("|".join(f"(?:{regex})" for regex, _, _ in include_rules), PATTERN_FLAGS) \
+            if include_rules else None
+
+    def __bool__(self) -> bool:
+        return bool(self.__file_excludes or self.__dir_excludes or self.__includes)
+
+    @classmethod
+    def from_configuration(cls, metadata: dict) -> "PathFilter":
+        """
+        Create filter from the rules saved with a configuration.
+        :param metadata: configuration (src, dst, sync, and optionally include/exclude lists)
+        :return: PathFilter
+        """
+        return cls(metadata.get("include", []), metadata.get("exclude", []))
+
+    def accepts(self, rel_path: str, is_dir: bool) -> bool:
+        """
+        Check single entry, assuming its parent directory was accepted. Used while walking a tree top-down.
+        :param rel_path: path relative to the configuration's folder
+        :param is_dir: whether the entry is a directory
+        :return: True if the entry is evaluated and synced
+        """
+        if sep != "/":
+            rel_path = rel_path.replace(sep, "/")
+        excludes = self.__dir_excludes if is_dir else self.__file_excludes
+        if excludes is not None:
+            match = excludes.fullmatch(rel_path)
+            if match is not None and match.lastgroup[0] == "x":
+                return False
+        return is_dir or self.__includes is None or self.__includes.fullmatch(rel_path) is not None
+
+    def accepts_path(self, rel_path: str, is_dir: bool) -> bool:
+        """
+        Check entry and all of its parent directories, e.g. for paths reported by a file watcher.
+        :param rel_path: path relative to the configuration's folder
+        :param is_dir: whether the entry is a directory
+        :return: True if the entry is evaluated and synced
+        """
+        parent = dirname(rel_path)
+        while parent:
+            if not self.accepts(parent, True):
+                return False
+            parent = dirname(parent)
+        return self.accepts(rel_path, is_dir)
+
+    @staticmethod
+    def __compile(rules: list, directories: bool):
+        """
+        Combine exclude rules into one alternation. Later rules come first, so the alternative that matches is the
+        last matching rule, and its group name tells whether it excludes (x) or re-includes (n).
+        :param rules: translated rules in file order
+        :param directories: whether to compile for directories, which also match directory-only rules
+        :return: compiled pattern, or None if no rule applies
+        """
+        alternatives = [f"(?P<{'n' if negated else 'x'}{index}>{regex})"
+                        for index, (regex, negated, dir_only) in reversed(list(enumerate(rules)))
+                        if directories or not dir_only]
+        return re.compile("|".join(alternatives), PATTERN_FLAGS) if alternatives else None
+
+    @staticmethod
+    def __translate(pattern: str):
+        """
+        Translate gitignore-style pattern to a regular expression without capturing groups.
+        :param pattern: rule as written by the user
+        :return: regex, whether the rule is negated, and whether it only matches directories; None for blank lines
+            and comments
+        """
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith("#"):
+            return None
+        negated = pattern.startswith("!")
+        if negated:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+
+        parts, i = [], 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                parts.append("(?:.*/)?")
+                i += 3
+            elif pattern.startswith("**", i):
+                parts.append(".*")
+                i += 2
+            elif pattern[i] == "*":
+                parts.append("[^/]*")
+                i += 1
+            elif pattern[i] == "?":
+                parts.append("[^/]")
+                i += 1
+            elif pattern[i] == "[":
+                negated_set = pattern.startswith("[!", i)
+                start = i + 2 if negated_set else i + 1
+                end = pattern.find("]", start + 1)  # "]" right after "[" or "[!" is part of the set
+                if end == -1:
+                    parts.append(re.escape("["))
+                    i += 1
+                    continue
+                content = pattern[start:end].replace("\\", "\\\\").replace("[", "\\[")
+                parts.append(("[^" if negated_set else "[") + content + "]")
+                i = end + 1
+            elif pattern[i] == "\\" and i + 1 < len(pattern):
+                parts.append(re.escape(pattern[i + 1]))
+                i += 2
+            else:
+                parts.append(re.escape(pattern[i]))
+                i += 1
+
+        regex = "".join(parts)
+        return (regex if anchored else "(?:.*/)?" + regex), negated, dir_only
@@ -0,0 +1,147 @@
+from os import makedirs, replace, stat
+from os.path import exists, join
+from time import time_ns
+from typing import Optional
+from urllib.parse import quote
+import json
+
+from src.settings.constants import LOCKSTEP_FOLDER
+
+MANIFEST_FOLDER = join(LOCKSTEP_FOLDER, "manifests")
+
+# directories modified this close to the scan may change again within the same mtime tick, so they aren't cached
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+DIRECTORY, FILE, OTHER = "d", "f", "o"
+
+
+class ManifestEntry(object):
+    """
+    Stand-in for os.DirEntry when a directory listing is served from the manifest.
+    """
+    __slots__ = ["name", "path", "__kind", "__stat"]
+
+    def __init__(self, name: str, path: str, kind: str) -> None:
+        self.name = name
+        self.path = path
+        self.__kind = kind
+        self.__stat = None
+
+    def is_dir(self) -> bool:
+        """
+        Whether entry was a directory (or link to one) when listed.
+        :return: boolean
+        """
+        return self.__kind == DIRECTORY
+
+    def is_file(self) -> bool:
+        """
+        Whether entry was a regular file (or link to one) when listed.
+        :return: boolean
+        """
+        return self.__kind == FILE
+
+    def stat(self):
+        """
+        Stat the file on first use. File contents can change without touching the parent directory's mtime.
+        :return: stat result
+        """
+        if self.__stat is None:
+            self.__stat = stat(self.path)
+        return self.__stat
+
+
+class ScanManifest(object):
+    """
+    This class persists directory listings from the last evaluation of a saved configuration.
+    A directory whose own mtime hasn't changed since it was listed can reuse its cached listing.
+    """
+    def __init__(self, configuration: str, folder: str = MANIFEST_FOLDER) -> None:
+        self.__folder = folder
+        self.__filename = join(folder, f"{quote(configuration, safe='')}.json")
+        self.__previous = {}  # path -> (mtime_ns, kinds, names) from last scan
+        self.__current = {}  # listings recorded during this scan
+        self.__roots = None
+        self.__scan_start_ns = 0
+
+    def load(self, src: str, dst: str) -> None:
+        """
+        Read manifest from file, if it belongs to the same source and destination folders.
+        :param src: source folder
+        :param dst: destination folder
+        :return: None
+        """
+        self.__roots = [src, dst]
+        self.__current = {}
+        self.__scan_start_ns = time_ns()
+
+        if exists(self.__filename):
+            with open(self.__filename, "r") as mf:
+                data = json.load(mf)
+            if data["roots"] == self.__roots:
+                self.__previous = data["directories"]
+
+        print(f"Loaded scan manifest with {len(self.__previous)} directories: {self.__filename}")
+
+    def list_directory(self, path: str, scanner) -> list:
+        """
+        Get listing of directory, from the manifest if the directory is unchanged, otherwise from scanner.
+        Safe to call from multiple threads.
+        :param path: directory path
+        :param scanner: function that lists the directory, returning DirEntry-like objects
+        :return: list of DirEntry-like objects
+        """
+        mtime_ns = stat(path).st_mtime_ns
+        cached = self.__lookup(path, mtime_ns)
+        if cached is not None:
+            return cached
+
+        entries = scanner(path)
+        if mtime_ns < self.__scan_start_ns - RACY_WINDOW_NS:
+            kinds = "".join(self.__kind(entry) for entry in entries)
+            self.__current[path] = [mtime_ns, kinds, [entry.name for entry in entries]]
+        return entries
+
+    def save(self) -> None:
+        """
+        Write listings recorded during this scan to file. Directories not visited this time are dropped.
+        :return: None
+        """
+        makedirs(self.__folder, exist_ok=True)
+        temp_filename = f"{self.__filename}.tmp"
+        with open(temp_filename, "w") as mf:
+            json.dump({"roots": self.__roots, "directories": self.__current}, mf, separators=(",", ":"))
+        replace(temp_filename, self.__filename)
+
+        self.__previous = self.__current
+
+    def __lookup(self, path: str, mtime_ns: int) -> Optional[list]:
+        """
+        Rebuild cached listing if it is still valid.
+        :param path: directory path
+        :param mtime_ns: current mtime of directory
+        :return: list of manifest entries, or None on cache miss
+        """
+        record = self.__previous.get(path)
+        if record is None or record[0] != mtime_ns:
+            return None
+
+        self.__current[path] = record
+        _, kinds, names = record
+        return [ManifestEntry(name, join(path, name), kind) for name, kind in zip(names, kinds)]
+
+    @staticmethod
+    def __kind(entry) -> str:
+        """
+        Classify directory entry the same way the walker does (following symlinks).
+        :param entry: DirEntry
+        :return: kind code
+        """
+        try:
+            if entry.is_dir():
+                return DIRECTORY
+            if entry.is_file():
+                return FILE
+        except OSError:
+            pass
+        return OTHER
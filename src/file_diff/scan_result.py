@@ -0,0 +1,152 @@
+from array import array
+from os import sep
+from os.path import join
+from sys import intern
+from typing import Iterator, Optional
+
+# entry kinds, stored as one byte per entry
+FILE, DIRECTORY, OTHER = 0, 1, 2
+
+
+class DirectoryTable(object):
+    """
+    This class interns the directories visited by a scan. Each directory is stored once, as the index of its parent
+    and its name, so entries only need to refer to their directory by index. Index 0 is the directory the scan
+    started from. Directories are relative to the compared folders, so one table serves both sides of a diff.
+    """
+    def __init__(self, rel_root: str = "") -> None:
+        self.__parents = array("l", [-1])
+        self.__names = [rel_root]
+        self.__rel_paths = [rel_root]  # kept, since every directory is joined once anyway to list it
+        self.__root_parts = tuple(part for part in rel_root.split(sep) if part)
+
+    def __len__(self) -> int:
+        return len(self.__names)
+
+    def add(self, parent: int, name: str) -> int:
+        """
+        Intern subdirectory.
+        :param parent: index of parent directory
+        :param name: name of subdirectory
+        :return: index of subdirectory
+        """
+        self.__parents.append(parent)
+        self.__names.append(intern(name))
+        self.__rel_paths.append(join(self.__rel_paths[parent], name))
+        return len(self.__names) - 1
+
+    def rel_path(self, index: int) -> str:
+        """
+        Path of directory relative to the compared folders.
+        :param index: directory index
+        :return: relative path, empty for the folders themselves
+        """
+        return self.__rel_paths[index]
+
+    def parts(self, index: int) -> tuple:
+        """
+        Path components of directory, found by following parent indices.
+        :param index: directory index
+        :return: tuple of names from the folder down to the directory
+        """
+        names = []
+        while index > 0:
+            names.append(self.__names[index])
+            index = self.__parents[index]
+        return self.__root_parts + tuple(reversed(names))
+
+
+class ScanResult(object):
+    """
+    This class holds the entries a scan found on one side of a diff, column by column: parent directory index,
+    interned base name, kind, size and mtime are kept in compact arrays instead of one full path string per entry.
+    Full paths are only built when asked for; iterating yields them, so it can stand in for a list of paths.
+    """
+    def __init__(self, root: str, directories: Optional[DirectoryTable] = None) -> None:
+        self.root = root
+        self.directories = directories if directories is not None else DirectoryTable()
+        self.parents = array("l")
+        self.names = []
+        self.kinds = bytearray()
+        self.sizes = array("q")
+        self.mtimes = array("q")
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[str]:
+        return (join(self.root, rel_path) for rel_path in self.rel_paths())
+
+    def append(self, parent: int, name: str, kind: int, size: int, mtime_ns: int) -> None:
+        """
+        Add entry.
+        :param parent: index of the entry's directory
+        :param name: base name
+        :param kind: FILE, DIRECTORY or OTHER
+        :param size: size in bytes, 0 for directories
+        :param mtime_ns: modification time
+        :return: None
+        """
+        self.parents.append(parent)
+        self.names.append(intern(name))
+        self.kinds.append(kind)
+        self.sizes.append(size)
+        self.mtimes.append(mtime_ns)
+
+    def extend(self, other: "ScanResult") -> None:
+        """
+        Add all entries of another result from the same scan.
+        :param other: result sharing this result's directory table
+        :return: None
+        """
+        if other.directories is not self.directories:
+            raise ValueError("Scan results of different scans can't be combined")
+        self.parents.extend(other.parents)
+        self.names.extend(other.names)
+        self.kinds.extend(other.kinds)
+        self.sizes.extend(other.sizes)
+        self.mtimes.extend(other.mtimes)
+
+    def rel_path(self, index: int) -> str:
+        """
+        Path of entry relative to the compared folders.
+        :param index: entry index
+        :return: relative path
+        """
+        return join(self.directories.rel_path(self.parents[index]), self.names[index])
+
+    def path(self, index: int) -> str:
+        """
+        Full path of entry.
+        :param index: entry index
+        :return: path below root
+        """
+        return join(self.root, self.rel_path(index))
+
+    def rel_paths(self) -> Iterator[str]:
+        """
+        Relative paths of all entries.
+        :return: iterator of relative paths
+        """
+        rel_dir = self.directories.rel_path
+        return (join(rel_dir(parent), name) for parent, name in zip(self.parents, self.names))
+
+    def iter_entries(self) -> Iterator[tuple]:
+        """
+        All entries with their metadata.
+        :return: iterator of (relative path, kind, size, mtime_ns)
+        """
+        return zip(self.rel_paths(), self.kinds, self.sizes, self.mtimes)
+
+    def iter_parts(self, prefix: tuple = ()) -> Iterator[tuple]:
+        """
+        All entries split into components, e.g. for building a tree. Entries arrive grouped by directory, so the
+        components of a directory are only looked up once per group and the same tuple is yielded for all of it.
+        :param prefix: components to put in front of every directory, e.g. those of the root
+        :return: iterator of (directory components, name, kind, size)
+        """
+        last_parent, folders = None, prefix
+        for parent, name, kind, size in zip(self.parents, self.names, self.kinds, self.sizes):
+            if parent != last_parent:
+                last_parent, folders = parent, prefix + self.directories.parts(parent)
+            yield folders, name, kind, size
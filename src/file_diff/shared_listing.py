@@ -0,0 +1,52 @@
+from os.path import join
+from threading import Event, Lock
+from typing import Callable
+
+
+class SharedListing(object):
+    """
+    This class lets several scans of the same source folder share its directory listings, e.g. the plans for each
+    destination of a fan-out sync. The first scan to reach a directory lists it; scans arriving while it is being
+    listed wait for that listing instead of reading the directory again. A listing is dropped once every scan has
+    used it; listings only some scans need are kept until the SharedListing itself is discarded.
+    Directories outside the source folder are listed directly. Passed to TreeWalker in place of a ScanManifest.
+    """
+    def __init__(self, root: str, users: int) -> None:
+        self.__prefix = join(root, "")
+        self.__users = max(1, users)
+        self.__slots = {}  # path -> [listed event, entries, error, remaining uses]
+        self.__lock = Lock()
+
+    def list_directory(self, path: str, scanner: Callable) -> list:
+        """
+        List directory, or reuse the listing another scan made of it.
+        :param path: directory to list
+        :param scanner: lists a directory from disk, path -> list of DirEntry
+        :return: list of DirEntry
+        """
+        if not join(path, "").startswith(self.__prefix):
+            return scanner(path)
+
+        with self.__lock:
+            slot = self.__slots.get(path)
+            owner = slot is None
+            if owner:
+                slot = self.__slots[path] = [Event(), None, None, self.__users]
+            slot[3] -= 1
+            if slot[3] <= 0:
+                del self.__slots[path]
+
+        listed, _, _, _ = slot
+        if owner:
+            try:
+                slot[1] = scanner(path)
+            except OSError as e:
+                slot[2] = e
+            finally:
+                listed.set()
+        else:
+            listed.wait()
+
+        if slot[2] is not None:
+            raise slot[2]
+        return slot[1]
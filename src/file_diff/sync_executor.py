@@ -0,0 +1,323 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from os import makedirs, mkdir, remove, scandir
+from os.path import dirname, getsize, isdir, islink, lexists
+from shutil import copystat, move, rmtree
+from threading import Event
+from typing import Optional
+
+from src.file_diff.copy_backend import CopyBackend, CopyCancelled, CopyMethod
+from src.file_diff.delta_transfer import DeltaTransfer
+from src.file_diff.sync_journal import SyncJournal
+from src.file_diff.sync_plan import SyncAction, SyncOperation, SyncPlan
+from src.file_diff.throttle import Throttle, lower_priority
+from src.metrics.run_metrics import MetricCounter, MetricPhase, RunMetrics
+from src.settings.constants import COPY_CHUNK_SIZE, DEFAULT_COPY_WORKERS, DEFAULT_DELTA_THRESHOLD, \
+    DEFAULT_SMALL_FILE_WORKERS
+
+# in small-file mode, files below this size are copied on a pool of their own
+SMALL_FILE_THRESHOLD = 256 * 1024
+
+
+class SyncExecutor(object):
+    """
+    This class carries out a sync plan: directory creation, then moves within the destination, then deletes, then
+    file copies on a pool of workers, then links to copies of identical content. Moves run before deletes, as they
+    may take entries out of purged directories.
+    Overwrites of files at least delta_threshold bytes in size only rewrite the blocks that changed.
+    Several plans from the same source can run together, one per destination: a file that needs copying to more
+    than one destination is read once and written to all of them.
+    Files are written to a temporary name and renamed into place, so a cancelled or crashed sync never leaves a
+    partially written file behind. Once the cancel event is set, copies stop between chunks and remaining
+    operations are skipped; completed operations are recorded in the journal, if given, so the job can resume.
+    A throttle limits both the operations started and the bytes copied per second; with low_priority, the workers
+    run at idle I/O priority and raised niceness.
+    In small-file mode, small files are copied in source inode order on a large pool of their own, with their
+    metadata applied through open descriptors, while large files go through the regular workers at the same time.
+    """
+    def __init__(self, max_workers: int = DEFAULT_COPY_WORKERS, delta_threshold: int = DEFAULT_DELTA_THRESHOLD,
+                 metrics: Optional[RunMetrics] = None, cancel_event: Optional[Event] = None,
+                 journal: Optional[SyncJournal] = None, buffer_size: int = COPY_CHUNK_SIZE,
+                 throttle: Optional[Throttle] = None, low_priority: bool = False, small_file_mode: bool = False,
+                 small_file_workers: int = DEFAULT_SMALL_FILE_WORKERS) -> None:
+        self.__max_workers = max(1, max_workers)
+        self.__delta_threshold = delta_threshold
+        self.__copy_backend = CopyBackend(buffer_size, throttle)
+        self.__throttle = throttle
+        self.__low_priority = low_priority
+        self.__small_file_mode = small_file_mode
+        self.__small_file_workers = max(1, small_file_workers)
+        self.__metrics = metrics if metrics is not None else RunMetrics("sync")  # progress counts operations
+        self.__cancel_event = cancel_event if cancel_event is not None else Event()
+        self.__journal = journal
+
+    def execute(self, plan: SyncPlan) -> dict:
+        """
+        Run every operation in the plan. Failed operations are reported and skipped.
+        :param plan: sync plan
+        :return: count of completed operations per action, plus errors and operations skipped by cancellation
+        """
+        return self.execute_many([plan], [self.__journal])[0]
+
+    def execute_many(self, plans: list, journals: Optional[list] = None) -> list:
+        """
+        Run several plans together, phase by phase. Copies of the same source file are grouped across plans.
+        :param plans: sync plans, typically from one source to different destinations
+        :param journals: journal per plan (or None), in the same order
+        :return: per plan, count of completed operations per action, plus errors and cancelled operations
+        """
+        journals = journals if journals is not None else [None] * len(plans)
+        results = [Counter() for _ in plans]
+        mkdirs = sorted(self.__tag(plans, SyncAction.MKDIR), key=lambda item: item[0].dst)  # parents first
+        self.__metrics.add_total(sum(map(len, plans)))
+
+        with ThreadPoolExecutor(max_workers=self.__max_workers,
+                                initializer=lower_priority if self.__low_priority else None) as executor:
+            with self.__metrics.phase(MetricPhase.COPY):
+                self.__run_phase(None, [[item] for item in mkdirs], journals, results)
+
+            with self.__metrics.phase(MetricPhase.MOVE):
+                self.__run_phase(None, [[item] for item in self.__tag(plans, SyncAction.MOVE)], journals, results)
+
+            with self.__metrics.phase(MetricPhase.DELETE):
+                self.__run_phase(executor, [[item] for item in self.__tag(plans, SyncAction.DELETE)], journals,
+                                 results)
+
+            with self.__metrics.phase(MetricPhase.COPY):
+                copies = self.__group_copies(self.__tag(plans, SyncAction.COPY, SyncAction.OVERWRITE))
+                if self.__small_file_mode:
+                    self.__run_copies_by_size(executor, copies, journals, results)
+                else:
+                    self.__run_phase(executor, copies, journals, results)
+                # a link needs the copy it points to, so links only start once every copy is done
+                self.__run_phase(executor, [[item] for item in self.__tag(plans, SyncAction.LINK)], journals,
+                                 results)
+
+        # copying into new directories bumps their mtime, so restore it afterwards, deepest first
+        for op, _ in reversed(mkdirs):
+            try:
+                copystat(op.src, op.dst)
+            except OSError as e:
+                print(f"Unable to copy directory metadata to {op.dst}: {e}")
+
+        state = "cancelled" if self.__cancel_event.is_set() else "complete"
+        for plan, counts in zip(plans, results):
+            print(f"Sync {state}: {dict(counts)}" if len(plans) == 1 else
+                  f"Sync to {plan.dst} {state}: {dict(counts)}")
+        return [dict(counts) for counts in results]
+
+    @staticmethod
+    def __tag(plans: list, *actions: str) -> list:
+        """
+        Collect operations of the given actions from all plans, tagged with the index of their plan.
+        :param plans: sync plans
+        :param actions: SyncAction values
+        :return: list of (operation, plan index)
+        """
+        return [(op, i) for i, plan in enumerate(plans) for op in plan.of_action(*actions)]
+
+    def __run_phase(self, executor: Optional[ThreadPoolExecutor], groups: list, journals: list,
+                    results: list) -> None:
+        """
+        Perform groups of operations and count their outcomes.
+        :param executor: worker pool, or None to run the groups one after another on this thread
+        :param groups: lists of (operation, plan index)
+        :param journals: journal per plan (or None)
+        :param results: counts per action, per plan
+        :return: None
+        """
+        if executor is None:
+            outcomes = (self.__run_group(group, journals) for group in groups)
+        else:
+            outcomes = executor.map(self.__run_group, groups, [journals] * len(groups))
+        self.__record_groups(outcomes, results)
+
+    def __run_copies_by_size(self, executor: ThreadPoolExecutor, groups: list, journals: list,
+                             results: list) -> None:
+        """
+        Copy small files in source inode order on a pool of their own, while large files are copied on the regular
+        workers at the same time, so neither kind holds up the other.
+        :param executor: regular worker pool, for large files
+        :param groups: lists of (operation, plan index) of copies and overwrites
+        :param journals: journal per plan (or None)
+        :param results: counts per action, per plan
+        :return: None
+        """
+        small = [group for group in groups if group[0][0].size < SMALL_FILE_THRESHOLD]
+        large = [group for group in groups if group[0][0].size >= SMALL_FILE_THRESHOLD]
+        with ThreadPoolExecutor(max_workers=self.__small_file_workers,
+                                initializer=lower_priority if self.__low_priority else None) as small_executor:
+            small = self.__order_by_inode(small)
+            outcomes = [executor.map(self.__run_group, large, [journals] * len(large)),
+                        small_executor.map(self.__run_group, small, [journals] * len(small))]
+            self.__record_groups(chain(*outcomes), results)
+
+    def __order_by_inode(self, groups: list) -> list:
+        """
+        Sort copies by source inode, which roughly follows where files are stored, so the disk reads them with less
+        seeking than in listing order. Inodes come from one listing per source directory rather than a stat per file.
+        :param groups: lists of (operation, plan index) with the same source file
+        :return: sorted groups; files that disappeared meanwhile go first, and fail when copied
+        """
+        inodes = {}
+        for folder in {dirname(group[0][0].src) for group in groups}:
+            self.__metrics.count(MetricCounter.DIRS_LISTED)
+            try:
+                with scandir(folder) as it:
+                    inodes.update((entry.path, entry.inode()) for entry in it)
+            except OSError:
+                pass  # the copies report the error
+        return sorted(groups, key=lambda group: inodes.get(group[0][0].src, 0))
+
+    def __record_groups(self, outcomes, results: list) -> None:
+        """
+        Count outcomes of groups of operations as they finish.
+        :param outcomes: iterable of lists of (plan index, whether the operation succeeded, action)
+        :param results: counts per action, per plan
+        :return: None
+        """
+        for group_outcomes in outcomes:
+            for i, ok, action in group_outcomes:
+                self.__record(results[i], ok, action)
+
+    def __group_copies(self, copies: list) -> list:
+        """
+        Group copies that read the same source file, so it is read once for all of them. Delta transfers read
+        their destination as well, so they stay on their own.
+        :param copies: (operation, plan index) of copies and overwrites
+        :return: list of groups
+        """
+        groups, by_source = [], {}
+        for op, i in copies:
+            if op.action == SyncAction.OVERWRITE and op.size >= self.__delta_threshold:
+                groups.append([(op, i)])
+            elif op.src in by_source:
+                by_source[op.src].append((op, i))
+            else:
+                by_source[op.src] = [(op, i)]
+                groups.append(by_source[op.src])
+        return groups
+
+    def __record(self, results: Counter, ok: bool, action: str) -> None:
+        """
+        Count finished operation and report progress.
+        :param results: counts per action
+        :param ok: whether the operation succeeded, None if it was skipped because the sync was cancelled
+        :param action: SyncAction of the operation
+        :return: None
+        """
+        if ok is None:
+            results["cancelled"] += 1
+        else:
+            results[action if ok else "errors"] += 1
+        self.__metrics.advance()
+
+    def __run_group(self, group: list, journals: list) -> list:
+        """
+        Perform a group of operations. Runs on a worker thread.
+        :param group: (operation, plan index); more than one only for copies of the same source file
+        :param journals: journal per plan (or None)
+        :return: (plan index, whether the operation succeeded (None if cancelled), action) per operation
+        """
+        if self.__throttle is not None:
+            self.__throttle.operation(self.__cancel_event, len(group))
+        if len(group) == 1:
+            oks = [self.__run(group[0][0])]
+        else:
+            oks = self.__copy_many([op for op, _ in group])
+
+        for (op, i), ok in zip(group, oks):
+            if ok and journals[i] is not None:
+                try:
+                    journals[i].record(op)
+                except OSError as e:
+                    # the operation itself succeeded; a resume just redoes it
+                    print(f"Unable to journal {op.action.lower()} of {op.dst}: {e}")
+        return [(i, ok, op.action) for (op, i), ok in zip(group, oks)]
+
+    def __copy_many(self, ops: list) -> list:
+        """
+        Copy one source file to the destinations of several operations, reading it once.
+        :param ops: copies and overwrites with the same source
+        :return: per operation, whether it succeeded (None if cancelled)
+        """
+        if self.__cancel_event.is_set():
+            return [None] * len(ops)
+        try:
+            errors = self.__copy_backend.copy_many(ops[0].src, [op.dst for op in ops], self.__cancel_event)
+        except CopyCancelled:
+            return [None] * len(ops)
+        except OSError as e:
+            errors = [e] * len(ops)  # the source itself couldn't be read
+
+        oks = []
+        for op, error in zip(ops, errors):
+            if error is None:
+                self.__metrics.count(MetricCounter.BYTES_COPIED, op.size)
+            else:
+                print(f"Unable to {op.action.lower()} {op.dst}: {error}")
+                self.__metrics.count(MetricCounter.ERRORS)
+            oks.append(error is None)
+        return oks
+
+    def __run(self, op: SyncOperation) -> Optional[bool]:
+        """
+        Perform single operation.
+        :param op: sync operation
+        :return: whether the operation succeeded, None if cancelled
+        """
+        if self.__cancel_event.is_set():
+            return None
+        try:
+            if op.action == SyncAction.DELETE:
+                if isdir(op.dst) and not islink(op.dst):
+                    rmtree(op.dst)
+                else:
+                    remove(op.dst)
+            elif op.action == SyncAction.MKDIR:
+                self.__make_directory(op.dst)
+            elif op.action == SyncAction.MOVE:
+                if lexists(op.dst):
+                    raise FileExistsError(f"{op.dst} already exists")
+                move(op.src, op.dst)  # a rename, unless the destination spans filesystems
+            elif op.action == SyncAction.LINK:
+                method = self.__copy_backend.link(op.src, op.dst, self.__cancel_event, op.origin)
+                if method not in (CopyMethod.REFLINK, CopyMethod.HARDLINK):
+                    self.__metrics.count(MetricCounter.BYTES_COPIED, getsize(op.dst))
+            elif op.action == SyncAction.OVERWRITE and op.size >= self.__delta_threshold:
+                delta = DeltaTransfer(copy_backend=self.__copy_backend, throttle=self.__throttle,
+                                      cancel_event=self.__cancel_event)
+                written = delta.transfer(op.src, op.dst)
+                self.__metrics.count(MetricCounter.BYTES_COPIED, written)
+            elif self.__small_file_mode and op.size < SMALL_FILE_THRESHOLD:
+                self.__copy_backend.copy_small(op.src, op.dst, self.__cancel_event)
+                self.__metrics.count(MetricCounter.BYTES_COPIED, op.size)
+            else:
+                self.__copy_backend.copy(op.src, op.dst, self.__cancel_event)
+                self.__metrics.count(MetricCounter.BYTES_COPIED, op.size)
+        except CopyCancelled:
+            return None
+        except OSError as e:
+            print(f"Unable to {op.action.lower()} {op.dst}: {e}")
+            self.__metrics.count(MetricCounter.ERRORS)
+            return False
+        return True
+
+    def __make_directory(self, path: str) -> None:
+        """
+        Create a directory of the destination skeleton. Directories are created parents first, so in small-file mode
+        a single mkdir is tried before makedirs, which checks every parent on the way.
+        :param path: directory to create
+        :return: None
+        """
+        if not self.__small_file_mode:
+            makedirs(path, exist_ok=True)
+            return
+        try:
+            mkdir(path)
+        except FileNotFoundError:
+            makedirs(path, exist_ok=True)  # parent isn't part of the plan
+        except FileExistsError:
+            if not isdir(path):
+                raise
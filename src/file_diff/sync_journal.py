@@ -0,0 +1,174 @@
+from os import fsync, lstat, makedirs, remove, replace
+from os.path import exists, join, lexists
+from threading import Lock
+from time import time
+import hashlib
+import json
+
+from src.file_diff.sync_plan import SyncAction, SyncOperation, SyncPlan
+from src.settings.constants import LOCKSTEP_FOLDER
+
+JOURNAL_FOLDER = join(LOCKSTEP_FOLDER, "journals")
+
+# completed operations are forced to disk this often; anything lost in a crash is simply redone
+FSYNC_INTERVAL = 256
+
+
+class SyncJournal(object):
+    """
+    This class records the progress of a sync job so that an interrupted job can be resumed.
+    When a job starts, its plan is saved; every completed operation is then appended to a log, together with the
+    size and mtime of what it produced and of the source it was produced from. A resumed job is planned against the
+    folders as they are now, so changes made since it stopped are synced too, and then skips logged operations
+    whose source and result are both unchanged, which only costs two stats per operation.
+    The journal is removed once a job runs to completion.
+    """
+    def __init__(self, src: str, dst: str, sync_option: str, folder: str = JOURNAL_FOLDER) -> None:
+        self.__src = src
+        self.__dst = dst
+        self.__sync_option = sync_option
+        name = hashlib.blake2b(f"{src}\0{dst}\0{sync_option}".encode(), digest_size=16).hexdigest()
+        self.__plan_file = join(folder, f"{name}.plan.json")
+        self.__log_file = join(folder, f"{name}.done.jsonl")
+        self.__folder = folder
+        self.__log = None
+        self.__unsynced = 0
+        self.__lock = Lock()  # shared by copy workers
+
+    def exists(self) -> bool:
+        """
+        Whether an unfinished job for the same folders and sync option left a journal behind.
+        :return: True if the job can be resumed
+        """
+        return exists(self.__plan_file)
+
+    def start(self, plan: SyncPlan) -> None:
+        """
+        Begin journaling a new job, discarding any previous journal.
+        :param plan: plan the job will execute
+        :return: None
+        """
+        self.__save_plan(plan)
+        self.__log = open(self.__log_file, "w")
+
+    def resume(self, plan: SyncPlan) -> SyncPlan:
+        """
+        Continue an unfinished job with a fresh plan of the same folders, without the operations it already did.
+        The log is kept, so operations done before an earlier resume are still skipped after the next one.
+        :param plan: plan of the folders as they are now
+        :return: plan of remaining operations
+        """
+        completed = {}
+        if exists(self.__log_file):
+            with open(self.__log_file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # last line cut off by a crash
+                    completed[(entry["action"], entry["dst"])] = entry
+
+        remaining = SyncPlan(plan.src, plan.dst)
+        skipped = 0
+        for op in plan.operations:
+            entry = completed.get((op.action, op.dst))
+            if entry is not None and self.__is_still_done(op, entry):
+                skipped += 1
+            else:
+                remaining.add(*op)
+
+        print(f"Resuming sync from {plan.src} to {plan.dst}: {skipped} operations already done, "
+              f"{len(remaining)} remaining")
+        self.__save_plan(remaining)
+        self.__log = open(self.__log_file, "a")
+        return remaining
+
+    def record(self, op: SyncOperation) -> None:
+        """
+        Log completed operation. Safe to call from multiple threads.
+        :param op: completed operation
+        :return: None
+        """
+        entry = {"action": op.action, "dst": op.dst}
+        if op.action in (SyncAction.COPY, SyncAction.OVERWRITE, SyncAction.LINK):
+            st = lstat(op.dst)
+            entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+            try:
+                st = lstat(op.origin or op.src)
+                entry.update(src_size=st.st_size, src_mtime_ns=st.st_mtime_ns)
+            except OSError:  # source removed meanwhile; without its stat the operation is never skipped
+                pass
+
+        line = json.dumps(entry) + "\n"
+        with self.__lock:
+            if self.__log is None:
+                return
+            self.__log.write(line)
+            self.__log.flush()
+            self.__unsynced += 1
+            if self.__unsynced >= FSYNC_INTERVAL:
+                fsync(self.__log.fileno())
+                self.__unsynced = 0
+
+    def close(self) -> None:
+        """
+        Flush log to disk and keep the journal for a later resume.
+        :return: None
+        """
+        with self.__lock:
+            if self.__log is not None:
+                self.__log.flush()
+                fsync(self.__log.fileno())
+                self.__log.close()
+                self.__log = None
+
+    def discard(self) -> None:
+        """
+        Remove journal, e.g. once its job has completed.
+        :return: None
+        """
+        self.close()
+        for filename in [self.__plan_file, self.__log_file]:
+            if exists(filename):
+                remove(filename)
+
+    def __save_plan(self, plan: SyncPlan) -> None:
+        """
+        Write plan of the job, atomically, so an interrupted write leaves the previous one in place.
+        :param plan: plan the job will execute
+        :return: None
+        """
+        makedirs(self.__folder, exist_ok=True)
+        header = {"src": self.__src, "dst": self.__dst, "sync_option": self.__sync_option, "created": time(),
+                  "operations": [list(op) for op in plan.operations]}
+        temp = self.__plan_file + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(header, f)
+            f.flush()
+            fsync(f.fileno())
+        replace(temp, self.__plan_file)
+
+    @staticmethod
+    def __is_still_done(op: SyncOperation, entry: dict) -> bool:
+        """
+        Cheap check that the result of a logged operation is still in place.
+        :param op: planned operation
+        :param entry: log entry of the operation
+        :return: True if the operation doesn't need to run again
+        """
+        if op.action == SyncAction.DELETE:
+            return not lexists(op.dst)
+        if op.action == SyncAction.MOVE:
+            return lexists(op.dst) and not lexists(op.src)
+        if op.action == SyncAction.MKDIR:
+            # always kept: creating an existing directory is free, and the executor restores its mtime afterwards
+            return False
+        # copies keep the source's mtime, so a copy is only planned again once the source changed after it ran;
+        # both sides have to be unchanged since then
+        try:
+            st = lstat(op.dst)
+            source = lstat(op.origin or op.src)
+        except OSError:
+            return False
+        return (st.st_size == entry.get("size") and st.st_mtime_ns == entry.get("mtime_ns")
+                and source.st_size == entry.get("src_size") and source.st_mtime_ns == entry.get("src_mtime_ns"))
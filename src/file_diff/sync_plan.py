@@ -0,0 +1,330 @@
+from collections import Counter
+from os import scandir, stat
+from os.path import dirname, exists, isdir, join, lexists, relpath
+from stat import S_ISDIR
+from typing import Iterable, NamedTuple, Optional
+
+from src.file_diff.move_detector import MoveDetector
+from src.file_diff.path_filter import PathFilter
+from src.file_diff.scan_result import DIRECTORY, FILE
+from src.file_diff.shared_listing import SharedListing
+from src.file_diff.throttle import Throttle
+from src.file_diff.tree_walker import TreeWalker
+from src.gui.constants import Enum
+from src.metrics.run_metrics import MetricCounter, MetricPhase, RunMetrics
+from src.settings.constants import DEFAULT_MAX_WORKERS
+
+SyncAction = Enum([
+    "MKDIR",
+    "COPY",
+    "OVERWRITE",
+    "MOVE",
+    "LINK",
+    "DELETE"
+])
+
+# dirsync only treats a file as newer if its mtime is ahead by at least a millisecond
+MTIME_TOLERANCE_NS = 10 ** 6
+
+
+class SyncOperation(NamedTuple):
+    """
+    Single step of a sync plan. src is None for DELETE; for MKDIR it is the directory whose metadata is copied; for
+    MOVE it is the destination-only entry that is renamed to dst; for LINK it is the destination of another copy
+    with the same content, which dst is linked to once that copy is done. origin is only set for LINK: the source
+    file whose content dst receives, which verification compares dst against.
+    """
+    action: str
+    src: Optional[str]
+    dst: str
+    size: int = 0
+    origin: Optional[str] = None
+
+
+class SyncPlan(object):
+    """
+    This class holds the explicit list of operations that brings the destination in line with the source.
+    """
+    def __init__(self, src: str, dst: str) -> None:
+        self.src = src
+        self.dst = dst
+        self.operations = []
+
+    def __len__(self) -> int:
+        return len(self.operations)
+
+    def add(self, action: str, src: Optional[str], dst: str, size: int = 0, origin: Optional[str] = None) -> None:
+        """
+        Append operation to plan.
+        :param action: SyncAction value
+        :param src: path to read from, if any
+        :param dst: path to write or delete
+        :param size: bytes to be copied
+        :param origin: for links, the source file dst gets its content from
+        :return: None
+        """
+        self.operations.append(SyncOperation(action, src, dst, size, origin))
+
+    def of_action(self, *actions: str) -> list:
+        """
+        Filter operations by action.
+        :param actions: SyncAction values
+        :return: list of matching operations
+        """
+        return [op for op in self.operations if op.action in actions]
+
+    def summary(self) -> dict:
+        """
+        Count operations per action and total bytes to copy.
+        :return: summary dictionary
+        """
+        summary = dict(Counter(op.action for op in self.operations))
+        summary["bytes"] = sum(op.size for op in self.operations)
+        return summary
+
+
+class SyncPlanner(object):
+    """
+    This class turns a folder diff into a sync plan for one of the supported sync options.
+    Semantics follow dirsync: ONE_WAY copies new files and files that are newer in the source, optionally purging
+    destination-only entries; TWO_WAY additionally copies files that are newer in the destination back to the source;
+    UPDATE only refreshes files that already exist in the destination.
+    When purging, source-only content that matches destination-only content is moved within the destination rather
+    than copied again and purged. Entries rejected by the path filter are neither copied nor purged.
+    Planners for several destinations of the same source can share a SharedListing, so each source directory is
+    only read once between them. A throttle limits the directory listings of the scan.
+    """
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, metrics: Optional[RunMetrics] = None,
+                 detect_moves: bool = True, path_filter: Optional[PathFilter] = None,
+                 listing: Optional[SharedListing] = None, throttle: Optional[Throttle] = None,
+                 low_priority: bool = False) -> None:
+        self.__max_workers = max_workers
+        self.__metrics = metrics if metrics is not None else RunMetrics("plan")
+        self.__detect_moves = detect_moves
+        self.__path_filter = path_filter if path_filter else None
+        self.__listing = listing
+        self.__throttle = throttle
+        self.__low_priority = low_priority
+
+    def plan(self, src: str, dst: str, sync_option: str, enable_purge: bool, diff: Optional[list] = None) -> SyncPlan:
+        """
+        Build sync plan, scanning the folders unless a diff from the evaluator is given.
+        :param src: source folder
+        :param dst: destination folder
+        :param sync_option: key of SyncOptions (ONE_WAY, TWO_WAY, UPDATE)
+        :param enable_purge: whether to delete destination-only entries (not used for UPDATE)
+        :param diff: source-only, destination-only and modified ScanResults from FileDiffEvaluator, if available
+        :return: sync plan
+        """
+        if diff is None:
+            diff = self.__scan(src, dst)
+
+        plan = SyncPlan(src, dst)
+        with self.__metrics.phase(MetricPhase.PLAN):
+            self.__add_diff(plan, diff, sync_option, enable_purge)
+        print(f"Planned sync from {src} to {dst}: {plan.summary()}")
+        return plan
+
+    def plan_paths(self, src: str, dst: str, sync_option: str, enable_purge: bool,
+                   rel_paths: Iterable[str]) -> SyncPlan:
+        """
+        Build sync plan covering only the given source entries, e.g. those reported by a file watcher.
+        Directories are compared recursively; files are compared individually; missing entries are purged.
+        :param src: source folder
+        :param dst: destination folder
+        :param sync_option: key of SyncOptions (ONE_WAY, TWO_WAY, UPDATE)
+        :param enable_purge: whether to delete destination entries that no longer exist in the source
+        :param rel_paths: changed entries, relative to the source folder
+        :return: sync plan
+        """
+        plan = SyncPlan(src, dst)
+        copies_allowed = sync_option in ("ONE_WAY", "TWO_WAY")
+        planned = set()
+        left_only, right_only = [], []  # collected, so a rename shows up as a move rather than a copy and a delete
+
+        for rel_path in sorted(set(rel_paths)):
+            if any(rel_path.startswith(join(parent, "")) for parent in planned):
+                continue  # already covered by a directory planned earlier
+            src_path, dst_path = join(src, rel_path), join(dst, rel_path)
+            if self.__path_filter is not None and \
+                    not self.__path_filter.accepts_path(rel_path, isdir(src_path) or isdir(dst_path)):
+                continue
+
+            if not exists(src_path):
+                if enable_purge and copies_allowed and lexists(dst_path):
+                    right_only.append(dst_path)
+                    planned.add(rel_path)
+            elif not exists(dst_path):
+                if copies_allowed:
+                    # copy from the highest ancestor that is missing in the destination
+                    while dirname(rel_path) and not exists(join(dst, dirname(rel_path))):
+                        rel_path = dirname(rel_path)
+                    if rel_path not in planned:
+                        left_only.append((rel_path, None, 0))
+                        planned.add(rel_path)
+            elif isdir(src_path) and isdir(dst_path):
+                self.__add_diff(plan, self.__scan(src, dst, rel_path), sync_option, enable_purge)
+                planned.add(rel_path)
+            elif not isdir(src_path) and not isdir(dst_path):
+                self.__add_update(plan, src, dst, rel_path, sync_option)
+
+        self.__add_transfers(plan, left_only, right_only)
+        print(f"Planned sync of {len(planned)} changed paths from {src} to {dst}: {plan.summary()}")
+        return plan
+
+    def __scan(self, src: str, dst: str, rel_root: str = "") -> list:
+        """
+        Diff two folders for planning.
+        :param src: source folder
+        :param dst: destination folder
+        :param rel_root: subdirectory to limit the diff to
+        :return: source-only, destination-only and modified ScanResults
+        """
+        # dirsync copies everything, so don't skip the names dircmp ignores
+        walker = TreeWalker(self.__max_workers, self.__is_modified, manifest=self.__listing, ignored_names=set(),
+                            metrics=self.__metrics, path_filter=self.__path_filter, throttle=self.__throttle,
+                            low_priority=self.__low_priority)
+        with self.__metrics.phase(MetricPhase.SCAN):
+            return walker.walk(src, dst, rel_root)
+
+    def __add_diff(self, plan: SyncPlan, diff: list, sync_option: str, enable_purge: bool) -> None:
+        """
+        Add operations for a folder diff.
+        :param plan: plan to extend
+        :param diff: source-only, destination-only and modified ScanResults under the plan's folders
+        :param sync_option: key of SyncOptions
+        :param enable_purge: whether to delete destination-only entries
+        :return: None
+        """
+        src, dst = plan.src, plan.dst
+        left_only, right_only, modified = diff
+
+        if sync_option in ("ONE_WAY", "TWO_WAY"):
+            purged = [join(dst, rel_path) for rel_path in right_only.rel_paths()] if enable_purge else []
+            self.__add_transfers(plan, [(rel_path, kind, size) for rel_path, kind, size, _ in left_only.iter_entries()],
+                                 purged)
+
+        # the scan already stat'ed the source side of modified files
+        for rel_path, _, size, mtime_ns in modified.iter_entries():
+            self.__add_update(plan, src, dst, rel_path, sync_option, (size, mtime_ns))
+
+    def __add_transfers(self, plan: SyncPlan, left_only: list, right_only: list) -> None:
+        """
+        Add operations that copy source-only entries and purge destination-only entries. Content that was only
+        moved or renamed in the source is moved the same way in the destination.
+        :param plan: plan to extend
+        :param left_only: source-only entries to copy, as (relative path, kind, size); kind is None if not known
+        :param right_only: destination-only paths to purge, empty if purge is disabled
+        :return: None
+        """
+        moves = {}
+        if self.__detect_moves and left_only and right_only:
+            detected = MoveDetector(metrics=self.__metrics, path_filter=self.__path_filter).detect(
+                plan.src, plan.dst, [join(plan.src, rel_path) for rel_path, _, _ in left_only], right_only)
+            moves = {relpath(path, plan.src): target for path, target in detected.items()}
+
+        moved_from = set(moves.values())
+        for path in right_only:
+            if path not in moved_from:
+                plan.add(SyncAction.DELETE, None, path)
+        for rel_path, kind, size in left_only:
+            self.__add_copies(plan, plan.src, plan.dst, rel_path, moves, kind, size)
+
+    def __add_update(self, plan: SyncPlan, src: str, dst: str, rel_path: str, sync_option: str,
+                     src_metadata: Optional[tuple] = None) -> None:
+        """
+        Add overwrite for a file present on both sides, in whichever direction the sync option and mtimes allow.
+        :param plan: plan to extend
+        :param src: source folder
+        :param dst: destination folder
+        :param rel_path: file relative to both folders
+        :param sync_option: key of SyncOptions
+        :param src_metadata: size and mtime_ns of the source file, if known from the scan
+        :return: None
+        """
+        if src_metadata is None:
+            src_stat = stat(join(src, rel_path))
+            self.__metrics.count(MetricCounter.STAT_CALLS)
+            src_metadata = src_stat.st_size, src_stat.st_mtime_ns
+        src_size, src_mtime_ns = src_metadata
+        dst_stat = stat(join(dst, rel_path))
+        self.__metrics.count(MetricCounter.STAT_CALLS)
+        if src_mtime_ns - dst_stat.st_mtime_ns >= MTIME_TOLERANCE_NS:
+            plan.add(SyncAction.OVERWRITE, join(src, rel_path), join(dst, rel_path), src_size)
+        elif sync_option == "TWO_WAY" and dst_stat.st_mtime_ns - src_mtime_ns >= MTIME_TOLERANCE_NS:
+            plan.add(SyncAction.OVERWRITE, join(dst, rel_path), join(src, rel_path), dst_stat.st_size)
+
+    def __is_modified(self, left, right) -> bool:
+        """
+        Cheap comparison used when planning without an evaluator diff. Direction is decided later from mtimes.
+        :param left: source file entry
+        :param right: destination file entry
+        :return: True if the files' size or mtime differ
+        """
+        left_stat, right_stat = left.stat(), right.stat()
+        self.__metrics.count(MetricCounter.STAT_CALLS, 2)
+        return left_stat.st_size != right_stat.st_size or left_stat.st_mtime_ns != right_stat.st_mtime_ns
+
+    def __add_copies(self, plan: SyncPlan, src: str, dst: str, rel_path: str, moves: Optional[dict] = None,
+                     kind: Optional[int] = None, size: int = 0) -> None:
+        """
+        Add operations that copy a source-only entry, expanding directories into their contents.
+        :param plan: plan to extend
+        :param src: source folder
+        :param dst: destination folder
+        :param rel_path: entry relative to both folders
+        :param moves: relative source path -> destination path with the same content, moved instead of copied
+        :param kind: FILE or DIRECTORY if known from the scan, otherwise the entry is stat'ed
+        :param size: size of the entry, if kind is FILE
+        :return: None
+        """
+        moves = moves or {}
+        if rel_path in moves:
+            plan.add(SyncAction.MOVE, moves[rel_path], join(dst, rel_path))
+            return
+
+        if kind not in (FILE, DIRECTORY):
+            st = stat(join(src, rel_path))
+            self.__metrics.count(MetricCounter.STAT_CALLS)
+            kind, size = (DIRECTORY, 0) if S_ISDIR(st.st_mode) else (FILE, st.st_size)
+        if kind == FILE:
+            plan.add(SyncAction.COPY, join(src, rel_path), join(dst, rel_path), size)
+            return
+
+        pending = [rel_path]
+        while pending:
+            rel_dir = pending.pop()
+            plan.add(SyncAction.MKDIR, join(src, rel_dir), join(dst, rel_dir))
+            for entry in self.__list_source(join(src, rel_dir)):
+                if self.__path_filter is not None and \
+                        not self.__path_filter.accepts(join(rel_dir, entry.name), entry.is_dir()):
+                    continue
+                if entry.is_dir():
+                    pending.append(join(rel_dir, entry.name))
+                elif join(rel_dir, entry.name) in moves:
+                    plan.add(SyncAction.MOVE, moves[join(rel_dir, entry.name)], join(dst, rel_dir, entry.name))
+                elif entry.is_file():
+                    self.__metrics.count(MetricCounter.STAT_CALLS)
+                    plan.add(SyncAction.COPY, entry.path, join(dst, rel_dir, entry.name), entry.stat().st_size)
+
+    def __list_source(self, path: str) -> list:
+        """
+        List a source directory, through the shared listing if there is one.
+        :param path: directory to list
+        :return: list of DirEntry
+        """
+        if self.__listing is not None:
+            return self.__listing.list_directory(path, self.__scan_directory)
+        return self.__scan_directory(path)
+
+    def __scan_directory(self, path: str) -> list:
+        """
+        List a single directory from disk.
+        :param path: directory to list
+        :return: list of DirEntry
+        """
+        if self.__throttle is not None:
+            self.__throttle.operation()
+        self.__metrics.count(MetricCounter.DIRS_LISTED)
+        with scandir(path) as it:
+            return list(it)
@@ -0,0 +1,283 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_all_start_methods, get_context
+from os import cpu_count, makedirs, scandir, stat
+from os.path import dirname, join
+from threading import Event
+from typing import Iterator, Optional
+import hashlib
+
+from src.file_diff.copy_backend import CopyBackend, CopyCancelled
+from src.file_diff.path_filter import PathFilter
+from src.file_diff.scan_result import DIRECTORY, FILE
+from src.file_diff.sync_plan import SyncAction, SyncPlan
+from src.file_diff.tree_walker import TreeWalker
+from src.metrics.run_metrics import MetricCounter, MetricPhase, RunMetrics
+from src.settings.constants import DEFAULT_VERIFY_ALGORITHM, MIB
+
+# hashing is CPU bound, so one worker process per core
+DEFAULT_VERIFY_WORKERS = cpu_count() or 1
+
+# callers are multi-threaded (GUI, daemon, batch runner), and forking a threaded process can leave the children
+# deadlocked on locks other threads held; forkserver starts them from a clean single-threaded process instead
+WORKER_START_METHOD = "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+
+VERIFY_CHUNK_SIZE = MIB
+
+# files are handed to the workers in batches of about this many bytes (or this many files), so small files don't
+# each pay for a round trip to a worker process and a single large file doesn't hold up a whole batch
+BATCH_BYTES = 64 * MIB
+BATCH_FILES = 256
+
+# mismatch reasons
+MISSING, MISSING_SOURCE, SIZE, CONTENT, UNREADABLE = "missing", "missing source", "size", "content", "unreadable"
+
+
+def hash_file(path: str, algorithm: str, chunk_size: int) -> bytes:
+    """
+    Hash file contents, reading it in chunks.
+    :param path: file to hash
+    :param algorithm: hashlib algorithm name
+    :param chunk_size: bytes read at a time
+    :return: digest
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return digest.digest()
+            digest.update(chunk)
+
+
+def verify_batch(pairs: list, algorithm: str, chunk_size: int) -> list:
+    """
+    Compare source and destination files by size, then by digest. Runs in a worker process.
+    :param pairs: (source file, destination file, size) tuples
+    :param algorithm: hashlib algorithm name
+    :param chunk_size: bytes read at a time
+    :return: per pair, the mismatch reason (None if the files match) and the number of files hashed
+    """
+    outcomes = []
+    for src, dst, _ in pairs:
+        try:
+            src_size = stat(src).st_size
+        except FileNotFoundError:
+            outcomes.append((MISSING_SOURCE, 0))
+            continue
+        except OSError as e:
+            outcomes.append((f"{UNREADABLE}: {e}", 0))
+            continue
+        try:
+            dst_size = stat(dst).st_size
+        except FileNotFoundError:
+            outcomes.append((MISSING, 0))
+            continue
+        except OSError as e:
+            outcomes.append((f"{UNREADABLE}: {e}", 0))
+            continue
+        if src_size != dst_size:
+            outcomes.append((SIZE, 0))
+            continue
+        try:
+            same = hash_file(src, algorithm, chunk_size) == hash_file(dst, algorithm, chunk_size)
+        except OSError as e:
+            outcomes.append((f"{UNREADABLE}: {e}", 0))
+            continue
+        outcomes.append((None if same else CONTENT, 2))
+    return outcomes
+
+
+class SyncVerifier(object):
+    """
+    This class checks that destination files match their sources after a sync, by size and then by a cryptographic
+    digest. Files are hashed in chunks on a pool of worker processes, so large trees use every core.
+    Mismatches are listed in a report and, if asked to, copied again and checked once more.
+    """
+    def __init__(self, algorithm: str = DEFAULT_VERIFY_ALGORITHM, max_workers: int = DEFAULT_VERIFY_WORKERS,
+                 chunk_size: int = VERIFY_CHUNK_SIZE, metrics: Optional[RunMetrics] = None,
+                 cancel_event: Optional[Event] = None) -> None:
+        if algorithm not in hashlib.algorithms_available or algorithm.startswith("shake"):
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        self.__algorithm = algorithm
+        self.__max_workers = max(1, max_workers)
+        self.__chunk_size = chunk_size
+        self.__metrics = metrics if metrics is not None else RunMetrics("verify")
+        self.__cancel_event = cancel_event if cancel_event is not None else Event()
+
+    def verify_plan(self, plan: SyncPlan, repair: bool = False) -> dict:
+        """
+        Verify the files a sync plan wrote. Moves aren't checked, as the plan doesn't record their source. Links are
+        checked against their own source file, not the copy they were linked to, so repairs copy from it as well.
+        :param plan: executed sync plan
+        :param repair: whether to copy mismatched files again
+        :return: verification report
+        """
+        pairs = [(op.origin or op.src, op.dst, op.size)
+                 for op in plan.of_action(SyncAction.COPY, SyncAction.OVERWRITE, SyncAction.LINK)]
+        return self.verify(pairs, repair)
+
+    def verify_tree(self, src: str, dst: str, path_filter: Optional[PathFilter] = None, repair: bool = False) -> dict:
+        """
+        Verify every source file against the destination, e.g. independently of a sync.
+        Destination-only entries aren't reported; whether they belong there depends on the purge setting.
+        :param src: source folder
+        :param dst: destination folder
+        :param path_filter: include/exclude rules of the configuration, if any
+        :param repair: whether to copy missing and mismatched files again
+        :return: verification report
+        """
+        # reporting every common file as modified makes the walk list all pairs to hash
+        walker = TreeWalker(file_comparator=lambda left, right: True, ignored_names=set(), metrics=self.__metrics,
+                            path_filter=path_filter)
+        with self.__metrics.phase(MetricPhase.SCAN):
+            left_only, _, common = walker.walk(src, dst)
+
+        pairs = [(join(src, rel_path), join(dst, rel_path), size)
+                 for rel_path, size in zip(common.rel_paths(), common.sizes)]
+        for rel_path, kind, size, _ in left_only.iter_entries():
+            if kind == FILE:
+                pairs.append((join(src, rel_path), join(dst, rel_path), size))
+            elif kind == DIRECTORY:
+                pairs.extend(self.__list_files(src, dst, rel_path, path_filter))
+        return self.verify(pairs, repair)
+
+    def verify(self, pairs: list, repair: bool = False) -> dict:
+        """
+        Verify pairs of files.
+        :param pairs: (source file, destination file, size) tuples
+        :param repair: whether to copy mismatched files again
+        :return: verification report: algorithm, count of verified files, mismatches as (source, destination,
+            reason, repaired) and count of repaired files; cancelled counts files left unchecked
+        """
+        self.__metrics.add_total(len(pairs))
+        with self.__metrics.phase(MetricPhase.VERIFY):
+            mismatches, cancelled = self.__check(pairs)
+
+        repaired = set()
+        if repair and mismatches and not self.__cancel_event.is_set():
+            repaired = self.__repair([pair for pair, reason in mismatches if reason != MISSING_SOURCE])
+
+        report = {
+            "algorithm": self.__algorithm,
+            "verified": len(pairs) - len(mismatches) - cancelled,
+            "mismatches": [{"src": src, "dst": dst, "reason": reason, "repaired": dst in repaired}
+                           for (src, dst, _), reason in mismatches],
+            "repaired": len(repaired),
+            "cancelled": cancelled
+        }
+        for mismatch in report["mismatches"]:
+            state = "repaired" if mismatch["repaired"] else "not repaired"
+            print(f"Verification failed for {mismatch['dst']} ({mismatch['reason']}, {state})")
+        print(f"Verified {report['verified']} files with {self.__algorithm}: {len(mismatches)} mismatches, "
+              f"{len(repaired)} repaired")
+        return report
+
+    def __check(self, pairs: list) -> tuple:
+        """
+        Hash pairs on the worker processes.
+        :param pairs: (source file, destination file, size) tuples
+        :return: list of (pair, reason) for mismatched pairs, and count of pairs skipped by cancellation
+        """
+        mismatches, cancelled = [], 0
+        batches = list(self.__batches(pairs))
+        if not batches:
+            return mismatches, cancelled
+
+        with ProcessPoolExecutor(min(self.__max_workers, len(batches)),
+                                 mp_context=get_context(WORKER_START_METHOD)) as executor:
+            pending = iter(batches)
+            in_flight = {}
+            try:
+                while True:
+                    # keep a bounded number of batches queued, so a cancel takes effect quickly
+                    while len(in_flight) < self.__max_workers * 2 and not self.__cancel_event.is_set():
+                        batch = next(pending, None)
+                        if batch is None:
+                            break
+                        in_flight[executor.submit(verify_batch, batch, self.__algorithm, self.__chunk_size)] = batch
+                    if not in_flight:
+                        break
+
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        batch = in_flight.pop(future)
+                        for pair, (reason, hashed) in zip(batch, future.result()):
+                            self.__metrics.count(MetricCounter.FILES_HASHED, hashed)
+                            if reason is not None:
+                                self.__metrics.count(MetricCounter.MISMATCHES)
+                                mismatches.append((pair, reason))
+                        self.__metrics.advance(len(batch))
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+        cancelled = sum(map(len, pending)) if self.__cancel_event.is_set() else 0
+        return mismatches, cancelled
+
+    def __repair(self, pairs: list) -> set:
+        """
+        Copy mismatched files again and check them once more.
+        :param pairs: (source file, destination file, size) tuples
+        :return: destination files that match their source afterwards
+        """
+        copy_backend = CopyBackend()
+        copied = []
+        for pair in pairs:
+            src, dst, _ = pair
+            try:
+                makedirs(dirname(dst), exist_ok=True)  # whole directories may be missing
+                copy_backend.copy(src, dst, self.__cancel_event)
+                self.__metrics.count(MetricCounter.BYTES_COPIED, pair[2])
+                copied.append(pair)
+            except CopyCancelled:
+                break
+            except OSError as e:
+                print(f"Unable to repair {dst}: {e}")
+                self.__metrics.count(MetricCounter.ERRORS)
+
+        self.__metrics.add_total(len(copied))
+        still_mismatched, _ = self.__check(copied)
+        failed = {dst for (_, dst, _), _ in still_mismatched}
+        return {dst for _, dst, _ in copied if dst not in failed}
+
+    def __list_files(self, src: str, dst: str, rel_dir: str, path_filter: Optional[PathFilter]) -> list:
+        """
+        List the files below a source-only directory, all of which are missing in the destination.
+        :param src: source folder
+        :param dst: destination folder
+        :param rel_dir: directory relative to both folders
+        :param path_filter: include/exclude rules of the configuration, if any
+        :return: (source file, destination file, size) tuples
+        """
+        pairs, pending = [], [rel_dir]
+        while pending:
+            rel_dir = pending.pop()
+            self.__metrics.count(MetricCounter.DIRS_LISTED)
+            with scandir(join(src, rel_dir)) as it:
+                for entry in it:
+                    rel_path = join(rel_dir, entry.name)
+                    if path_filter and not path_filter.accepts(rel_path, entry.is_dir()):
+                        continue
+                    if entry.is_dir():
+                        pending.append(rel_path)
+                    elif entry.is_file():
+                        self.__metrics.count(MetricCounter.STAT_CALLS)
+                        pairs.append((entry.path, join(dst, rel_path), entry.stat().st_size))
+        return pairs
+
+    @staticmethod
+    def __batches(pairs: list) -> Iterator[list]:
+        """
+        Split pairs into batches for the worker processes.
+        :param pairs: (source file, destination file, size) tuples
+        :return: iterator of batches
+        """
+        batch, batch_bytes = [], 0
+        for pair in pairs:
+            batch.append(pair)
+            batch_bytes += pair[2]
+            if batch_bytes >= BATCH_BYTES or len(batch) >= BATCH_FILES:
+                yield batch
+                batch, batch_bytes = [], 0
+        if batch:
+            yield batch
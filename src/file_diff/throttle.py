@@ -0,0 +1,189 @@
+from threading import Condition, Event, get_native_id
+from time import monotonic
+from typing import Callable, Optional
+import ctypes
+import os
+import platform
+
+# a bucket holds at most this many seconds worth of tokens, so an idle period allows only a short burst
+BURST_SECONDS = 1.0
+
+# longest single wait, so cancellation and raised limits are noticed promptly
+MAX_WAIT = 0.25
+
+# limits are re-read from their source at most this often, so changes made elsewhere reach a running sync
+DEFAULT_REFRESH_INTERVAL = 2.0
+
+# Linux I/O priority constants (see ioprio_set(2)); glibc has no wrapper, so the syscall is made directly
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1  # with a thread ID, applies to that thread only
+SYS_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "i386": 289, "i686": 289, "armv7l": 314, "ppc64le": 273}
+
+# added to the niceness of low-priority workers
+LOW_PRIORITY_NICENESS = 10
+
+
+class TokenBucket(object):
+    """
+    This class limits the rate of some quantity (bytes, operations) shared by many threads. Callers take tokens for
+    what they are about to do; once the bucket is empty they wait until it has refilled. A caller may take more
+    than the bucket holds, e.g. a large chunk, and later callers then wait until that debt is paid back.
+    A rate of 0 means unlimited. The rate can be changed at any time; waiting callers pick it up immediately.
+    """
+    def __init__(self, rate: float = 0) -> None:
+        self.__rate = max(0.0, rate)
+        self.__tokens = self.__rate * BURST_SECONDS
+        self.__updated = monotonic()
+        self.__condition = Condition()
+
+    @property
+    def rate(self) -> float:
+        """
+        Getter for tokens added per second.
+        :return: rate, 0 if unlimited
+        """
+        return self.__rate
+
+    @rate.setter
+    def rate(self, rate: float) -> None:
+        """
+        Setter for tokens added per second. Applies to waiting callers as well.
+        :param rate: rate, 0 for unlimited
+        :return: None
+        """
+        with self.__condition:
+            self.__refill()
+            self.__rate = max(0.0, rate)
+            self.__tokens = min(self.__tokens, self.__rate * BURST_SECONDS)
+            self.__condition.notify_all()
+
+    def consume(self, amount: float, cancel_event: Optional[Event] = None) -> None:
+        """
+        Take tokens, waiting while the bucket is in debt.
+        :param amount: tokens to take
+        :param cancel_event: stops waiting when set
+        :return: None
+        """
+        with self.__condition:
+            if self.__rate <= 0:
+                return
+            self.__refill()
+            self.__tokens -= amount
+            while self.__rate > 0 and self.__tokens < 0:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                self.__condition.wait(min(-self.__tokens / self.__rate, MAX_WAIT))
+                self.__refill()
+
+    def __refill(self) -> None:
+        """
+        Add tokens for the time since the last refill. Caller must hold the condition.
+        :return: None
+        """
+        now = monotonic()
+        self.__tokens = min(self.__rate * BURST_SECONDS, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+
+class Throttle(object):
+    """
+    This class enforces a sync's limits on bytes per second and operations (directory listings, file operations)
+    per second, with one token bucket each. Limits can be set directly, e.g. from the GUI, or read from a source
+    such as the saved configuration, which is polled while the sync runs so that limits changed by another process
+    (e.g. `lockstep throttle`) take effect without restarting it.
+    """
+    def __init__(self, bytes_per_second: float = 0, ops_per_second: float = 0,
+                 refresh_interval: float = DEFAULT_REFRESH_INTERVAL) -> None:
+        self.__bytes = TokenBucket(bytes_per_second)
+        self.__ops = TokenBucket(ops_per_second)
+        self.__refresh_interval = refresh_interval
+        self.__limits_source = None  # () -> (bytes per second, operations per second)
+        self.__refreshed = monotonic()
+
+    @property
+    def limits(self) -> tuple:
+        """
+        Getter for current limits.
+        :return: bytes per second and operations per second, 0 if unlimited
+        """
+        return self.__bytes.rate, self.__ops.rate
+
+    def set_limits(self, bytes_per_second: float, ops_per_second: float) -> None:
+        """
+        Change limits. Applies to a running sync immediately.
+        :param bytes_per_second: 0 for unlimited
+        :param ops_per_second: 0 for unlimited
+        :return: None
+        """
+        if (bytes_per_second, ops_per_second) != self.limits:
+            print(f"Throttling to {bytes_per_second or 'unlimited'} bytes/s, {ops_per_second or 'unlimited'} ops/s")
+        self.__bytes.rate = bytes_per_second
+        self.__ops.rate = ops_per_second
+
+    def watch_limits(self, limits_source: Optional[Callable]) -> None:
+        """
+        Read limits from a source now, and again periodically while the sync runs.
+        :param limits_source: returns (bytes per second, operations per second), or None to stop polling
+        :return: None
+        """
+        self.__limits_source = limits_source
+        if limits_source is not None:
+            self.set_limits(*limits_source())
+        self.__refreshed = monotonic()
+
+    def transfer(self, size: int, cancel_event: Optional[Event] = None) -> None:
+        """
+        Wait until size bytes may be transferred.
+        :param size: bytes about to be read or written
+        :param cancel_event: stops waiting when set
+        :return: None
+        """
+        self.__refresh()
+        self.__bytes.consume(size, cancel_event)
+
+    def operation(self, cancel_event: Optional[Event] = None, count: int = 1) -> None:
+        """
+        Wait until more operations may start.
+        :param cancel_event: stops waiting when set
+        :param count: operations about to start
+        :return: None
+        """
+        self.__refresh()
+        self.__ops.consume(count, cancel_event)
+
+    def __refresh(self) -> None:
+        """
+        Re-read limits from their source, if one is set and the refresh interval has passed.
+        :return: None
+        """
+        if self.__limits_source is None or monotonic() - self.__refreshed < self.__refresh_interval:
+            return
+        self.__refreshed = monotonic()  # set first, so other threads don't poll at the same time
+        try:
+            self.set_limits(*self.__limits_source())
+        except Exception as e:  # keep the current limits; e.g. the settings database is locked
+            print(f"Unable to refresh throttle limits: {e}")
+
+
+def lower_priority() -> None:
+    """
+    Move the calling thread to the idle I/O scheduling class and raise its niceness, so it only gets disk and CPU
+    time nothing else wants. Meant as an initializer for worker threads; other threads keep their priority. Only
+    supported on Linux, where both are per thread; elsewhere this does nothing.
+    :return: None
+    """
+    if platform.system() != "Linux":
+        return
+    thread_id = get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, thread_id, os.getpriority(os.PRIO_PROCESS, thread_id) + LOW_PRIORITY_NICENESS)
+    except OSError as e:
+        print(f"Unable to lower CPU priority: {e}")
+
+    syscall = SYS_IOPRIO_SET.get(platform.machine())
+    if syscall is None:
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall, IOPRIO_WHO_PROCESS, thread_id, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+        print(f"Unable to set idle I/O priority: {os.strerror(ctypes.get_errno())}")
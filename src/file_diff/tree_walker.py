@@ -0,0 +1,201 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from filecmp import DEFAULT_IGNORES
+from os import curdir, pardir, scandir
+from os.path import join, normcase
+from stat import S_ISDIR, S_ISREG
+from typing import Callable, Iterator, Optional
+
+from src.file_diff.path_filter import PathFilter
+from src.file_diff.scan_manifest import ScanManifest
+from src.file_diff.scan_result import DIRECTORY, FILE, OTHER, DirectoryTable, ScanResult
+from src.file_diff.throttle import Throttle, lower_priority
+from src.metrics.run_metrics import MetricCounter, RunMetrics
+from src.settings.constants import DEFAULT_MAX_WORKERS
+
+# number of entries handed to the consumer at a time when streaming results
+DEFAULT_BATCH_SIZE = 2000
+
+# same names filecmp.dircmp hides/ignores by default, so results match the previous implementation
+IGNORED_NAMES = frozenset(DEFAULT_IGNORES + [curdir, pardir])
+
+
+class TreeWalker(object):
+    """
+    This class walks the source and destination folders side by side and reports entries unique to either side.
+    Directories are listed with os.scandir on a bounded thread pool; the walk itself is iterative.
+    Entries rejected by the path filter are left out on both sides, and excluded directories are never listed.
+    With a throttle, every directory read from disk counts as one operation.
+    """
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, file_comparator: Optional[Callable] = None,
+                 manifest: Optional[ScanManifest] = None, ignored_names: frozenset = IGNORED_NAMES,
+                 metrics: Optional[RunMetrics] = None, path_filter: Optional[PathFilter] = None,
+                 throttle: Optional[Throttle] = None, low_priority: bool = False) -> None:
+        self.__max_workers = max(1, max_workers)
+        self.__ignored_names = frozenset(ignored_names) | {curdir, pardir}
+        self.__file_comparator = file_comparator  # (src entry, dst entry) -> bool, called for files on both sides
+        self.__manifest = manifest  # ScanManifest or SharedListing to reuse listings from, if given
+        self.__metrics = metrics if metrics is not None else RunMetrics("walk")  # progress counts directory pairs
+        self.__path_filter = path_filter if path_filter else None  # empty filters are skipped entirely
+        self.__throttle = throttle
+        self.__low_priority = low_priority  # list at idle I/O priority and raised niceness
+
+    @property
+    def max_workers(self) -> int:
+        """
+        Getter for number of directory listing threads.
+        :return: max_workers value
+        """
+        return self.__max_workers
+
+    def walk(self, src: str, dst: str, rel_root: str = "") -> tuple:
+        """
+        Walk both folders and collect entries that only exist on one side.
+        Only directories present on both sides are descended into, matching filecmp.dircmp.
+        If a file comparator was given, files present on both sides are checked on the worker threads as well.
+        :param src: source folder
+        :param dst: destination folder
+        :param rel_root: subdirectory present in both folders to start from, so paths stay relative to the folders
+        :return: ScanResult of source deltas, destination deltas, and modified files (with source metadata)
+        """
+        results = None
+        for batch in self.iter_batches(src, dst, rel_root=rel_root):
+            if results is None:
+                results = batch
+            else:
+                for result, entries in zip(results, batch):
+                    result.extend(entries)
+        return results
+
+    def iter_batches(self, src: str, dst: str, batch_size: int = DEFAULT_BATCH_SIZE,
+                     rel_root: str = "") -> Iterator[tuple]:
+        """
+        Walk both folders, yielding results as they are found instead of all at once.
+        The walk pauses while the consumer holds on to a batch, so a slow consumer throttles the scan.
+        All batches share one DirectoryTable; at least one batch is yielded, even if the folders don't differ.
+        :param src: source folder
+        :param dst: destination folder
+        :param batch_size: number of entries after which a batch is yielded
+        :param rel_root: subdirectory present in both folders to start from
+        :return: iterator of (source deltas, destination deltas, modified files) batches of ScanResult
+        """
+        directories = DirectoryTable(rel_root)
+        src_delta, dst_delta, modified = ScanResult(src, directories), ScanResult(dst, directories), \
+            ScanResult(src, directories)
+        pending = deque([0])  # indices of common directories that still need to be listed
+        in_flight = set()
+        yielded = False
+        self.__metrics.add_total(1)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                initializer=lower_priority if self.__low_priority else None) as executor:
+            try:
+                while pending or in_flight:
+                    # cap outstanding work so very wide trees don't queue millions of futures at once
+                    while pending and len(in_flight) < self.max_workers * 2:
+                        index = pending.popleft()
+                        in_flight.add(executor.submit(self.__compare_directory, src, dst, index,
+                                                      directories.rel_path(index)))
+
+                    # results are added to the tables here on the consumer thread, so they need no locking
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index, left_only, right_only, common_dirs, modified_files = future.result()
+                        for result, rows in [(src_delta, left_only), (dst_delta, right_only),
+                                             (modified, modified_files)]:
+                            for row in rows:
+                                result.append(index, *row)
+                        pending.extend(directories.add(index, name) for name in common_dirs)
+                        self.__metrics.add_total(len(common_dirs))
+                        self.__metrics.advance()
+
+                    if len(src_delta) + len(dst_delta) + len(modified) >= batch_size:
+                        yield src_delta, dst_delta, modified
+                        yielded = True
+                        src_delta, dst_delta, modified = ScanResult(src, directories), ScanResult(dst, directories), \
+                            ScanResult(src, directories)
+            finally:
+                for future in in_flight:
+                    future.cancel()  # consumer stopped early or a listing failed
+
+        if src_delta or dst_delta or modified or not yielded:
+            yield src_delta, dst_delta, modified
+
+    def __scan_directory(self, path: str) -> list:
+        """
+        List a single directory from disk.
+        :param path: directory to list
+        :return: list of DirEntry
+        """
+        if self.__throttle is not None:
+            self.__throttle.operation()
+        self.__metrics.count(MetricCounter.DIRS_LISTED)
+        with scandir(path) as it:
+            return [entry for entry in it if entry.name not in self.__ignored_names]
+
+    def __list_directory(self, root: str, rel_dir: str) -> dict:
+        """
+        List a single directory, keyed by case-normalized name.
+        :param root: source or destination folder
+        :param rel_dir: directory relative to the folder
+        :return: dictionary of normalized name to DirEntry
+        """
+        path = join(root, rel_dir)
+        if self.__manifest is not None:
+            entries = self.__manifest.list_directory(path, self.__scan_directory)
+        else:
+            entries = self.__scan_directory(path)
+        if self.__path_filter is not None:
+            entries = [entry for entry in entries
+                       if self.__path_filter.accepts(join(rel_dir, entry.name), entry.is_dir())]
+        return {normcase(entry.name): entry for entry in entries}
+
+    def __describe(self, entry) -> tuple:
+        """
+        Metadata of a reported entry. Follows symlinks, like the is_dir/is_file checks of the walk.
+        :param entry: DirEntry or ManifestEntry
+        :return: name, kind, size and mtime_ns; entries that can't be stat'ed are OTHER with zero size and mtime
+        """
+        try:
+            st = entry.stat()
+        except OSError:
+            return entry.name, OTHER, 0, 0
+        self.__metrics.count(MetricCounter.STAT_CALLS)
+        if S_ISDIR(st.st_mode):
+            return entry.name, DIRECTORY, 0, st.st_mtime_ns
+        return entry.name, FILE if S_ISREG(st.st_mode) else OTHER, st.st_size, st.st_mtime_ns
+
+    def __compare_directory(self, src: str, dst: str, index: int, rel_dir: str) -> tuple:
+        """
+        Compare one directory level between source and destination. Runs on a worker thread.
+        :param src: source folder
+        :param dst: destination folder
+        :param index: index of the directory in the scan's DirectoryTable, passed through to the result
+        :param rel_dir: directory relative to both roots
+        :return: directory index, source-only entries, destination-only entries, names of common subdirectories,
+            and modified files; entries as (name, kind, size, mtime_ns)
+        """
+        left = self.__list_directory(src, rel_dir)
+        right = self.__list_directory(dst, rel_dir)
+
+        left_only = [self.__describe(entry) for name, entry in left.items() if name not in right]
+        right_only = [self.__describe(entry) for name, entry in right.items() if name not in left]
+
+        common_dirs, modified = [], []
+        for name, entry in left.items():
+            other = right.get(name)
+            if other is None:
+                continue
+            try:
+                # DirEntry caches d_type, so this only stats for symlinks/unknown types (dircmp follows links too)
+                if entry.is_dir() and other.is_dir():
+                    common_dirs.append(entry.name)
+                elif self.__file_comparator and entry.is_file() and other.is_file():
+                    if self.__file_comparator(entry, other):
+                        modified.append(self.__describe(entry))
+            except OSError as e:
+                # equivalent of dircmp's common_funny: neither reported nor descended into
+                print(f"Unable to compare {entry.path}: {e}")
+                self.__metrics.count(MetricCounter.ERRORS)
+
+        return index, left_only, right_only, common_dirs, modified
@@ -11,8 +11,11 @@ class Enum(set):
 
 CallbackKey = Enum([
     "EVALUATE",
+    "EVALUATION_BATCH",
     "EVALUATION_COMPLETE",
     "SYNCHRONIZE",
+    "SYNC_COMPLETE",
+    "CANCEL",
     "SOURCE_FOLDER",
     "SOURCE_TREE",
     "DESTINATION_FOLDER",
@@ -20,15 +23,36 @@ CallbackKey = Enum([
     "SYNC_DROPDOWN",
     "CONFIGURATION_DROPDOWN",
     "SAVE_CONFIGURATION",
-    "TAB_GROUP"
+    "INCLUDE_RULES",
+    "EXCLUDE_RULES",
+    "EXTRA_DESTINATIONS",
+    "TAB_GROUP",
+    "PROGRESS",
+    "PROGRESS_BAR",
+    "PROGRESS_TEXT"
 ])
 
 SyncOptions = {
     "ONE_WAY": "One-way",
     "TWO_WAY": "Two-way",
     "UPDATE": "Update",
+    "SNAPSHOT": "Snapshot",
 }
 
 SettingsKey = Enum([
-    "ENABLE_PURGE"
+    "ENABLE_PURGE",
+    "SCAN_WORKERS",
+    "SYNC_WORKERS",
+    "DELTA_THRESHOLD_MIB",
+    "DEDUPLICATE",
+    "COPY_BUFFER_MIB",
+    "VERIFY_AFTER_SYNC",
+    "VERIFY_ALGORITHM",
+    "REPAIR_MISMATCHES",
+    "MAX_MIB_PER_SECOND",
+    "MAX_OPS_PER_SECOND",
+    "LOW_PRIORITY",
+    "SMALL_FILE_MODE",
+    "SMALL_FILE_WORKERS",
+    "METRICS_TEXTFILE_DIR"
 ])
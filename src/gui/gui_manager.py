@@ -1,43 +1,81 @@
 import PySimpleGUI as sg
+from collections import Counter
 from os.path import exists
-from threading import Thread
+from threading import Semaphore, Thread
+from typing import Optional
 
 from src.file_diff.file_diff_evaluator import FileDiffEvaluator
 from src.file_diff.file_synchronizer import FileSynchronizer
+from src.file_diff.path_filter import PathFilter
 from src.gui.main_layout import MainLayout
 from src.gui.constants import CallbackKey, SettingsKey, SyncOptions
-from src.gui.utilities import gen_treedata
-from src.gui.images import ADD_ICON, REMOVE_ICON
+from src.gui.utilities import LazyTree
+from src.gui.images import ADD_ICON, MODIFIED_ICON, REMOVE_ICON
+from src.metrics.run_metrics import RunMetrics, publish_metrics
+from src.settings.constants import MIB
 from src.settings.settings import GuiSettings
 
+MAX_PENDING_BATCHES = 4  # evaluation batches allowed in the window's event queue at once
+
 
 class GuiManager(object):
     """
     This class handles events from the GUI and runs callback methods based on the event value(s).
     """
-    def __init__(self) -> None:
+    def __init__(self, file_synchronizer: Optional[FileSynchronizer] = None) -> None:
         self.gui_settings = GuiSettings()
         self.gui_settings.load_settings()
 
-        # TODO: pass these as arguments to support daemon service
+        # synchronizer may be shared with a sync daemon running in the same process
+        self.file_synchronizer = file_synchronizer or FileSynchronizer.from_settings(self.gui_settings.gui_settings)
         self.file_diff_evaluator = FileDiffEvaluator(
-            lambda diff: self.emit_event(CallbackKey.EVALUATION_COMPLETE, diff))
-        self.file_synchronizer = FileSynchronizer(self.gui_settings.gui_settings[SettingsKey.ENABLE_PURGE])
+            lambda totals: self.emit_event(CallbackKey.EVALUATION_COMPLETE, totals),
+            self.gui_settings.gui_settings[SettingsKey.SCAN_WORKERS],
+            self.__emit_evaluation_batch, self.file_synchronizer.throttle, self.file_synchronizer.low_priority)
+        self.__batch_slots = Semaphore(MAX_PENDING_BATCHES)
 
         self.window = MainLayout().create_window()
         self.window[CallbackKey.CONFIGURATION_DROPDOWN].update(values=list(self.gui_settings.configurations.keys()))
+        for key in [SettingsKey.SCAN_WORKERS, SettingsKey.SYNC_WORKERS, SettingsKey.DELTA_THRESHOLD_MIB,
+                    SettingsKey.DEDUPLICATE, SettingsKey.COPY_BUFFER_MIB, SettingsKey.VERIFY_AFTER_SYNC,
+                    SettingsKey.VERIFY_ALGORITHM, SettingsKey.REPAIR_MISMATCHES, SettingsKey.MAX_MIB_PER_SECOND,
+                    SettingsKey.MAX_OPS_PER_SECOND, SettingsKey.LOW_PRIORITY, SettingsKey.SMALL_FILE_MODE,
+                    SettingsKey.SMALL_FILE_WORKERS, SettingsKey.METRICS_TEXTFILE_DIR]:
+            self.window[key].update(self.gui_settings.gui_settings[key])
         self.values = {}
 
+        self.source_tree = LazyTree(self.window[CallbackKey.SOURCE_TREE])
+        self.destination_tree = LazyTree(self.window[CallbackKey.DESTINATION_TREE])
+
         self.callbacks = {
             CallbackKey.EVALUATE: self.__evaluate_file_diff,
-            CallbackKey.EVALUATION_COMPLETE: self.__display_file_diff,
+            CallbackKey.EVALUATION_BATCH: self.__display_file_diff_batch,
+            CallbackKey.EVALUATION_COMPLETE: self.__on_evaluation_complete,
+            CallbackKey.PROGRESS: self.__on_progress,
             CallbackKey.SYNCHRONIZE: self.__sync_folders,
+            CallbackKey.SYNC_COMPLETE: self.__on_sync_complete,
+            CallbackKey.CANCEL: self.__cancel_sync,
             CallbackKey.SYNC_DROPDOWN: self.__on_sync_dropdown,
             CallbackKey.CONFIGURATION_DROPDOWN: self.__on_configuration_dropdown,
             CallbackKey.SAVE_CONFIGURATION: self.__on_configuration_save,
             CallbackKey.SOURCE_FOLDER: lambda: self.__evaluate_path_validity(CallbackKey.SOURCE_FOLDER),
             CallbackKey.DESTINATION_FOLDER: lambda: self.__evaluate_path_validity(CallbackKey.DESTINATION_FOLDER),
-            SettingsKey.ENABLE_PURGE: self.__purge_checkbox
+            CallbackKey.EXTRA_DESTINATIONS: self.__update_button_states,
+            SettingsKey.ENABLE_PURGE: self.__purge_checkbox,
+            SettingsKey.SCAN_WORKERS: self.__scan_workers_spin,
+            SettingsKey.SYNC_WORKERS: self.__sync_workers_spin,
+            SettingsKey.DELTA_THRESHOLD_MIB: self.__delta_threshold_spin,
+            SettingsKey.DEDUPLICATE: self.__deduplicate_checkbox,
+            SettingsKey.COPY_BUFFER_MIB: self.__copy_buffer_spin,
+            SettingsKey.VERIFY_AFTER_SYNC: self.__verify_checkbox,
+            SettingsKey.VERIFY_ALGORITHM: self.__verify_algorithm_combo,
+            SettingsKey.REPAIR_MISMATCHES: self.__repair_mismatches_checkbox,
+            SettingsKey.MAX_MIB_PER_SECOND: lambda: self.__throttle_spin(SettingsKey.MAX_MIB_PER_SECOND),
+            SettingsKey.MAX_OPS_PER_SECOND: lambda: self.__throttle_spin(SettingsKey.MAX_OPS_PER_SECOND),
+            SettingsKey.LOW_PRIORITY: self.__low_priority_checkbox,
+            SettingsKey.SMALL_FILE_MODE: self.__small_file_mode_checkbox,
+            SettingsKey.SMALL_FILE_WORKERS: self.__small_file_workers_spin,
+            SettingsKey.METRICS_TEXTFILE_DIR: self.__metrics_textfile_input
         }
 
     def run(self) -> None:
@@ -55,6 +93,7 @@ class GuiManager(object):
                 print(f"Unexpected key: {event}")
 
         self.window.close()
+        self.gui_settings.close()  # write settings changed in the last moments
 
     def emit_event(self, key: str, value: str) -> None:
         """
@@ -65,6 +104,15 @@ class GuiManager(object):
         """
         self.window.write_event_value(key, value)
 
+    def __emit_evaluation_batch(self, batch: list) -> None:
+        """
+        Pass batch of evaluation results to window. Blocks the evaluator while too many batches are pending.
+        :param batch: source-only, destination-only and modified entries, with their sizes from the scan
+        :return: None
+        """
+        self.__batch_slots.acquire()
+        self.emit_event(CallbackKey.EVALUATION_BATCH, batch)
+
     def __has_callback(self, key: str) -> bool:
         """
         Wrapper for existence of key in callback dictionary.
@@ -104,7 +152,8 @@ class GuiManager(object):
         evaluate_button_disabled = not (exists(src) and exists(dst))
         self.window[CallbackKey.EVALUATE].update(disabled=evaluate_button_disabled)
 
-        synchronize_button_disabled = evaluate_button_disabled or sync_style not in SyncOptions.values()
+        synchronize_button_disabled = evaluate_button_disabled or sync_style not in SyncOptions.values() or \
+            not all(exists(folder) for folder in self.__get_extra_destinations())
         self.window[CallbackKey.SYNCHRONIZE].update(disabled=synchronize_button_disabled)
 
     def __on_sync_dropdown(self) -> None:
@@ -126,25 +175,58 @@ class GuiManager(object):
 
         metadata = self.gui_settings.configurations[key]
         src, dst, sync = metadata["src"], metadata["dst"], metadata["sync"]
+        include, exclude = "\n".join(metadata.get("include", [])), "\n".join(metadata.get("exclude", []))
+        extra_destinations = "\n".join(FileSynchronizer.destinations_of(metadata)[1:])
 
         self.values[CallbackKey.SOURCE_FOLDER] = src
         self.values[CallbackKey.DESTINATION_FOLDER] = dst
         self.values[CallbackKey.SYNC_DROPDOWN] = sync
+        self.values[CallbackKey.INCLUDE_RULES] = include
+        self.values[CallbackKey.EXCLUDE_RULES] = exclude
+        self.values[CallbackKey.EXTRA_DESTINATIONS] = extra_destinations
 
         self.window[CallbackKey.SOURCE_FOLDER].update(src)
         self.window[CallbackKey.DESTINATION_FOLDER].update(dst)
         self.window[CallbackKey.SYNC_DROPDOWN].update(sync)
+        self.window[CallbackKey.INCLUDE_RULES].update(include)
+        self.window[CallbackKey.EXCLUDE_RULES].update(exclude)
+        self.window[CallbackKey.EXTRA_DESTINATIONS].update(extra_destinations)
 
         for key in [CallbackKey.SOURCE_FOLDER, CallbackKey.DESTINATION_FOLDER]:
             self.__evaluate_path_validity(key)
 
     def __on_configuration_save(self) -> None:
         """
-        Save configuration to file.
+        Save configuration to file. Only the fields shown in the GUI are replaced, so values set elsewhere, such as
+        throttle limits set with `lockstep throttle`, are kept.
         :return: None
         """
         key = self.values[CallbackKey.CONFIGURATION_DROPDOWN]
-        self.gui_settings.update_configuration(key, dict(zip(["src", "dst", "sync"], self.__get_path_state())))
+        configuration = self.gui_settings.get_configuration(key) or {}
+        configuration.update(zip(["src", "dst", "sync"], self.__get_path_state()))
+        configuration.update(zip(["include", "exclude"], self.__get_filter_rules()))
+        extra_destinations = self.__get_extra_destinations()
+        if extra_destinations:
+            configuration["destinations"] = [configuration["dst"], *extra_destinations]
+        else:
+            configuration.pop("destinations", None)
+        self.gui_settings.update_configuration(key, configuration)
+
+    def __get_filter_rules(self) -> list:
+        """
+        Read include/exclude rules from their fields, skipping blank lines.
+        :return: include rules and exclude rules
+        """
+        return [[line.strip() for line in self.values.get(key, "").splitlines() if line.strip()]
+                for key in [CallbackKey.INCLUDE_RULES, CallbackKey.EXCLUDE_RULES]]
+
+    def __get_extra_destinations(self) -> list:
+        """
+        Read further destination folders from their field, skipping blank lines.
+        :return: list of folders
+        """
+        return [line.strip() for line in self.values.get(CallbackKey.EXTRA_DESTINATIONS, "").splitlines()
+                if line.strip()]
 
     def __evaluate_path_validity(self, key: str) -> None:
         """
@@ -159,28 +241,158 @@ class GuiManager(object):
 
         self.__update_button_states()
 
+    def __get_saved_configuration(self) -> Optional[str]:
+        """
+        Name of the selected configuration, if it has been saved.
+        :return: configuration name or None
+        """
+        configuration = self.values[CallbackKey.CONFIGURATION_DROPDOWN]
+        return configuration if configuration in self.gui_settings.configurations else None
+
+    def __create_metrics(self, kind: str, label: str) -> RunMetrics:
+        """
+        Create metrics for a run that report progress to the window.
+        :param kind: run kind (evaluate, sync)
+        :param label: text shown next to the progress bar
+        :return: run metrics
+        """
+        return RunMetrics(kind, lambda done, total: self.emit_event(CallbackKey.PROGRESS, (label, done, total)))
+
+    def __publish_metrics(self, metrics: RunMetrics, configuration: Optional[str]) -> None:
+        """
+        Write metrics of a finished run.
+        :param metrics: run metrics
+        :param configuration: name of saved configuration, if any
+        :return: None
+        """
+        publish_metrics(metrics, self.gui_settings.gui_settings[SettingsKey.METRICS_TEXTFILE_DIR], configuration)
+
     def __evaluate_file_diff(self) -> None:
         """
-        Run file diff evaluator.
+        Run file diff evaluator. Saved configurations are scanned incrementally from their last manifest.
         :return: None
         """
-        Thread(target=self.file_diff_evaluator.generate_file_diff, args=[*self.__get_path_state()]).start()
+        self.source_tree.clear()
+        self.destination_tree.clear()
+
+        # daemon, since it may be blocked on the batch queue when the window is closed
+        Thread(target=self.__run_evaluation, args=[*self.__get_path_state(), self.__get_saved_configuration(),
+                                                   PathFilter(*self.__get_filter_rules())], daemon=True).start()
 
-    def __display_file_diff(self) -> None:
+    def __run_evaluation(self, src: str, dst: str, sync_style: str, configuration: Optional[str],
+                         path_filter: PathFilter) -> None:
         """
-        Take file diff and transform it into file trees for source and destination folders.
+        Evaluate file diff and publish its metrics. Runs on a worker thread.
+        :param src: source folder
+        :param dst: destination folder
+        :param sync_style: sync style
+        :param configuration: name of saved configuration, if any
+        :param path_filter: include/exclude rules currently entered
         :return: None
         """
-        left, right = self.values[CallbackKey.EVALUATION_COMPLETE]
-        self.window[CallbackKey.SOURCE_TREE].update(gen_treedata(sorted(left), ADD_ICON))
-        self.window[CallbackKey.DESTINATION_TREE].update(gen_treedata(sorted(right), REMOVE_ICON))
+        metrics = self.__create_metrics("evaluate", "Scanning folders")
+        self.file_synchronizer.throttle.watch_limits(lambda: self.gui_settings.throttle_limits(configuration))
+        self.file_diff_evaluator.generate_file_diff(src, dst, sync_style, configuration, metrics, path_filter)
+        self.__publish_metrics(metrics, configuration)
+
+    def __display_file_diff_batch(self) -> None:
+        """
+        Add batch of file diff results to file trees for source and destination folders.
+        Modified files are shown in the source tree, since the source copy is what will be written.
+        :return: None
+        """
+        left, right, modified = self.values[CallbackKey.EVALUATION_BATCH]
+        try:
+            self.source_tree.add(left, ADD_ICON)
+            self.source_tree.add(modified, MODIFIED_ICON)
+            self.destination_tree.add(right, REMOVE_ICON)
+        finally:
+            self.__batch_slots.release()
+
+    def __on_evaluation_complete(self) -> None:
+        """
+        Report totals once all file diff batches have been sent.
+        :return: None
+        """
+        left, right, modified = self.values[CallbackKey.EVALUATION_COMPLETE]
+        print(f"Evaluation complete: {left} source-only, {right} destination-only, {modified} modified")
 
     def __sync_folders(self) -> None:
         """
         Run file sync process.
         :return: None
         """
-        Thread(target=self.file_synchronizer.run_sync, args=[*self.__get_path_state()]).start()
+        self.window[CallbackKey.SYNCHRONIZE].update(disabled=True)
+        self.window[CallbackKey.CANCEL].update(disabled=False)
+        src, dst, sync_style = self.__get_path_state()
+        Thread(target=self.__run_sync, args=[src, [dst, *self.__get_extra_destinations()], sync_style,
+                                             self.__get_saved_configuration(),
+                                             PathFilter(*self.__get_filter_rules())]).start()
+
+    def __run_sync(self, src: str, dsts: list, sync_style: str, configuration: Optional[str],
+                   path_filter: PathFilter) -> None:
+        """
+        Sync folders and publish metrics. Runs on a worker thread.
+        :param src: source folder
+        :param dsts: destination folders
+        :param sync_style: sync style
+        :param configuration: name of saved configuration, if any
+        :param path_filter: include/exclude rules currently entered
+        :return: None
+        """
+        totals = {}
+        try:
+            metrics = self.__create_metrics("sync", "Synchronizing")
+            # limits changed in the settings tab or with `lockstep throttle` apply while the sync runs
+            self.file_synchronizer.throttle.watch_limits(lambda: self.gui_settings.throttle_limits(configuration))
+            results = self.file_synchronizer.run_fan_out(src, dsts, sync_style, metrics=metrics,
+                                                         path_filter=path_filter)
+            self.__publish_metrics(metrics, configuration)
+            totals = Counter()
+            for counts in (results or {}).values():
+                totals.update(counts)
+            totals = dict(totals)
+        except Exception as e:  # e.g. a destination that is missing or not writable
+            print(f"Sync failed: {e}")
+            totals = {"failure": str(e)}
+        finally:
+            # always sent, so the buttons are restored even if the sync failed
+            self.emit_event(CallbackKey.SYNC_COMPLETE, totals)
+
+    def __cancel_sync(self) -> None:
+        """
+        Stop running sync. It resumes where it left off the next time the same folders are synchronized.
+        :return: None
+        """
+        self.window[CallbackKey.CANCEL].update(disabled=True)
+        self.file_synchronizer.cancel()
+
+    def __on_sync_complete(self) -> None:
+        """
+        Restore buttons and report outcome once a sync has finished or stopped.
+        :return: None
+        """
+        results = self.values[CallbackKey.SYNC_COMPLETE]
+        self.window[CallbackKey.CANCEL].update(disabled=True)
+        self.__update_button_states()
+        if results.get("failure"):
+            self.window[CallbackKey.PROGRESS_TEXT].update(f"Sync failed: {results['failure']}")
+        elif self.file_synchronizer.cancelled:
+            self.window[CallbackKey.PROGRESS_TEXT].update(f"Cancelled, {results.get('cancelled', 0)} left to resume")
+        elif results.get("errors"):
+            self.window[CallbackKey.PROGRESS_TEXT].update(f"Synchronized with {results['errors']} errors")
+        elif results.get("mismatches", 0) > results.get("repaired", 0):
+            self.window[CallbackKey.PROGRESS_TEXT].update(
+                f"Synchronized, {results['mismatches'] - results['repaired']} files failed verification")
+
+    def __on_progress(self) -> None:
+        """
+        Update progress bar from a progress report of the running evaluation or sync.
+        :return: None
+        """
+        label, done, total = self.values[CallbackKey.PROGRESS]
+        self.window[CallbackKey.PROGRESS_BAR].update_bar(done, max(total, 1))
+        self.window[CallbackKey.PROGRESS_TEXT].update(f"{label}: {done}/{total}")
 
     def __purge_checkbox(self) -> None:
         """
@@ -190,3 +402,120 @@ class GuiManager(object):
         value = self.values[SettingsKey.ENABLE_PURGE]
         self.gui_settings.update_gui_setting(SettingsKey.ENABLE_PURGE, value)
         self.file_synchronizer.enable_purge = value
+
+    def __scan_workers_spin(self) -> None:
+        """
+        Globally update number of threads used to scan folders.
+        :return: None
+        """
+        value = int(self.values[SettingsKey.SCAN_WORKERS])
+        self.gui_settings.update_gui_setting(SettingsKey.SCAN_WORKERS, value)
+        self.file_diff_evaluator.max_workers = value
+
+    def __sync_workers_spin(self) -> None:
+        """
+        Globally update number of threads used to copy files.
+        :return: None
+        """
+        value = int(self.values[SettingsKey.SYNC_WORKERS])
+        self.gui_settings.update_gui_setting(SettingsKey.SYNC_WORKERS, value)
+        self.file_synchronizer.max_workers = value
+
+    def __delta_threshold_spin(self) -> None:
+        """
+        Globally update minimum size of modified files that are synced by block-level delta.
+        :return: None
+        """
+        value = int(self.values[SettingsKey.DELTA_THRESHOLD_MIB])
+        self.gui_settings.update_gui_setting(SettingsKey.DELTA_THRESHOLD_MIB, value)
+        self.file_synchronizer.delta_threshold = value * MIB
+
+    def __deduplicate_checkbox(self) -> None:
+        """
+        Globally update whether identical files are linked instead of copied.
+        :return: None
+        """
+        value = self.values[SettingsKey.DEDUPLICATE]
+        self.gui_settings.update_gui_setting(SettingsKey.DEDUPLICATE, value)
+        self.file_synchronizer.deduplicate = value
+
+    def __copy_buffer_spin(self) -> None:
+        """
+        Globally update size of each read and write when copying files.
+        :return: None
+        """
+        value = int(self.values[SettingsKey.COPY_BUFFER_MIB])
+        self.gui_settings.update_gui_setting(SettingsKey.COPY_BUFFER_MIB, value)
+        self.file_synchronizer.copy_buffer_size = value * MIB
+
+    def __verify_checkbox(self) -> None:
+        """
+        Globally update whether written files are verified after each sync.
+        :return: None
+        """
+        value = self.values[SettingsKey.VERIFY_AFTER_SYNC]
+        self.gui_settings.update_gui_setting(SettingsKey.VERIFY_AFTER_SYNC, value)
+        self.file_synchronizer.verify = value
+
+    def __verify_algorithm_combo(self) -> None:
+        """
+        Globally update hash algorithm used for verification.
+        :return: None
+        """
+        value = self.values[SettingsKey.VERIFY_ALGORITHM]
+        self.gui_settings.update_gui_setting(SettingsKey.VERIFY_ALGORITHM, value)
+        self.file_synchronizer.verify_algorithm = value
+
+    def __repair_mismatches_checkbox(self) -> None:
+        """
+        Globally update whether files that fail verification are copied again.
+        :return: None
+        """
+        value = self.values[SettingsKey.REPAIR_MISMATCHES]
+        self.gui_settings.update_gui_setting(SettingsKey.REPAIR_MISMATCHES, value)
+        self.file_synchronizer.repair_mismatches = value
+
+    def __throttle_spin(self, key: str) -> None:
+        """
+        Globally update a throttle limit. A running sync picks it up within seconds, unless its configuration has a
+        limit of its own.
+        :param key: SettingsKey of the limit
+        :return: None
+        """
+        self.gui_settings.update_gui_setting(key, int(self.values[key]))
+
+    def __low_priority_checkbox(self) -> None:
+        """
+        Globally update whether scans and copies run at low I/O and CPU priority.
+        :return: None
+        """
+        value = self.values[SettingsKey.LOW_PRIORITY]
+        self.gui_settings.update_gui_setting(SettingsKey.LOW_PRIORITY, value)
+        self.file_synchronizer.low_priority = value
+        self.file_diff_evaluator.low_priority = value
+
+    def __small_file_mode_checkbox(self) -> None:
+        """
+        Globally update whether small files are copied in inode order on a pool of their own.
+        :return: None
+        """
+        value = self.values[SettingsKey.SMALL_FILE_MODE]
+        self.gui_settings.update_gui_setting(SettingsKey.SMALL_FILE_MODE, value)
+        self.file_synchronizer.small_file_mode = value
+
+    def __small_file_workers_spin(self) -> None:
+        """
+        Globally update number of parallel small file copy workers.
+        :return: None
+        """
+        value = int(self.values[SettingsKey.SMALL_FILE_WORKERS])
+        self.gui_settings.update_gui_setting(SettingsKey.SMALL_FILE_WORKERS, value)
+        self.file_synchronizer.small_file_workers = value
+
+    def __metrics_textfile_input(self) -> None:
+        """
+        Globally update folder that Prometheus textfiles are written to.
+        :return: None
+        """
+        value = self.values[SettingsKey.METRICS_TEXTFILE_DIR].strip()
+        self.gui_settings.update_gui_setting(SettingsKey.METRICS_TEXTFILE_DIR, value)
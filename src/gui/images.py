@@ -15,3 +15,4 @@ def load_image(path: str) -> bytes:
 LOCK_ICON = load_image("res/png/lock.png")
 ADD_ICON = load_image("res/png/add.png")
 REMOVE_ICON = load_image("res/png/remove.png")
+MODIFIED_ICON = load_image("res/png/modified.png")
@@ -1,7 +1,9 @@
 import PySimpleGUI as sg
+import sys
 
 from src.gui.constants import CallbackKey, SettingsKey, SyncOptions
 from src.gui.images import LOCK_ICON
+from src.settings.constants import VERIFY_ALGORITHMS
 
 
 class MainLayout(object):
@@ -20,6 +22,9 @@ class MainLayout(object):
         See: https://stackoverflow.com/a/1552105
         :return: None
         """
+        if sys.platform != "win32":
+            return
+
         import ctypes
         ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID('arbitrary string')
 
@@ -63,6 +68,34 @@ class MainLayout(object):
 
         return sg.Column(components, element_justification='c', expand_x=True)
 
+    @staticmethod
+    def __create_filter_rules() -> sg.Column:
+        """
+        Creates include/exclude rule fields that are saved with each configuration.
+        :return: column wrapper of rule fields
+        """
+        components = [[
+            sg.T('Include (globs, one per line):'),
+            sg.Multiline(k=CallbackKey.INCLUDE_RULES, size=(30, 3)),
+            sg.T('Exclude (gitignore syntax):'),
+            sg.Multiline(k=CallbackKey.EXCLUDE_RULES, size=(30, 3))
+        ]]
+
+        return sg.Column(components, element_justification='c', expand_x=True)
+
+    @staticmethod
+    def __create_extra_destinations() -> sg.Column:
+        """
+        Creates field for further destination folders that are synced from the same source in one pass.
+        :return: column wrapper of destination field
+        """
+        components = [[
+            sg.T('Also synchronize to (folders, one per line):'),
+            sg.Multiline(k=CallbackKey.EXTRA_DESTINATIONS, size=(60, 2), enable_events=True)
+        ]]
+
+        return sg.Column(components, element_justification='c', expand_x=True)
+
     @staticmethod
     def __create_file_panel(direction: str, tree_key: str, input_key: str) -> sg.Column:
         """
@@ -74,8 +107,8 @@ class MainLayout(object):
         """
         components = [
             [sg.T(f"{direction}:"), sg.I(size=35, enable_events=True, k=input_key), sg.FolderBrowse(k=direction)],
-            [sg.Tree(data=sg.TreeData(), k=tree_key, headings=[""], visible_column_map=[False], expand_x=True,
-                     expand_y=True)]
+            [sg.Tree(data=sg.TreeData(), k=tree_key, headings=["Size"], col_widths=[18], auto_size_columns=False,
+                     expand_x=True, expand_y=True)]
         ]
 
         return sg.Column(components, element_justification='c', expand_x=True, expand_y=True)
@@ -83,15 +116,20 @@ class MainLayout(object):
     @staticmethod
     def __create_bottom_buttons() -> sg.Column:
         """
-        Creates evaluate/sync/exit buttons at bottom of GUI.
+        Creates progress bar and evaluate/sync/cancel/exit buttons at bottom of GUI.
         :return: column wrapper for buttons
         """
         button_pairs = [
             ("Evaluate", CallbackKey.EVALUATE, True),
             ("Synchronize...", CallbackKey.SYNCHRONIZE, True),
+            ("Cancel", CallbackKey.CANCEL, True),
             ('Exit', 'Exit', False)
         ]
-        components = [[sg.B(x, k=key, disabled=disabled) for (x, key, disabled) in button_pairs]]
+        components = [
+            [sg.ProgressBar(1, orientation="h", size=(40, 15), k=CallbackKey.PROGRESS_BAR),
+             sg.T("", size=(30, 1), k=CallbackKey.PROGRESS_TEXT)],
+            [sg.B(x, k=key, disabled=disabled) for (x, key, disabled) in button_pairs]
+        ]
         return sg.Column(components, element_justification='c', expand_x=True)
 
     def __create_sync_tab(self) -> sg.Tab:
@@ -101,6 +139,7 @@ class MainLayout(object):
         """
         return sg.Tab("Synchronize", [
             [self.__create_configuration_dropdown()],
+            [self.__create_filter_rules()],
             [sg.Pane(
                 [
                     self.__create_file_panel("Source", CallbackKey.SOURCE_TREE, CallbackKey.SOURCE_FOLDER),
@@ -111,6 +150,7 @@ class MainLayout(object):
                 expand_x=True,
                 expand_y=True
             )],
+            [self.__create_extra_destinations()],
             [self.__create_sync_method_dropdown()],
             [self.__create_bottom_buttons()]
         ])
@@ -122,7 +162,40 @@ class MainLayout(object):
         :return: tab wrapper for GUI settings
         """
         return sg.Tab("Settings", [
-            [sg.Checkbox("Enable file purge on sync", k=SettingsKey.ENABLE_PURGE, enable_events=True, pad=(10, 10))]
+            [sg.Checkbox("Enable file purge on sync", k=SettingsKey.ENABLE_PURGE, enable_events=True, pad=(10, 10))],
+            [sg.Checkbox("Link identical files instead of copying them again", k=SettingsKey.DEDUPLICATE,
+                         enable_events=True, pad=(10, 10))],
+            [sg.T("Folder scan threads:", pad=(10, 10)),
+             sg.Spin(list(range(1, 65)), k=SettingsKey.SCAN_WORKERS, size=5, enable_events=True, readonly=True)],
+            [sg.T("File copy threads:", pad=(10, 10)),
+             sg.Spin(list(range(1, 65)), k=SettingsKey.SYNC_WORKERS, size=5, enable_events=True, readonly=True)],
+            [sg.Checkbox("Small-file mode, with small file copy threads:", k=SettingsKey.SMALL_FILE_MODE,
+                         enable_events=True, pad=(10, 10)),
+             sg.Spin(list(range(1, 257)), k=SettingsKey.SMALL_FILE_WORKERS, size=5, enable_events=True,
+                     readonly=True)],
+            [sg.T("Delta transfer for modified files from (MiB):", pad=(10, 10)),
+             sg.Spin([2 ** i for i in range(16)], k=SettingsKey.DELTA_THRESHOLD_MIB, size=7, enable_events=True,
+                     readonly=True)],
+            [sg.T("Copy buffer size (MiB):", pad=(10, 10)),
+             sg.Spin([2 ** i for i in range(10)], k=SettingsKey.COPY_BUFFER_MIB, size=7, enable_events=True,
+                     readonly=True)],
+            [sg.T("Limit transfers to (MiB/s, 0 = unlimited):", pad=(10, 10)),
+             sg.Spin([0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000], k=SettingsKey.MAX_MIB_PER_SECOND,
+                     size=7, enable_events=True, readonly=True),
+             sg.T("Limit file operations to (per second, 0 = unlimited):"),
+             sg.Spin([0, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000], k=SettingsKey.MAX_OPS_PER_SECOND,
+                     size=7, enable_events=True, readonly=True)],
+            [sg.Checkbox("Run scans and copies at low priority (idle I/O, lower CPU priority)",
+                         k=SettingsKey.LOW_PRIORITY, enable_events=True, pad=(10, 10))],
+            [sg.Checkbox("Verify files after sync with", k=SettingsKey.VERIFY_AFTER_SYNC, enable_events=True,
+                         pad=(10, 10)),
+             sg.Combo(VERIFY_ALGORITHMS, k=SettingsKey.VERIFY_ALGORITHM, size=(10, 1), enable_events=True,
+                      readonly=True),
+             sg.Checkbox("Copy files that fail verification again", k=SettingsKey.REPAIR_MISMATCHES,
+                         enable_events=True)],
+            [sg.T("Prometheus textfile folder (optional):", pad=(10, 10)),
+             sg.I(size=35, k=SettingsKey.METRICS_TEXTFILE_DIR, enable_events=True),
+             sg.FolderBrowse(target=SettingsKey.METRICS_TEXTFILE_DIR)]
         ])
 
     def __create_layout(self) -> list:
@@ -0,0 +1,171 @@
+from typing import Optional
+
+# prefixes for displaying aggregate sizes, in steps of 1024
+SIZE_UNITS = ["B", "KiB", "MiB", "GiB", "TiB", "PiB"]
+
+
+def format_size(size: int) -> str:
+    """
+    Human-readable byte count.
+    :param size: number of bytes
+    :return: formatted size, e.g. 1.5 MiB
+    """
+    value = float(size)
+    for unit in SIZE_UNITS:
+        if value < 1024 or unit == SIZE_UNITS[-1]:
+            return f"{int(value)} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
+
+def split_path(path: str) -> list:
+    """
+    Split path into trie components. The leading separator of an absolute path stays on the first component,
+    so "/tmp/a" gives ["/tmp", "a"] and "C:/a" gives ["C:", "a"].
+    :param path: path with forward slashes
+    :return: list of components
+    """
+    parts = path.split("/")
+    if not parts[0] and len(parts) > 1:
+        parts[1] = "/" + parts[1]
+        del parts[0]
+    return parts
+
+
+def join_key(parent_key: str, name: str) -> str:
+    """
+    Key of a child node, matching the path prefix it stands for.
+    :param parent_key: key of parent ("" for the root)
+    :param name: child component
+    :return: child key
+    """
+    return f"{parent_key}/{name}" if parent_key else name
+
+
+class TreeNode(object):
+    """
+    Node of a PathTrie. Folders have a children dictionary, files don't.
+    Count and size are aggregated over all files below a folder.
+    """
+    __slots__ = ("children", "count", "size", "icon", "item", "populated")
+
+    def __init__(self, is_folder: bool) -> None:
+        self.children = {} if is_folder else None
+        self.count = 0
+        self.size = 0
+        self.icon = None
+        self.item = None  # ID of the widget item displaying this node, once it has been displayed
+        self.populated = False  # whether children have been added to the widget
+
+    @property
+    def is_folder(self) -> bool:
+        """
+        Getter for whether node is a folder.
+        :return: True for folders
+        """
+        return self.children is not None
+
+
+class PathTrie(object):
+    """
+    This class stores file paths as a tree of path components, with file counts and sizes summed up per folder.
+    Each path is added in time linear in its length: ancestors are found by walking down from the root (or reused
+    from the previous path in the same folder), and no prefix strings are built. Keys are only derived for nodes
+    that are actually displayed.
+    """
+    def __init__(self) -> None:
+        self.root = TreeNode(is_folder=True)
+        self.__last_folder = None
+        self.__last_trail = []
+
+    def __descend(self, folders: list) -> list:
+        """
+        Find (or create) folder nodes along a path.
+        :param folders: path components of a folder
+        :return: nodes from the root down to the folder, as (name, node) pairs
+        """
+        node = self.root
+        trail = [("", node)]
+        for name in folders:
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = TreeNode(is_folder=True)
+            elif child.children is None:
+                child.children = {}  # listed as a file before, e.g. a folder that only exists on one side
+            node = child
+            trail.append((name, node))
+        return trail
+
+    def insert(self, path: str, icon: Optional[bytes] = None, size: int = 0) -> list:
+        """
+        Add file and any missing parent folders.
+        :param path: file path with forward slashes
+        :param icon: icon to display the file with
+        :param size: file size in bytes
+        :return: nodes from the root down to the file, as (name, node) pairs
+        """
+        folder, _, name = path.rpartition("/")
+        if folder != self.__last_folder or not folder:
+            # paths arrive grouped by directory, so the parent is usually the one found for the previous path
+            parts = split_path(path)
+            name = parts.pop()
+            self.__last_folder = folder
+            self.__last_trail = self.__descend(parts)
+        return self.__add_file(name, icon, size)
+
+    def insert_parts(self, folders: tuple, name: str, icon: Optional[bytes] = None, size: int = 0) -> list:
+        """
+        Add file given as path components, e.g. from a ScanResult, so no path string is built or split.
+        :param folders: components of the file's folder, as yielded by ScanResult.iter_parts
+        :param name: file name
+        :param icon: icon to display the file with
+        :param size: file size in bytes
+        :return: nodes from the root down to the file, as (name, node) pairs
+        """
+        if folders is not self.__last_folder:
+            self.__last_folder = folders
+            self.__last_trail = self.__descend(folders)
+        return self.__add_file(name, icon, size)
+
+    def __add_file(self, name: str, icon: Optional[bytes], size: int) -> list:
+        """
+        Add file to the folder found last and count it in all of its ancestors.
+        :param name: file name
+        :param icon: icon to display the file with
+        :param size: file size in bytes
+        :return: nodes from the root down to the file, as (name, node) pairs
+        """
+        parent = self.__last_trail[-1][1]
+        node = parent.children.get(name)
+        created = node is None
+        if created:
+            node = parent.children[name] = TreeNode(is_folder=False)
+        trail = self.__last_trail + [(name, node)]
+
+        if created:  # the same path reported twice is only counted once
+            for _, ancestor in trail:
+                ancestor.count += 1
+                ancestor.size += size
+        node.icon = icon
+        return trail
+
+    def __len__(self) -> int:
+        """
+        Number of files in trie.
+        :return: file count
+        """
+        return self.root.count
+
+    def walk(self):
+        """
+        Visit every node, parents before their children and siblings in sorted order.
+        :return: iterator of (parent key, key, name, node)
+        """
+        pending = [("", self.root)]
+        while pending:
+            parent_key, parent = pending.pop()
+            for name in sorted(parent.children):
+                child = parent.children[name]
+                key = join_key(parent_key, name)
+                if child.is_folder:
+                    pending.append((key, child))
+                yield parent_key, key, name, child
@@ -1,34 +1,143 @@
 import PySimpleGUI as sg
-from os.path import dirname, basename
+import tkinter as tk
+from os.path import normpath
 
+from src.file_diff.scan_result import ScanResult
+from src.gui.path_trie import PathTrie, TreeNode, format_size, join_key, split_path
 
-def gen_treedata(data: list, icon: bytes) -> sg.TreeData:
+
+def gen_treedata(data: list, icon: bytes, treedata: sg.TreeData = None) -> sg.TreeData:
     """
     Transforms folder delta into file tree that is displayed in GUI.
     :param data: list of files
     :param icon: icon to represent direction of file movement
+    :param treedata: existing tree to add files to, if any
     :return: PySimpleGUI tree data structure
     """
-    treedata = sg.TreeData()
+    if treedata is None:
+        treedata = sg.TreeData()
 
+    trie = PathTrie()
     for path in data:
-        parent_folder = dirname(path)
-        folders = parent_folder.split("/")
-        filename = basename(path)
+        trie.insert(path, icon)
 
-        # iteratively add parent folders as keys to tree, if necessary
-        for i, folder in enumerate(folders):
-            parent = "/".join(folders[:i])
-            if not parent:
-                parent = ''
+    # parents are visited before their children, so every parent key already exists when a node is inserted
+    for parent_key, key, name, node in trie.walk():
+        if key not in treedata.tree_dict:
+            treedata.insert(parent_key, key, name.lstrip("/"), values=[], icon=None if node.is_folder else icon)
 
-            curr = "/".join(folders[:i + 1])
-            val = folders[i]
-            if curr not in treedata.tree_dict:
-                treedata.insert(parent, curr, val, values=[])
+    return treedata
 
-        # insert file into tree
-        treedata.insert(parent_folder, path, filename, values=[], icon=icon)
 
-    return treedata
+class LazyTree(object):
+    """
+    Displays file paths in a tree element without inserting every node into the Tkinter treeview up front.
+    Paths are collected in a PathTrie; a folder's children are only added to the widget when it is expanded, in
+    sorted order. Folders show the number and total size of files below them, so collapsed folders stay informative.
+    """
+    def __init__(self, tree: sg.Tree) -> None:
+        self.__tree = tree
+        self.__photos = {}  # Tkinter drops images that aren't referenced from Python
+        self.__trie = PathTrie()
+        self.__nodes = {}  # widget item ID -> displayed node
+        self.__root_parts = {}  # scan root -> its path components
+        self.__reset()
+        tree.Widget.bind("<<TreeviewOpen>>", self.__on_open, add="+")
+
+    def clear(self) -> None:
+        """
+        Remove all nodes from tree.
+        :return: None
+        """
+        self.__tree.update(values=sg.TreeData())
+        self.__reset()
+
+    def add(self, entries: ScanResult, icon: bytes) -> None:
+        """
+        Add scan results to tree. Only nodes below already expanded folders are inserted into the widget.
+        Entries are inserted by path component, below the components of their root, without building path strings.
+        :param entries: source-only, destination-only or modified entries
+        :param icon: icon to represent direction of file movement
+        :return: None
+        """
+        root_parts = self.__root_parts.get(entries.root)
+        if root_parts is None:
+            # forward slashes, since PySimpleGUI doesn't appear to handle escaping backslashes cleanly
+            root_parts = self.__root_parts[entries.root] = tuple(split_path(normpath(entries.root).replace("\\", "/")))
+
+        changed = {}  # item ID -> displayed folder whose totals changed
+        for folders, name, _, size in entries.iter_parts(root_parts):
+            trail = self.__trie.insert_parts(folders, name, icon, size)
+            for (_, parent), (name, node) in zip(trail, trail[1:]):
+                if node.item is None:
+                    if not parent.populated:
+                        break  # hidden inside a collapsed folder
+                    self.__show(parent, name, node)
+                if node.is_folder:
+                    changed[node.item] = node
+
+        for node in changed.values():
+            self.__tree.Widget.item(node.item, values=[self.__describe(node)])
+
+    def __reset(self) -> None:
+        """
+        Start over with an empty trie whose root is the (always expanded) root of the widget.
+        :return: None
+        """
+        self.__trie = PathTrie()
+        self.__trie.root.item = ""
+        self.__trie.root.populated = True
+        self.__nodes = {"": self.__trie.root}
+
+    def __on_open(self, event: tk.Event) -> None:
+        """
+        Insert children of a folder the first time it is expanded.
+        :param event: Tkinter event
+        :return: None
+        """
+        node = self.__nodes.get(self.__tree.Widget.focus())
+        if node is None or node.populated:
+            return
+
+        widget = self.__tree.Widget
+        widget.delete(*widget.get_children(node.item))  # placeholder
+        node.populated = True
+        for name in sorted(node.children):
+            self.__show(node, name, node.children[name])
+
+    def __show(self, parent: TreeNode, name: str, node: TreeNode) -> None:
+        """
+        Insert single node into widget under its (displayed) parent.
+        Folders get an empty placeholder child, so they can be expanded before their children are inserted.
+        :param parent: parent node
+        :param name: path component of node
+        :param node: node to display
+        :return: None
+        """
+        options = {}
+        if node.icon and not node.is_folder:
+            if node.icon not in self.__photos:
+                self.__photos[node.icon] = tk.PhotoImage(data=node.icon)
+            options["image"] = self.__photos[node.icon]
+
+        key = join_key(self.__tree.IdToKey[parent.item], name)
+        widget = self.__tree.Widget
+        node.item = widget.insert(parent.item, "end", text=name.lstrip("/"), values=[self.__describe(node)],
+                                  **options)
+        if node.is_folder:
+            widget.insert(node.item, "end", text="")
+
+        self.__nodes[node.item] = node
+        self.__tree.IdToKey[node.item] = key
+        self.__tree.KeyToID[key] = node.item
 
+    @staticmethod
+    def __describe(node: TreeNode) -> str:
+        """
+        Text for the size column of a node.
+        :param node: trie node
+        :return: file size, or file count and total size for folders
+        """
+        if node.is_folder:
+            return f"{node.count} files, {format_size(node.size)}"
+        return format_size(node.size)
@@ -1,7 +1,12 @@
-from src.gui.gui_manager import GuiManager
+import sys
 
 
 def main() -> None:
+    if len(sys.argv) > 1:
+        from src.cli import main as cli_main  # headless; never imports GUI modules
+        sys.exit(cli_main(sys.argv[1:]))
+
+    from src.gui.gui_manager import GuiManager
     GuiManager().run()
 
 
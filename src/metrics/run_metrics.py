@@ -0,0 +1,224 @@
+from collections import Counter
+from contextlib import contextmanager
+from os import chmod, makedirs, replace
+from os.path import dirname, join
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import monotonic, perf_counter, time
+from typing import Callable, Optional
+from urllib.parse import quote
+import json
+
+from src.gui.constants import Enum
+from src.settings.constants import LOCKSTEP_FOLDER
+
+MetricPhase = Enum([
+    "SCAN",
+    "COMPARE",
+    "PLAN",
+    "COPY",
+    "MOVE",
+    "DELETE",
+    "VERIFY"
+])
+
+MetricCounter = Enum([
+    "DIRS_LISTED",
+    "STAT_CALLS",
+    "FILES_HASHED",
+    "BYTES_COPIED",
+    "MISMATCHES",
+    "ERRORS"
+])
+
+# JSON summary of the most recent run of each kind
+METRICS_FOLDER = join(LOCKSTEP_FOLDER, "metrics")
+
+# progress callbacks are rate-limited to this many seconds apart, so the GUI's event queue isn't flooded
+DEFAULT_PROGRESS_INTERVAL = 0.2
+
+
+class RunMetrics(object):
+    """
+    This class collects timings and counters for one evaluate or sync run. Safe to update from worker threads.
+    Phase timings add up the time spent inside each phase; phases that run on several threads at once (compare)
+    therefore report thread time rather than wall time.
+    Progress is tracked as done/total units of work, where the total may grow while the run discovers more work.
+    """
+    def __init__(self, kind: str, progress_callback: Optional[Callable] = None,
+                 progress_interval: float = DEFAULT_PROGRESS_INTERVAL) -> None:
+        self.kind = kind
+        self.__progress_callback = progress_callback  # called with (done, total)
+        self.__progress_interval = progress_interval
+        self.__started = time()
+        self.__start = perf_counter()
+        self.__elapsed = None
+        self.__phases = Counter()  # MetricPhase -> seconds
+        self.__counters = Counter()  # MetricCounter -> value
+        self.__done, self.__total = 0, 0
+        self.__last_progress = 0.0
+        self.__lock = Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Time the enclosed block and add it to a phase.
+        :param name: MetricPhase value
+        :return: None
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            with self.__lock:
+                self.__phases[name] += seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        """
+        Increase counter.
+        :param name: MetricCounter value
+        :param value: amount to add
+        :return: None
+        """
+        with self.__lock:
+            self.__counters[name] += value
+
+    def add_total(self, units: int) -> None:
+        """
+        Add work that was discovered while running.
+        :param units: units of work
+        :return: None
+        """
+        with self.__lock:
+            self.__total += units
+
+    def advance(self, units: int = 1) -> None:
+        """
+        Mark work as done, and report progress if the last report is long enough ago.
+        :param units: units of work
+        :return: None
+        """
+        now = monotonic()
+        with self.__lock:
+            self.__done += units
+            due = self.__progress_callback is not None and now - self.__last_progress >= self.__progress_interval
+            if due:
+                self.__last_progress = now
+            progress = self.__done, self.__total
+
+        if due:
+            self.__progress_callback(*progress)
+
+    def finish(self) -> None:
+        """
+        Stop the clock and send a final progress report.
+        :return: None
+        """
+        with self.__lock:
+            self.__elapsed = perf_counter() - self.__start
+            progress = self.__done, self.__total
+        if self.__progress_callback is not None:
+            self.__progress_callback(*progress)
+
+    def summary(self) -> dict:
+        """
+        Collected metrics as a JSON-compatible dictionary.
+        :return: summary dictionary
+        """
+        with self.__lock:
+            elapsed = self.__elapsed if self.__elapsed is not None else perf_counter() - self.__start
+            return {
+                "kind": self.kind,
+                "started": round(self.__started, 3),
+                "elapsed": round(elapsed, 4),
+                "phases": {name.lower(): round(self.__phases[name], 4) for name in sorted(MetricPhase)},
+                "counters": {name.lower(): self.__counters[name] for name in sorted(MetricCounter)},
+                "progress": {"done": self.__done, "total": self.__total}
+            }
+
+    def write_json(self, filename: str) -> None:
+        """
+        Write summary to file, replacing it atomically.
+        :param filename: JSON file
+        :return: None
+        """
+        self.__write_atomic(filename, json.dumps(self.summary(), indent=4) + "\n")
+
+    def write_prometheus(self, filename: str, labels: Optional[dict] = None) -> None:
+        """
+        Write summary in the Prometheus text format, for the node exporter's textfile collector.
+        The file is replaced atomically, so the exporter never reads a partial file.
+        :param filename: .prom file
+        :param labels: extra labels for every sample, e.g. the configuration name
+        :return: None
+        """
+        summary = self.summary()
+        prefix = f"lockstep_{self.kind}"
+        labels = labels or {}
+
+        families = [
+            ("last_run_timestamp_seconds", "Start time of the last run.", [({}, summary["started"])]),
+            ("duration_seconds", "Wall time of the last run.", [({}, summary["elapsed"])]),
+            ("phase_seconds", "Time spent per phase in the last run.",
+             [({"phase": name}, seconds) for name, seconds in summary["phases"].items()])
+        ]
+        families.extend((name, f"{name.replace('_', ' ').capitalize()} in the last run.", [({}, value)])
+                        for name, value in summary["counters"].items())
+
+        lines = []
+        for name, help_text, samples in families:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for extra, value in samples:
+                lines.append(f"{prefix}_{name}{self.__format_labels({**labels, **extra})} {value}")
+
+        self.__write_atomic(filename, "\n".join(lines) + "\n")
+
+    @staticmethod
+    def __format_labels(labels: dict) -> str:
+        """
+        Render label set, escaping values as the text format requires.
+        :param labels: label name -> value
+        :return: label string, empty if there are no labels
+        """
+        if not labels:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+                   for value in labels.values())
+        return "{" + ",".join(f"{name}=\"{value}\"" for name, value in zip(labels, escaped)) + "}"
+
+    @staticmethod
+    def __write_atomic(filename: str, text: str) -> None:
+        """
+        Write file through a temporary file in the same folder.
+        :param filename: target file
+        :param text: contents
+        :return: None
+        """
+        folder = dirname(filename) or "."
+        makedirs(folder, exist_ok=True)
+        with NamedTemporaryFile("w", dir=folder, prefix=".tmp-", delete=False) as f:
+            f.write(text)
+        chmod(f.name, 0o644)  # temporary files are private, but the exporter may run as another user
+        replace(f.name, filename)
+
+
+def publish_metrics(metrics: RunMetrics, textfile_dir: str = "", configuration: Optional[str] = None) -> None:
+    """
+    Finish a run and write its metrics: JSON summary to ~/.lockstep/metrics, and a Prometheus textfile if a folder
+    for the node exporter is configured. Failing to write metrics never fails the run itself.
+    :param metrics: metrics of a run
+    :param textfile_dir: node exporter textfile collector folder, empty to skip
+    :param configuration: name of saved configuration, if any
+    :return: None
+    """
+    metrics.finish()
+    suffix = f"_{quote(configuration, safe='')}" if configuration else ""
+    try:
+        metrics.write_json(join(METRICS_FOLDER, f"{metrics.kind}{suffix}.json"))
+        if textfile_dir:
+            labels = {"configuration": configuration} if configuration else {}
+            metrics.write_prometheus(join(textfile_dir, f"lockstep_{metrics.kind}{suffix}.prom"), labels)
+    except OSError as e:
+        print(f"Unable to write metrics: {e}")
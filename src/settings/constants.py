@@ -0,0 +1,27 @@
+from os import cpu_count
+from os.path import expanduser, join
+
+LOCKSTEP_FOLDER = join(expanduser("~"), ".lockstep")  # local data folder shared by settings and caches
+
+MIB = 1024 * 1024
+
+# defaults of the sync engine, kept here so the settings can offer them without importing it
+
+# largest chunk handed to the kernel per call; also the userspace buffer size, unless configured otherwise
+COPY_CHUNK_SIZE = 16 * MIB
+
+# files smaller than this are cheaper to copy outright than to diff
+DEFAULT_DELTA_THRESHOLD = 64 * MIB
+
+# copies are mostly waiting on disk, so a handful of streams keeps the device queue busy
+DEFAULT_COPY_WORKERS = 4
+
+# small copies are dominated by metadata operations (open, create, utime, rename), which many threads can overlap
+DEFAULT_SMALL_FILE_WORKERS = 32
+
+# offered in the settings; all are guaranteed by hashlib and produce fixed-size digests
+VERIFY_ALGORITHMS = ["blake2b", "sha256", "sha512", "sha1", "md5"]
+DEFAULT_VERIFY_ALGORITHM = "blake2b"
+
+# mirrors the default of ThreadPoolExecutor; listing is I/O bound, so more threads than cores is fine
+DEFAULT_MAX_WORKERS = min(32, (cpu_count() or 1) + 4)
@@ -1,54 +1,75 @@
-from os.path import expanduser, exists, join
-from os import makedirs
-from typing import Any
-import json
+from typing import Any, Optional
 
 from src.gui.constants import SettingsKey
+from src.settings.constants import COPY_CHUNK_SIZE, DEFAULT_COPY_WORKERS, DEFAULT_DELTA_THRESHOLD, DEFAULT_MAX_WORKERS, \
+    DEFAULT_SMALL_FILE_WORKERS, DEFAULT_VERIFY_ALGORITHM, LOCKSTEP_FOLDER, MIB
+from src.settings.settings_store import SettingsStore
 
 
 class GuiSettings(object):
     """
-    This class is responsible for reading/writing GUI settings from/to disk.
+    This class is responsible for reading/writing GUI settings and configurations from/to disk.
+    Storage is shared with other Lockstep processes; see SettingsStore.
     """
-    def __init__(self) -> None:
-        self.base_folder = join(expanduser("~"), ".lockstep")
-        self.settings_file = join(self.base_folder, "settings.json")
-        self.configurations_file = join(self.base_folder, "configurations.json")
+    def __init__(self, store: Optional[SettingsStore] = None) -> None:
+        self.base_folder = LOCKSTEP_FOLDER
+        self.__store = store if store is not None else SettingsStore()
 
-        self.__gui_settings = {SettingsKey.ENABLE_PURGE: False}
+        self.__gui_settings = {
+            SettingsKey.ENABLE_PURGE: False,
+            SettingsKey.SCAN_WORKERS: DEFAULT_MAX_WORKERS,
+            SettingsKey.SYNC_WORKERS: DEFAULT_COPY_WORKERS,
+            SettingsKey.DELTA_THRESHOLD_MIB: DEFAULT_DELTA_THRESHOLD // MIB,
+            SettingsKey.DEDUPLICATE: False,
+            SettingsKey.COPY_BUFFER_MIB: COPY_CHUNK_SIZE // MIB,
+            SettingsKey.VERIFY_AFTER_SYNC: False,
+            SettingsKey.VERIFY_ALGORITHM: DEFAULT_VERIFY_ALGORITHM,
+            SettingsKey.REPAIR_MISMATCHES: False,
+            SettingsKey.MAX_MIB_PER_SECOND: 0,  # 0 is unlimited; configurations may set their own limits
+            SettingsKey.MAX_OPS_PER_SECOND: 0,
+            SettingsKey.LOW_PRIORITY: False,
+            SettingsKey.SMALL_FILE_MODE: False,
+            SettingsKey.SMALL_FILE_WORKERS: DEFAULT_SMALL_FILE_WORKERS,
+            SettingsKey.METRICS_TEXTFILE_DIR: ""  # node exporter textfile collector folder; empty disables it
+        }
         self.__configurations = {}
 
     def load_settings(self) -> None:
         """
-        Read GUI settings/configurations from file, if possible.
+        Read GUI settings/configurations from disk.
         :return: None
         """
-        if not exists(self.base_folder):
-            makedirs(self.base_folder)
-
-        if not exists(self.settings_file):
-            self.__save_to_file(self.settings_file, self.gui_settings)
-        else:
-            with open(self.settings_file, "r") as sf:
-                self.gui_settings = json.load(sf)
-
-        if exists(self.configurations_file):
-            with open(self.configurations_file, "r") as sf:
-                self.configurations = json.load(sf)
+        # keep defaults for keys that were never saved
+        self.gui_settings = {**self.gui_settings, **self.__store.get_settings()}
+        self.configurations = self.__store.get_configurations()
 
         print(f"GUI settings are: {self.gui_settings}")
         print(f"Configurations are: {self.configurations}")
 
-    @staticmethod
-    def __save_to_file(filename: str, data: dict) -> None:
+    def load_gui_settings(self) -> None:
         """
-        Write dictionary to file.
-        :param filename: filename
-        :param data: dictionary (settings/config)
+        Read only GUI settings from disk, for callers that look up configurations individually.
         :return: None
         """
-        with open(filename, "w") as sf:
-            json.dump(data, sf, indent=4)
+        self.gui_settings = {**self.gui_settings, **self.__store.get_settings()}
+
+    def get_configuration(self, name: str) -> Optional[dict]:
+        """
+        Read a single configuration from disk, without loading the others.
+        :param name: configuration name
+        :return: configuration, or None if there is none by that name
+        """
+        return self.__store.get_configuration(name)
+
+    def throttle_limits(self, name: Optional[str] = None) -> tuple:
+        """
+        Read current throttle limits from disk, bypassing the loaded copies, so that running syncs can poll it and
+        pick up changes saved by any process.
+        :param name: configuration name, or None for the limits of the GUI settings alone
+        :return: bytes per second and operations per second, 0 if unlimited
+        """
+        settings = {**self.gui_settings, **self.__store.get_settings()}
+        return limits_of(settings, self.__store.get_configuration(name) if name else None)
 
     @property
     def gui_settings(self) -> dict:
@@ -86,20 +107,40 @@ class GuiSettings(object):
 
     def update_gui_setting(self, k: str, v: Any) -> None:
         """
-        Commit GUI setting change locally and to file.
+        Commit GUI setting change locally, and queue it for writing to disk.
         :param k: setting key
         :param v: value
         :return: None
         """
         self.gui_settings[k] = v
-        self.__save_to_file(self.settings_file, self.gui_settings)
+        self.__store.put_setting(k, v)
 
     def update_configuration(self, k: str, kv_pairs: dict) -> None:
         """
-        Commit configuration change locally and to file.
+        Commit configuration change locally, and queue it for writing to disk.
         :param k: configuration key
         :param kv_pairs: configuration values
         :return: None
         """
         self.configurations[k] = kv_pairs
-        self.__save_to_file(self.configurations_file, self.configurations)
+        self.__store.put_configuration(k, kv_pairs)
+
+    def close(self) -> None:
+        """
+        Write queued changes to disk.
+        :return: None
+        """
+        self.__store.close()
+
+
+def limits_of(settings: dict, configuration: Optional[dict] = None) -> tuple:
+    """
+    Throttle limits of a configuration: its own "max_mib_per_second" and "max_ops_per_second" where set,
+    otherwise those of the GUI settings.
+    :param settings: GUI settings dictionary
+    :param configuration: configuration, if any
+    :return: bytes per second and operations per second, 0 if unlimited
+    """
+    configuration = configuration or {}
+    mib_per_second = configuration.get("max_mib_per_second", settings[SettingsKey.MAX_MIB_PER_SECOND])
+    return mib_per_second * MIB, configuration.get("max_ops_per_second", settings[SettingsKey.MAX_OPS_PER_SECOND])
@@ -0,0 +1,213 @@
+from os import makedirs, replace
+from os.path import dirname, exists, join
+from threading import Lock, Timer
+from typing import Any, Optional
+import json
+import sqlite3
+
+from src.settings.constants import LOCKSTEP_FOLDER
+
+SETTINGS_DATABASE = join(LOCKSTEP_FOLDER, "settings.db")
+
+# JSON files written by earlier versions; imported once, then renamed with this suffix
+LEGACY_SETTINGS_FILE = join(LOCKSTEP_FOLDER, "settings.json")
+LEGACY_CONFIGURATIONS_FILE = join(LOCKSTEP_FOLDER, "configurations.json")
+MIGRATED_SUFFIX = ".migrated"
+
+# changes are held back this many seconds, so bursts (e.g. clicking through a spin box) become a single write
+DEFAULT_WRITE_DELAY = 1.0
+
+# seconds to wait for another process holding the database lock
+LOCK_TIMEOUT = 30.0
+
+SCHEMA_VERSION = 1
+TABLES = ("settings", "configurations")
+
+
+class SettingsStore(object):
+    """
+    This class persists GUI settings and configurations in SQLite, one row per key, so the GUI, CLI and daemons can
+    share the data folder. SQLite serializes writers across processes and commits atomically, a write only touches
+    the rows that changed, and a single configuration can be read without loading the others.
+    Changes are queued and written together after a short delay; reads see queued changes immediately.
+    """
+    def __init__(self, filename: str = SETTINGS_DATABASE, write_delay: float = DEFAULT_WRITE_DELAY,
+                 legacy_files: Optional[dict] = None) -> None:
+        self.__filename = filename
+        self.__write_delay = write_delay
+        self.__legacy_files = legacy_files if legacy_files is not None else {
+            "settings": LEGACY_SETTINGS_FILE,
+            "configurations": LEGACY_CONFIGURATIONS_FILE
+        }
+        self.__connection = None  # opened on first use
+        self.__pending = {table: {} for table in TABLES}  # writes not yet committed to disk
+        self.__timer = None
+        self.__lock = Lock()  # shared with the delayed write timer
+
+    def __connect(self) -> sqlite3.Connection:
+        """
+        Open database, creating it and importing legacy JSON files if necessary. Caller must hold the lock.
+        :return: database connection
+        """
+        if self.__connection is None:
+            makedirs(dirname(self.__filename), exist_ok=True)
+            connection = sqlite3.connect(self.__filename, timeout=LOCK_TIMEOUT, check_same_thread=False,
+                                         isolation_level=None)  # transactions are managed explicitly
+            connection.execute("PRAGMA journal_mode=WAL")  # readers don't block the writer, and vice versa
+            connection.execute("BEGIN IMMEDIATE")  # take the write lock, so only one process migrates
+            try:
+                if connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                    for table in TABLES:
+                        connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT)")
+                    migrated = self.__import_legacy_files(connection)
+                    connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+                else:
+                    migrated = []
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                connection.close()
+                raise
+
+            for filename in migrated:
+                replace(filename, filename + MIGRATED_SUFFIX)  # kept as a backup, but no longer read
+            self.__connection = connection
+        return self.__connection
+
+    def __import_legacy_files(self, connection: sqlite3.Connection) -> list:
+        """
+        Copy settings/configurations from the JSON files of earlier versions. Runs inside the schema transaction.
+        :param connection: database connection
+        :return: imported files
+        """
+        migrated = []
+        for table, filename in self.__legacy_files.items():
+            if not exists(filename):
+                continue
+            try:
+                with open(filename, "r") as f:
+                    data = json.load(f)
+            except ValueError as e:
+                print(f"Unable to migrate {filename}: {e}")
+                continue
+            connection.executemany(f"INSERT OR IGNORE INTO {table} VALUES (?, ?)",
+                                   [(key, json.dumps(value)) for key, value in data.items()])
+            migrated.append(filename)
+            print(f"Migrated {len(data)} {table} from {filename}")
+        return migrated
+
+    def __read(self, table: str, key: Optional[str] = None) -> dict:
+        """
+        Read rows from disk, overlaid with queued writes.
+        :param table: settings or configurations
+        :param key: single key to read, or None for all
+        :return: key -> value
+        """
+        with self.__lock:
+            if key is None:
+                rows = self.__connect().execute(f"SELECT key, value FROM {table}").fetchall()
+                pending = self.__pending[table]
+            else:
+                rows = self.__connect().execute(f"SELECT key, value FROM {table} WHERE key=?", (key,)).fetchall()
+                pending = {key: self.__pending[table][key]} if key in self.__pending[table] else {}
+        return {**{k: json.loads(v) for k, v in rows}, **pending}
+
+    def __write(self, table: str, key: str, value: Any) -> None:
+        """
+        Queue write and schedule the delayed flush.
+        :param table: settings or configurations
+        :param key: row key
+        :param value: JSON-serializable value
+        :return: None
+        """
+        with self.__lock:
+            self.__pending[table][key] = value
+            if self.__timer is None:
+                self.__timer = Timer(self.__write_delay, self.__flush_delayed)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def get_settings(self) -> dict:
+        """
+        Read all GUI settings.
+        :return: setting key -> value
+        """
+        return self.__read("settings")
+
+    def put_setting(self, key: str, value: Any) -> None:
+        """
+        Change one GUI setting. Written to disk after the write delay, or on flush.
+        :param key: setting key
+        :param value: JSON-serializable value
+        :return: None
+        """
+        self.__write("settings", key, value)
+
+    def get_configurations(self) -> dict:
+        """
+        Read all configurations.
+        :return: configuration name -> configuration
+        """
+        return self.__read("configurations")
+
+    def get_configuration(self, name: str) -> Optional[dict]:
+        """
+        Read a single configuration.
+        :param name: configuration name
+        :return: configuration, or None if there is none by that name
+        """
+        return self.__read("configurations", name).get(name)
+
+    def put_configuration(self, name: str, configuration: dict) -> None:
+        """
+        Add or replace one configuration. Written to disk after the write delay, or on flush.
+        :param name: configuration name
+        :param configuration: configuration (src, dst, sync, ...)
+        :return: None
+        """
+        self.__write("configurations", name, configuration)
+
+    def flush(self) -> None:
+        """
+        Commit queued writes in one transaction.
+        :return: None
+        """
+        with self.__lock:
+            if self.__timer is not None:
+                self.__timer.cancel()  # no-op when called from the timer itself
+                self.__timer = None
+            if not any(self.__pending.values()):
+                return
+
+            connection = self.__connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for table, rows in self.__pending.items():
+                    connection.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?)",
+                                           [(key, json.dumps(value)) for key, value in rows.items()])
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self.__pending = {table: {} for table in TABLES}
+
+    def __flush_delayed(self) -> None:
+        """
+        Flush from the write timer. Failed writes stay queued for the next flush.
+        :return: None
+        """
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            print(f"Unable to save settings: {e}")
+
+    def close(self) -> None:
+        """
+        Flush queued writes and close the database.
+        :return: None
+        """
+        self.flush()
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None